@@ -0,0 +1,89 @@
+from __future__ import unicode_literals
+import os
+import hashlib
+import requests
+from time import time
+from tempfile import NamedTemporaryFile
+from logging import getLogger
+from cache import DiskCache, cache_root
+from config import config
+
+artwork_path = os.path.join(cache_root, 'artwork')
+artwork_max_bytes = config.get('artwork_cache_size', 1024 * 1024 * 1024)
+artwork_revalidate = config.get('artwork_revalidate', 30 * 24 * 60 * 60)
+artwork_index = DiskCache('artwork-index')
+
+def fix_jpeg(data):
+  if len(data) > 3 and data[:3] == b'\xff\xd8\xff' and data[3:4] != b'\xe0':
+    data = data[:3] + b'\xe0' + data[4:]
+  return data
+
+def _evict():
+  entries = []
+  for name in os.listdir(artwork_path):
+    if name.endswith('.tmp'):
+      continue
+    try:
+      st = os.stat(os.path.join(artwork_path, name))
+    except OSError:
+      continue
+    entries.append((st.st_mtime, st.st_size, name))
+  total = sum(e[1] for e in entries)
+  if total <= artwork_max_bytes:
+    return
+  for _, size, name in sorted(entries):
+    getLogger().debug('Evicting artwork {:s}'.format(name))
+    try:
+      os.remove(os.path.join(artwork_path, name))
+    except OSError:
+      pass
+    total -= size
+    if total <= artwork_max_bytes * 0.9:
+      break
+
+def _store(data, ext):
+  digest = hashlib.sha1(data).hexdigest()
+  path = os.path.join(artwork_path, '{:s}{:s}'.format(digest, ext))
+  if not os.path.exists(path):
+    with NamedTemporaryFile('wb', dir=artwork_path, suffix='.tmp', delete=False) as f:
+      f.write(data)
+    os.rename(f.name, path)
+    _evict()
+  return path
+
+def fetch(url, log=None, timeout=30):
+  if log is None:
+    log = getLogger()
+  if not os.path.exists(artwork_path):
+    os.makedirs(artwork_path)
+  entry = artwork_index.get(url)
+  cached = None
+  if entry is not None and os.path.exists(os.path.join(artwork_path, entry['file'])):
+    cached = os.path.join(artwork_path, entry['file'])
+    if time() - entry['validated'] < artwork_revalidate:
+      os.utime(cached, None)
+      return cached
+  headers = {}
+  if cached is not None and entry.get('etag'):
+    headers['If-None-Match'] = entry['etag']
+  try:
+    log.debug('Downloading artwork from {:s}'.format(url))
+    response = requests.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304 and cached is not None:
+      entry['validated'] = time()
+      artwork_index.set(url, entry)
+      os.utime(cached, None)
+      return cached
+    response.raise_for_status()
+  except requests.exceptions.RequestException as e:
+    if cached is not None:
+      log.warning('Unable to revalidate artwork {:s}, using cached copy: {}'.format(url, e))
+      return cached
+    raise
+  ext = os.path.splitext(url.split('?')[0])[1].lower()
+  data = response.content
+  if ext in ['.jpg', '.jpeg']:
+    data = fix_jpeg(data)
+  path = _store(data, ext)
+  artwork_index.set(url, {'file': os.path.basename(path), 'etag': response.headers.get('ETag'), 'validated': time()})
+  return path
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+import os
+import json
+import hashlib
+from time import time
+from tempfile import gettempdir, NamedTemporaryFile
+from logging import getLogger
+from rarstream import is_url, from_url
+from config import config
+
+cache_root = config.get('cache_path', os.path.join(gettempdir(), 'convert-cache'))
+
+def fingerprint(filepath, sample_size=1 << 20):
+  if is_url(filepath):
+    f = from_url(filepath)
+    size, mtime = f.size, f.mtime
+  else:
+    f = open(filepath, 'rb')
+    st = os.fstat(f.fileno())
+    size, mtime = st.st_size, st.st_mtime
+  h = hashlib.sha1()
+  with f:
+    h.update(f.read(sample_size))
+    if size > 3 * sample_size:
+      f.seek(size // 2)
+      h.update(f.read(sample_size))
+    if size > 2 * sample_size:
+      f.seek(-sample_size, os.SEEK_END)
+      h.update(f.read(sample_size))
+  return '{:d}:{:d}:{:s}'.format(size, int(mtime), h.hexdigest())
+
+def make_key(*parts):
+  return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+class DiskCache(object):
+  def __init__(self, name, max_bytes=None, ttl=None):
+    self.path = os.path.join(cache_root, name)
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.log = getLogger()
+    if not os.path.exists(self.path):
+      os.makedirs(self.path)
+
+  def _file(self, key):
+    return os.path.join(self.path, '{:s}.json'.format(make_key(key)))
+
+  def get(self, key, ttl=None):
+    ttl = self.ttl if ttl is None else ttl
+    path = self._file(key)
+    try:
+      with open(path, 'r') as f:
+        entry = json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    if entry['key'] != key or (ttl is not None and time() - entry['stored'] > ttl):
+      self.delete(key)
+      return None
+    os.utime(path, None)
+    return entry['value']
+
+  def set(self, key, value):
+    entry = {'key': key, 'stored': time(), 'value': value}
+    with NamedTemporaryFile('w', dir=self.path, suffix='.tmp', delete=False) as f:
+      json.dump(entry, f)
+    os.rename(f.name, self._file(key))
+    if self.max_bytes is not None:
+      self._evict()
+
+  def delete(self, key):
+    path = self._file(key)
+    if os.path.exists(path):
+      os.remove(path)
+
+  def _evict(self):
+    entries = []
+    for name in os.listdir(self.path):
+      if name.endswith('.json'):
+        try:
+          st = os.stat(os.path.join(self.path, name))
+        except OSError:
+          continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(e[1] for e in entries)
+    if total <= self.max_bytes:
+      return
+    for _, size, name in sorted(entries):
+      self.log.debug('Evicting cache entry {:s}/{:s}'.format(os.path.basename(self.path), name))
+      try:
+        os.remove(os.path.join(self.path, name))
+      except OSError:
+        pass
+      total -= size
+      if total <= self.max_bytes * 0.9:
+        break
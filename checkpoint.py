@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+import os
+import json
+import shutil
+from time import time
+from tempfile import NamedTemporaryFile
+from logging import getLogger
+from cache import fingerprint, make_key
+from config import config
+
+checkpoint_root = config.get('checkpoint_path', os.path.join(os.path.expanduser('~'), '.convert', 'checkpoints'))
+checkpoint_expiry = config.get('checkpoint_expiry', 14 * 24 * 3600)
+
+stages = ['analyzed', 'normalized', 'tagged', 'faststarted', 'published']
+
+def _fsync(path, directory=False):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+class Checkpoint(object):
+  def __init__(self, kind, source, params=None, log=None, work_root=None):
+    self.fingerprint = fingerprint(source)
+    self.key = make_key(kind, self.fingerprint, params)
+    self.path = os.path.join(checkpoint_root, '{:s}.json'.format(self.key))
+    self.work_dir = os.path.join(work_root or checkpoint_root, self.key)
+    self.log = log if log is not None else getLogger()
+    for folder in [checkpoint_root, self.work_dir]:
+      if not os.path.exists(folder):
+        os.makedirs(folder)
+    try:
+      with open(self.path, 'r') as f:
+        self.state = json.load(f)
+    except (IOError, OSError, ValueError):
+      self.state = {'kind': kind, 'source': source, 'params': params, 'stages': {}}
+    self.state['work_dir'] = self.work_dir
+    self._save()
+    self.stage = self._last_valid()
+    if self.stage is not None:
+      self.log.info('Resuming from checkpoint \'{:s}\''.format(self.stage))
+
+  def _valid(self, name):
+    for artifact in self.state['stages'][name]['artifacts']:
+      if not os.path.isfile(artifact['path']):
+        self.log.warning('Checkpoint \'{:s}\' artifact {:s} is missing'.format(name, artifact['path']))
+        return False
+      if fingerprint(artifact['path']) != artifact['fingerprint']:
+        self.log.warning('Checkpoint \'{:s}\' artifact {:s} has changed'.format(name, artifact['path']))
+        return False
+    return True
+
+  def _last_valid(self):
+    for name in reversed(stages):
+      if name in self.state['stages'] and self._valid(name):
+        return name
+    return None
+
+  def reached(self, name):
+    return self.stage is not None and stages.index(self.stage) >= stages.index(name)
+
+  def artifacts(self, name=None):
+    name = self.stage if name is None else name
+    if name not in self.state['stages']:
+      return []
+    return [a['path'] for a in self.state['stages'][name]['artifacts']]
+
+  def data(self, name=None):
+    name = self.stage if name is None else name
+    if name not in self.state['stages']:
+      return None
+    return self.state['stages'][name]['data']
+
+  def record(self, name, artifacts=None, data=None):
+    if artifacts is None:
+      artifacts = []
+    elif not isinstance(artifacts, list):
+      artifacts = [artifacts]
+    for path in artifacts:
+      _fsync(path)
+    self.state['stages'][name] = {
+      'time': time(),
+      'artifacts': [{'path': path, 'fingerprint': fingerprint(path)} for path in artifacts],
+      'data': data
+    }
+    self.stage = name
+    self._save()
+    self.log.debug('Recorded checkpoint \'{:s}\''.format(name))
+
+  def _save(self):
+    with NamedTemporaryFile('w', dir=checkpoint_root, suffix='.tmp', delete=False) as f:
+      json.dump(self.state, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(f.name, self.path)
+    _fsync(checkpoint_root)
+
+  def clear(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    shutil.rmtree(self.work_dir, ignore_errors=True)
+
+def expire(max_age=None, source=None, log=None):
+  log = log if log is not None else getLogger()
+  max_age = checkpoint_expiry if max_age is None else max_age
+  if not os.path.isdir(checkpoint_root):
+    return 0
+  now = time()
+  expired = 0
+  for name in os.listdir(checkpoint_root):
+    if not name.endswith('.json'):
+      continue
+    path = os.path.join(checkpoint_root, name)
+    try:
+      if source is None and now - os.path.getmtime(path) < max_age:
+        continue
+      with open(path, 'r') as f:
+        state = json.load(f)
+    except (IOError, OSError, ValueError):
+      continue
+    if source is not None and state.get('source') != source:
+      continue
+    log.info('Expiring checkpoint for {:s}'.format(state.get('source')))
+    shutil.rmtree(state.get('work_dir', os.path.join(checkpoint_root, name[:-len('.json')])), ignore_errors=True)
+    os.remove(path)
+    expired += 1
+  return expired
@@ -21,10 +21,11 @@ def pushover(s, m, fail=False):
       Client(user_key=k).send_message(m, title=s)
 
 class Cleaner(object):
-  def __init__(self, ref, ident=None, temp_dir=None):
+  def __init__(self, ref, ident=None, temp_dir=None, checkpoint=None):
     if temp_dir:
       tempfile.tempdir = temp_dir
     self._temp_files = []
+    self._checkpoint = checkpoint
     self.temp_dir = tempfile.gettempdir()
     self._ref = ref
     self._log = getLogger()
@@ -74,10 +75,15 @@ class Cleaner(object):
       self.send_failmail(self._ref, ''.join(format_exception(exc_type, exc_val, exc_tb)))
       pushover(self._ref, 'An error of type {:s} occurred: {}'.format(exc_type.__name__, exc_val), True)
       print_exception(exc_type, exc_val, exc_tb)
+    keep = []
+    if exc_val is not None and self._checkpoint is not None:
+      keep = self._checkpoint.artifacts()
     if len(self._temp_files) > 0:
       with Timer('Cleaning up', self._id):
         for f in self._temp_files:
-          if os.path.exists(f):
+          if f in keep:
+            self._log.info('Keeping checkpointed file {:s}'.format(f))
+          elif os.path.exists(f):
             self._log.debug('Deleting temp file {:s}'.format(f))
             os.remove(f)
     return False
@@ -1,21 +1,40 @@
 import click
 import re
 import os
+import json
 from newfinished import process_tv
+from jobqueue import JobQueue, Daemon
+from library import Library, cost
+from digest import dedup
+from watch import Watcher
+from distributed import Coordinator, Worker, status
+import multiprocessing
+from ffmpeg import FfMpeg
 from shutil import move
 from config import config
 import tmdbsimple as tmdb
 from logging import getLogger
 
+def _progress_updater(bar):
+  label = bar.label
+  def update(progress):
+    if progress.fraction is not None:
+      bar.update(int(progress.fraction * bar.length) - bar.pos)
+    if progress.speed:
+      bar.label = '{:s} [{:.0f}fps {:.2f}x]'.format(label, progress.fps, progress.speed)
+  return update
+
 @click.group()
 def cli():
   pass
 
 @click.command()
 @click.option('--tag-only', is_flag=True)
+@click.option('--now', is_flag=True, help='Run in the foreground instead of submitting to the job queue')
+@click.option('--priority', type=click.Choice(['priority', 'normal', 'bulk']), default='normal')
 @click.argument('folder', type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True))
 @click.argument('tvdb_id', type=click.INT)
-def series(tag_only, folder, tvdb_id):
+def series(tag_only, now, priority, folder, tvdb_id):
   searcher = re.compile(r's(?P<season>\d\d?)e(?P<episode>\d\d)', re.I)
   files = []
   for root, dirs, fs in os.walk(folder):
@@ -24,36 +43,156 @@ def series(tag_only, folder, tvdb_id):
                   searcher.search(os.path.basename(f)) is not None])
   print('{:d} files found.'.format(len(files)))
 
+  q = JobQueue()
   for f in sorted(files, key=lambda f: (int(searcher.search(os.path.basename(f)).group('season')), int(searcher.search(os.path.basename(f)).group('episode')))):
     match = searcher.search(os.path.basename(f))
     if match:
-      process_tv(f,
-                 tvdb_id,
-                 int(match.group('season')),
-                 int(match.group('episode')),
-                 crop=True,
-                 deint=True,
-                 max_height=1080,
-                 tag_only=tag_only)
+      if not now:
+        job_id = q.submit('tv', {'file_path': f,
+                                 'show_id': tvdb_id,
+                                 'season_number': int(match.group('season')),
+                                 'episode_number': int(match.group('episode')),
+                                 'crop': True,
+                                 'deint': True,
+                                 'max_height': 1080,
+                                 'tag_only': tag_only}, priority=priority, source=f, mark_done=True)
+        print('{:s} queued as job {:d}'.format(os.path.basename(f), job_id))
+        continue
+      with click.progressbar(length=1000, label=os.path.basename(f)) as bar:
+        process_tv(f,
+                   tvdb_id,
+                   int(match.group('season')),
+                   int(match.group('episode')),
+                   crop=True,
+                   deint=True,
+                   max_height=1080,
+                   tag_only=tag_only,
+                   progress=_progress_updater(bar))
       move(f, f + '.done')
 
 @click.command()
+@click.option('--now', is_flag=True, help='Run in the foreground instead of submitting to the job queue')
+@click.option('--priority', type=click.Choice(['priority', 'normal', 'bulk']), default='normal')
 @click.argument('file', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
 @click.argument('tvdb_id', type=click.INT)
 @click.argument('season', type=click.INT)
 @click.argument('episode', type=click.INT)
-def episode(file, tvdb_id, season, episode):
-  process_tv(file,
-             tvdb_id,
-             season,
-             episode,
-             crop=True,
-             deint=True,
-             max_height=1080)
+def episode(now, priority, file, tvdb_id, season, episode):
+  if not now:
+    job_id = JobQueue().submit('tv', {'file_path': file,
+                                      'show_id': tvdb_id,
+                                      'season_number': season,
+                                      'episode_number': episode,
+                                      'crop': True,
+                                      'deint': True,
+                                      'max_height': 1080}, priority=priority, source=file, mark_done=True)
+    print('{:s} queued as job {:d}'.format(os.path.basename(file), job_id))
+    return
+  with click.progressbar(length=1000, label=os.path.basename(file)) as bar:
+    process_tv(file,
+               tvdb_id,
+               season,
+               episode,
+               crop=True,
+               deint=True,
+               max_height=1080,
+               progress=_progress_updater(bar))
   move(file, file + '.done')
 
+@click.command()
+@click.option('--all', 'show_all', is_flag=True, help='Include finished jobs')
+def jobs(show_all):
+  states = None if show_all else ['queued', 'running', 'failed']
+  rows = JobQueue().jobs(states)
+  progress = {}
+  if any(job['state'] == 'running' and (job['worker'] or '').startswith('tcp:') for job in rows):
+    try:
+      progress = status()
+    except IOError as e:
+      print('Unable to reach the coordinator: {}'.format(e))
+  for job in rows:
+    args = json.loads(job['args'])
+    line = '{:6d} {:8s} {:12s} {:2d}/{:d} {:s}'.format(job['id'], job['state'], job['kind'], job['attempts'], job['max_attempts'], os.path.basename(args['file_path']))
+    p = progress.get(job['id'])
+    if p is not None and p['fraction'] is not None:
+      line += ' [{:.1f}% on {:s}]'.format(p['fraction'] * 100, p['worker'])
+    print(line)
+
+@click.command()
+@click.option('--slots', type=click.INT, default=None)
+def daemon(slots):
+  Daemon(slots=slots).run()
+
+@click.command()
+@click.option('--full', is_flag=True, help='Rescan files that have not changed since the last scan')
+@click.option('--workers', type=click.INT, default=None)
+def reindex(full, workers):
+  scanned = Library().rebuild([config['plex_movie_section'], config['plex_tv_section']], workers=workers, full=full)
+  print('{:d} files scanned.'.format(scanned))
+
+@click.command()
+@click.option('--limit', type=click.INT, default=None)
+def stale(limit):
+  version = FfMpeg.version
+  rows = Library().stale(version)
+  for row in rows[:limit]:
+    outdated = [k for k in ['video', 'audio', 'tags'] if row[k] != version[k]]
+    print('{:8.0f} {:12s} {:s}'.format(cost(row), ','.join(outdated), row['path']))
+  print('{:d} stale files, {:.1f} hours of 1080p-equivalent encoding.'.format(len(rows), sum(cost(row) for row in rows) / 3600))
+
+@click.command()
+@click.option('--unpin', is_flag=True)
+@click.argument('paths', nargs=-1, type=click.Path(dir_okay=False))
+def pin(unpin, paths):
+  Library().pin([os.path.abspath(p) for p in paths], pinned=not unpin)
+
+@click.command()
+@click.option('--with-library', is_flag=True, help='Also link Plex files that are identical to a backup')
+def dedupe(with_library):
+  folders = [config['oldmp4_folder']]
+  if with_library:
+    folders.extend([config['plex_movie_section'], config['plex_tv_section']])
+  paths = []
+  for folder in folders:
+    for root, dirs, fs in os.walk(folder):
+      paths.extend([os.path.join(root, f) for f in fs if os.path.splitext(f)[1].lower() in ['.mp4', '.m4v']])
+  saved = dedup(paths)
+  print('{:.1f} GiB reclaimed.'.format(saved / float(1 << 30)))
+
+@click.command()
+@click.option('--settle', type=click.INT, default=None, help='Seconds a file must stay unchanged before it is queued')
+@click.option('--retry-failed', is_flag=True, help='Queue files again even if an unchanged copy already failed')
+def watch(settle, retry_failed):
+  Watcher(settle=settle, retry_failed=retry_failed or None).run()
+
+@click.command()
+@click.option('--host', default=None, help='Address to listen on, set coordinator_token before exposing it to the network')
+@click.option('--port', type=click.INT, default=None)
+def coordinator(host, port):
+  Coordinator(host=host, port=port).run()
+
+@click.command()
+@click.option('--port', type=click.INT, default=None)
+@click.option('--slots', type=click.INT, default=1)
+@click.argument('host')
+def worker(port, slots, host):
+  workers = [multiprocessing.Process(target=Worker(host, port, name='{:s}:{:d}'.format(os.uname()[1], n)).run) for n in range(slots)]
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+
 cli.add_command(series)
 cli.add_command(episode)
+cli.add_command(jobs)
+cli.add_command(daemon)
+cli.add_command(reindex)
+cli.add_command(stale)
+cli.add_command(pin)
+cli.add_command(dedupe)
+cli.add_command(watch)
+cli.add_command(coordinator)
+cli.add_command(worker)
 
 if __name__ == '__main__':
   tmdb.API_KEY = config['tmdb']
@@ -4,90 +4,81 @@ from __future__ import unicode_literals
 from __future__ import print_function
 import re
 import os
-from shutil import move
 from logging import getLogger
 from ffmpeg import get_ffprobe
 
 import tmdbsimple as tmdb
 
 from config import config
-from newfinished import process_movie, process_tv
+from jobqueue import JobQueue
 
-def blu_movies(folder):
-  searcher = re.compile(
-    r'^(?P<tmdb_id>\d+)\s?-(\[(?P<collection>[^\]]+)\]\s*)?(?P<title>.+?)$')
+ladder_pattern = re.compile(
+  r'^(?P<tmdb_id>\d+)\s?-(\[(?P<collection>[^\]]+)\]\s*)?(?P<title>.+?)$')
+movie_pattern = re.compile(
+  r'^(?P<tmdb_id>\d+)\s?-(\[(?P<collection>[^\]]+)\]\s*)?(?P<title>.+?)(-(?P<feature_type>behindthescenes|deleted|interview|scene|trailer))?$')
+
+def submit_ladder(q, f, priority='normal'):
+  match = ladder_pattern.search(os.path.splitext(os.path.basename(f))[0])
+  if not match:
+    getLogger().error('Movie filename does not match pattern')
+    return None
+  ffprobe = get_ffprobe(f)
+  video = [s for s in ffprobe['streams'] if s['codec_type'] == 'video'][0]
+  heights = [480]
+  if video['height'] > 480:
+    heights.insert(0, 720)
+  if video['height'] > 720:
+    heights.insert(0, 1080)
+  return q.submit('movie_ladder', {'file_path': f,
+                                   'tmdb_id': int(match.group('tmdb_id')),
+                                   'heights': heights,
+                                   'collection': match.group('collection'),
+                                   'crop': True,
+                                   'deint': True,
+                                   'keep_other_audio': True}, priority=priority, source=f, mark_done=True)
+
+def submit_movie(q, f, priority='normal'):
+  match = movie_pattern.search(os.path.splitext(os.path.basename(f))[0])
+  if not match:
+    getLogger().error('Movie filename does not match pattern')
+    return None
+  if match.group('feature_type') is not None:
+    return q.submit('movie', {'file_path': f,
+                              'tmdb_id': int(match.group('tmdb_id')),
+                              'collection': match.group('collection'),
+                              'crop': True,
+                              'special_feature_title': match.group('title'),
+                              'special_feature_type': match.group('feature_type')}, priority=priority, source=f, mark_done=True)
+  return q.submit('movie', {'file_path': f,
+                            'tmdb_id': int(match.group('tmdb_id')),
+                            'collection': match.group('collection'),
+                            'crop': True,
+                            'keep_other_audio': True,
+                            'max_height': 1080,
+                            'res_in_filename': True}, priority=priority, source=f, mark_done=True)
+
+def blu_movies(folder, priority='normal'):
   files = []
   for root, dirs, fs in os.walk(folder):
     files.extend([os.path.join(root, f) for f in fs if
                   os.path.splitext(f)[1].lower() in ['.mkv', '.mp4', '.avi'] and
-                  searcher.search(os.path.splitext(os.path.basename(f))[0]) is not None])
+                  ladder_pattern.search(os.path.splitext(os.path.basename(f))[0]) is not None])
   print('{:d} files found.'.format(len(files)))
 
-  for f in sorted(files, key=lambda f: int(searcher.search(os.path.splitext(os.path.basename(f))[0]).group('tmdb_id'))):
-    match = searcher.search(os.path.splitext(os.path.basename(f))[0])
-    if match:
-      ffprobe = get_ffprobe(f)
-      video = [s for s in ffprobe['streams'] if s['codec_type'] == 'video'][0]
-      if video['height'] > 720:
-        process_movie(f,
-                      int(match.group('tmdb_id')),
-                      collection=match.group('collection'),
-                      crop=True,
-                      deint=True,
-                      keep_other_audio=True,
-                      max_height=1080,
-                      res_in_filename=True)
-      if video['height'] > 480:
-        process_movie(f,
-                      int(match.group('tmdb_id')),
-                      collection=match.group('collection'),
-                      crop=True,
-                      deint=True,
-                      keep_other_audio=True,
-                      max_height=720,
-                      res_in_filename=True)
-      process_movie(f,
-                    int(match.group('tmdb_id')),
-                    collection=match.group('collection'),
-                    crop=True,
-                    deint=True,
-                    keep_other_audio=True,
-                    max_height=480,
-                    res_in_filename=True)
-      move(f, f + '.done')
-    else:
-      log.error('Movie filename does not match pattern')
+  q = JobQueue()
+  for f in sorted(files, key=lambda f: int(ladder_pattern.search(os.path.splitext(os.path.basename(f))[0]).group('tmdb_id'))):
+    submit_ladder(q, f, priority=priority)
 
 def main_movies():
   folder = '/tank/Incoming/'
-  searcher = re.compile(
-    r'^(?P<tmdb_id>\d+)\s?-(\[(?P<collection>[^\]]+)\]\s*)?(?P<title>.+?)(-(?P<feature_type>behindthescenes|deleted|interview|scene|trailer))?$')
   files = []
   for root, dirs, fs in os.walk(folder):
     files.extend([os.path.join(root, f) for f in fs if
                   os.path.splitext(f)[1].lower() in ['.mkv', '.mp4', '.avi']])
   print('{:d} files found.'.format(len(files)))
+  q = JobQueue()
   for f in files:
-    match = searcher.search(os.path.splitext(os.path.basename(f))[0])
-    if match:
-      if match.group('feature_type') is not None:
-        process_movie(f,
-                      int(match.group('tmdb_id')),
-                      collection=match.group('collection'),
-                      crop=True,
-                      special_feature_title=match.group('title'),
-                      special_feature_type=match.group('feature_type'))
-      else:
-        process_movie(f,
-                      int(match.group('tmdb_id')),
-                      collection=match.group('collection'),
-                      crop=True,
-                      keep_other_audio=True,
-                      max_height=1080,
-                      res_in_filename=True)
-      move(f, f + '.done')
-    else:
-      log.error('Movie filename does not match pattern')
+    submit_movie(q, f)
 
 
 def main():
@@ -98,17 +89,17 @@ def main():
     files.extend([os.path.join(root, f) for f in fs if
                   os.path.splitext(f)[1].lower() in ['.mkv', '.mp4', '.avi']])
   print('{:d} files found.'.format(len(files)))
+  q = JobQueue()
   for f in files:
     match = searcher.search(os.path.basename(f))
     if match:
-      process_tv(f,
-                 275274,
-                 int(match.group('season')),
-                 int(match.group('episode')),
-                 crop=True,
-                 deint=False,
-                 max_height=1080)
-      move(f, f + '.done')
+      q.submit('tv', {'file_path': f,
+                      'show_id': 275274,
+                      'season_number': int(match.group('season')),
+                      'episode_number': int(match.group('episode')),
+                      'crop': True,
+                      'deint': False,
+                      'max_height': 1080}, source=f, mark_done=True)
 
 
 def retag_tv():
@@ -120,14 +111,14 @@ def retag_tv():
     files.extend([os.path.join(root, f) for f in fs if
                   os.path.splitext(f)[1].lower() in ['.mkv', '.mp4', '.avi']])
   print('{:d} files found.'.format(len(files)))
+  q = JobQueue()
   for f in files:
     match = searcher.search(os.path.basename(f))
     if match:
       if os.path.splitext(f)[1].lower() in ['.mkv', '.mp4', '.avi']:
         season_number = int(match.group('season'))
         episode_number = int(match.group('episode'))
-        process_tv(f, show_id, season_number, episode_number, tag_only=True)
-        move(f, f + '.done')
+        q.submit('tv', {'file_path': f, 'show_id': show_id, 'season_number': season_number, 'episode_number': episode_number, 'tag_only': True}, source=f, mark_done=True)
 
 
 if __name__ == '__main__':
@@ -136,5 +127,5 @@ if __name__ == '__main__':
 
   setup_logging('convert')
   log = getLogger()
-  blu_movies('/tank/incoming/movies/priority')
+  blu_movies('/tank/incoming/movies/priority', priority='priority')
   blu_movies('/tank/incoming/movies')
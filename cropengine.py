@@ -0,0 +1,87 @@
+from __future__ import unicode_literals
+from __future__ import division
+import math
+import numpy as np
+from runner import Runner
+from logging import getLogger
+
+def sample_positions(duration, samples):
+  positions = []
+  for i in range(1, samples + 1):
+    q = 0.0
+    denominator = 1.0
+    n = i
+    while n > 0:
+      denominator *= 2
+      n, remainder = divmod(n, 2)
+      q += remainder / denominator
+    positions.append((0.05 + 0.9 * q) * duration)
+  return positions
+
+def read_frames(filepath, stream_index, width, height, duration, samples=24, frames_per_sample=2, factor=2, window=30.0):
+  sw = int(width // factor) // 2 * 2
+  sh = int(height // factor) // 2 * 2
+  cmd = ['ffmpeg', '-hide_banner', '-nostats', '-v', 'error']
+  graph = []
+  for i, position in enumerate(sample_positions(duration, samples)):
+    cmd.extend(['-skip_frame', 'nokey', '-noaccurate_seek', '-ss', '{:.3f}'.format(position), '-t', '{:.3f}'.format(window), '-i', filepath])
+    graph.append('[{:d}:{:d}]trim=end_frame={:d},scale={:d}:{:d},format=gray[w{:d}]'.format(i, stream_index, frames_per_sample, sw, sh, i))
+  graph.append('{:s}concat=n={:d}:v=1:a=0[out]'.format(''.join(['[w{:d}]'.format(i) for i in range(samples)]), samples))
+  cmd.extend(['-filter_complex', ';'.join(graph), '-map', '[out]', '-an', '-sn', '-f', 'rawvideo', '-pix_fmt', 'gray', '-'])
+  frame_size = sw * sh
+  frames = []
+  r = Runner(cmd, stdout='raw').start()
+  while True:
+    buf = r.stdout.read(frame_size)
+    if len(buf) < frame_size:
+      break
+    frames.append(np.frombuffer(buf, dtype=np.uint8).reshape(sh, sw))
+  rc = r.wait()
+  if rc != 0:
+    raise IOError('Crop sampling failed with exit code {:d}'.format(rc))
+  if len(frames) == 0:
+    return np.zeros((0, sh, sw), dtype=np.uint8)
+  return np.stack(frames)
+
+def _edges(profile, limit):
+  content = np.flatnonzero(profile > limit)
+  if len(content) == 0:
+    return None
+  return content[0], content[-1]
+
+def frame_bounds(frames, limit=24):
+  rows = frames.mean(axis=2) > limit
+  cols = frames.mean(axis=1) > limit
+  h = rows.shape[1]
+  w = cols.shape[1]
+  has_rows = rows.any(axis=1)
+  has_cols = cols.any(axis=1)
+  y1 = np.where(has_rows, rows.argmax(axis=1), 0)
+  y2 = np.where(has_rows, h - 1 - rows[:, ::-1].argmax(axis=1), h - 1)
+  x1 = np.where(has_cols, cols.argmax(axis=1), 0)
+  x2 = np.where(has_cols, w - 1 - cols[:, ::-1].argmax(axis=1), w - 1)
+  return np.stack([x1, y1, x2, y2], axis=1), has_rows & has_cols
+
+def detect_crop(filepath, stream_index, width, height, duration, samples=24, frames_per_sample=2, limit=24, factor=2, log=None):
+  if log is None:
+    log = getLogger()
+  frames = read_frames(filepath, stream_index, width, height, duration, samples=samples, frames_per_sample=frames_per_sample, factor=factor)
+  log.debug('Read {:d} frames for crop detection'.format(len(frames)))
+  if len(frames) == 0:
+    return None
+  rows = _edges(frames.mean(axis=2).max(axis=0), limit)
+  cols = _edges(frames.mean(axis=1).max(axis=0), limit)
+  if rows is None or cols is None:
+    return None
+  sy = float(height) / frames.shape[1]
+  sx = float(width) / frames.shape[2]
+  x = int(math.floor(cols[0] * sx))
+  y = int(math.floor(rows[0] * sy))
+  w = min(int(math.ceil((cols[1] + 1) * sx)), width) - x
+  h = min(int(math.ceil((rows[1] + 1) * sy)), height) - y
+  bounds, content = frame_bounds(frames, limit)
+  if content.any():
+    heights = (bounds[content, 3] - bounds[content, 1] + 1) * sy
+    if heights.max() - heights.min() > 0.1 * height:
+      log.warning('Picture height varies between {:.0f} and {:.0f} across samples, aspect ratio may change mid-title'.format(heights.min(), heights.max()))
+  return {'x': x, 'y': y, 'width': w - w % 2, 'height': h - h % 2}
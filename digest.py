@@ -0,0 +1,133 @@
+from __future__ import unicode_literals
+import os
+import mmap
+import errno
+import fcntl
+import hashlib
+from tempfile import NamedTemporaryFile
+from logging import getLogger
+from cache import DiskCache
+from config import config
+
+digest_chunk = config.get('digest_chunk', 16 * 1024 * 1024)
+digest_attr = 'user.convert.digest'
+digest_index = DiskCache('digests')
+
+FICLONE = 0x40049409
+
+if hasattr(hashlib, 'blake2b'):
+  algorithm = 'blake2b'
+else:
+  algorithm = 'sha256'
+
+def _compute(path):
+  h = hashlib.new(algorithm)
+  with open(path, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return h.hexdigest()
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for offset in range(0, size, digest_chunk):
+        h.update(m[offset:offset + digest_chunk])
+    finally:
+      m.close()
+  return h.hexdigest()
+
+def _stamp(st):
+  return '{:d}:{:d}:{:s}'.format(st.st_size, int(st.st_mtime * 1000000), algorithm)
+
+def _read_cached(path, st):
+  stamp = _stamp(st)
+  if hasattr(os, 'getxattr'):
+    try:
+      value = os.getxattr(path, digest_attr).decode('ascii')
+    except (OSError, IOError):
+      value = None
+    if value is not None and value.rsplit(':', 1)[0] == stamp:
+      return value.rsplit(':', 1)[1]
+  entry = digest_index.get([path, stamp])
+  return None if entry is None else entry['digest']
+
+def _write_cached(path, st, digest):
+  stamp = _stamp(st)
+  if hasattr(os, 'setxattr'):
+    try:
+      os.setxattr(path, digest_attr, '{:s}:{:s}'.format(stamp, digest).encode('ascii'))
+      return
+    except (OSError, IOError):
+      pass
+  digest_index.set([path, stamp], {'digest': digest})
+
+def file_digest(path, log=None):
+  log = log if log is not None else getLogger()
+  st = os.stat(path)
+  digest = _read_cached(path, st)
+  if digest is None:
+    log.debug('Hashing {:s}'.format(path))
+    digest = _compute(path)
+    _write_cached(path, st, digest)
+  return digest
+
+def identical(a, b, log=None):
+  if os.path.getsize(a) != os.path.getsize(b):
+    return False
+  return file_digest(a, log=log) == file_digest(b, log=log)
+
+def link_duplicate(keep, duplicate, log=None):
+  log = log if log is not None else getLogger()
+  folder = os.path.dirname(duplicate)
+  with NamedTemporaryFile('wb', dir=folder, prefix='.dedup-', delete=False) as f:
+    temp = f.name
+    try:
+      with open(keep, 'rb') as src:
+        fcntl.ioctl(f.fileno(), FICLONE, src.fileno())
+      os.fsync(f.fileno())
+      method = 'reflink'
+    except (IOError, OSError) as e:
+      if e.errno not in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL]:
+        os.remove(temp)
+        raise
+      method = None
+  if method is None:
+    os.remove(temp)
+    try:
+      os.link(keep, temp)
+      method = 'hardlink'
+    except OSError as e:
+      if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+        raise
+      log.debug('Unable to link {:s} to {:s}: {}'.format(duplicate, keep, e))
+      return None
+  if method == 'reflink':
+    st = os.stat(duplicate)
+    os.utime(temp, (st.st_atime, st.st_mtime))
+    _write_cached(temp, os.stat(temp), file_digest(keep, log=log))
+  os.rename(temp, duplicate)
+  log.debug('Replaced {:s} with a {:s} to {:s}'.format(duplicate, method, keep))
+  return method
+
+def dedup(paths, log=None):
+  log = log if log is not None else getLogger()
+  by_size = {}
+  for path in paths:
+    try:
+      st = os.stat(path)
+    except OSError:
+      continue
+    by_size.setdefault(st.st_size, []).append((st.st_dev, st.st_ino, path))
+  saved = 0
+  for size, files in by_size.items():
+    if len(files) < 2 or size == 0:
+      continue
+    by_digest = {}
+    for dev, ino, path in files:
+      by_digest.setdefault(file_digest(path, log=log), []).append((dev, ino, path))
+    for group in by_digest.values():
+      keep = group[0]
+      for dev, ino, path in group[1:]:
+        if (dev, ino) == keep[:2]:
+          continue
+        if link_duplicate(keep[2], path, log=log) is not None:
+          saved += size
+  return saved
@@ -0,0 +1,290 @@
+from __future__ import unicode_literals
+import os
+import sys
+import hmac
+import json
+import signal
+import socket
+import multiprocessing
+from time import time, sleep
+from traceback import format_exc
+from logging import getLogger
+if sys.version > '3':
+  import socketserver
+else:
+  import SocketServer as socketserver
+from logs import setup_logging
+from jobqueue import JobQueue, resolve
+from checkpoint import expire as expire_checkpoints
+from config import config
+
+coordinator_host = config.get('coordinator_host', '127.0.0.1')
+coordinator_port = config.get('coordinator_port', 7654)
+coordinator_token = config.get('coordinator_token', None)
+worker_poll = config.get('worker_poll', 10)
+worker_heartbeat = config.get('worker_heartbeat', 15)
+worker_timeout = config.get('worker_timeout', 60)
+worker_reconnect = config.get('worker_reconnect', 30)
+worker_progress_interval = config.get('worker_progress_interval', 5)
+path_map = config.get('path_map', {})
+
+def _send(f, message):
+  f.write((json.dumps(message) + '\n').encode('utf-8'))
+  f.flush()
+
+def _recv(f):
+  line = f.readline()
+  if not line:
+    return None
+  return json.loads(line.decode('utf-8'))
+
+def _token_ok(expected, given):
+  if expected is None:
+    return True
+  if given is None:
+    return False
+  return hmac.compare_digest(expected.encode('utf-8'), given.encode('utf-8'))
+
+def _connect(host, port, token, name=None):
+  s = socket.create_connection((host, port), worker_timeout)
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+  f = s.makefile('rwb')
+  hello = {'op': 'hello', 'token': token}
+  if name is not None:
+    hello['worker'] = name
+  _send(f, hello)
+  reply = _recv(f)
+  if reply is None or reply['op'] != 'ok':
+    f.close()
+    s.close()
+    raise socket.error('Coordinator refused the connection: {}'.format(reply['error'] if reply is not None else 'closed'))
+  return s, f
+
+def status(host=None, port=None, token=None):
+  s, f = _connect(host or coordinator_host, port or coordinator_port, token if token is not None else coordinator_token)
+  try:
+    _send(f, {'op': 'status'})
+    reply = _recv(f)
+  finally:
+    f.close()
+    s.close()
+  if reply is None:
+    raise socket.error('Coordinator closed the connection')
+  return dict((int(k), v) for k, v in reply['jobs'].items())
+
+def map_paths(value, mapping):
+  if isinstance(value, dict):
+    return dict((k, map_paths(v, mapping)) for k, v in value.items())
+  if isinstance(value, list):
+    return [map_paths(v, mapping) for v in value]
+  if hasattr(value, 'startswith'):
+    for prefix in sorted(mapping, key=len, reverse=True):
+      if value == prefix or value.startswith(prefix.rstrip('/') + '/'):
+        return mapping[prefix] + value[len(prefix):]
+  return value
+
+class _Handler(socketserver.StreamRequestHandler):
+  def setup(self):
+    self.timeout = self.server.coordinator.timeout
+    socketserver.StreamRequestHandler.setup(self)
+    self.request.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+  def handle(self):
+    coordinator = self.server.coordinator
+    log = coordinator.log
+    queue = JobQueue(coordinator.path)
+    authorized = False
+    worker = None
+    running = set()
+    try:
+      while True:
+        message = _recv(self.rfile)
+        if message is None:
+          break
+        op = message.get('op')
+        if op == 'hello':
+          if not _token_ok(coordinator.token, message.get('token')):
+            log.warning('Rejected connection from {:s}: bad token'.format(self.client_address[0]))
+            _send(self.wfile, {'op': 'error', 'error': 'Bad token'})
+            break
+          authorized = True
+          if message.get('worker'):
+            worker = 'tcp:{:s}'.format(message['worker'])
+            log.info('Worker {:s} connected from {:s}'.format(worker, self.client_address[0]))
+          _send(self.wfile, {'op': 'ok'})
+        elif not authorized:
+          _send(self.wfile, {'op': 'error', 'error': 'Say hello first'})
+        elif op == 'status':
+          _send(self.wfile, {'op': 'status', 'jobs': coordinator.status()})
+        elif worker is None:
+          _send(self.wfile, {'op': 'error', 'error': 'Not a worker'})
+        elif op == 'claim':
+          job = queue.claim(worker)
+          if job is None:
+            due = queue.next_due()
+            wait = worker_poll if due is None else max(0.1, min(worker_poll, due - time()))
+            _send(self.wfile, {'op': 'idle', 'wait': wait})
+          else:
+            running.add(job['id'])
+            log.info('Sending {:s} job {:d} (attempt {:d}) to {:s}'.format(job['kind'], job['id'], job['attempts'], worker))
+            _send(self.wfile, {'op': 'job', 'id': job['id'], 'kind': job['kind'], 'args': json.loads(job['args'])})
+        elif op == 'heartbeat':
+          _send(self.wfile, {'op': 'ok'})
+        elif op == 'progress':
+          if message.get('id') in running:
+            coordinator.progress[message['id']] = {'worker': worker, 'fraction': message.get('fraction'), 'fps': message.get('fps'),
+                                                   'speed': message.get('speed'), 'eta': message.get('eta'), 'updated': time()}
+        elif op in ['done', 'failed'] and message.get('id') not in running:
+          _send(self.wfile, {'op': 'error', 'error': 'Job {} is not running on {:s}'.format(message.get('id'), worker)})
+        elif op == 'done':
+          running.discard(message['id'])
+          coordinator.progress.pop(message['id'], None)
+          queue.finish(message['id'])
+          log.info('Job {:d} finished on {:s}'.format(message['id'], worker))
+          _send(self.wfile, {'op': 'ok'})
+        elif op == 'failed':
+          running.discard(message['id'])
+          coordinator.progress.pop(message['id'], None)
+          queue.fail(message['id'], message['error'])
+          _send(self.wfile, {'op': 'ok'})
+        else:
+          _send(self.wfile, {'op': 'error', 'error': 'Unknown op {}'.format(op)})
+    except (socket.error, ValueError) as e:
+      log.warning('Connection to {} lost: {}'.format(worker, e))
+    finally:
+      for job_id in running:
+        coordinator.progress.pop(job_id, None)
+        if queue.get(job_id)['state'] == 'running':
+          queue.fail(job_id, 'Worker {:s} disconnected'.format(worker))
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class Coordinator(object):
+  def __init__(self, path=None, host=None, port=None, token=None, timeout=None):
+    self.path = path
+    self.token = token if token is not None else coordinator_token
+    self.timeout = timeout or worker_timeout
+    self.log = getLogger()
+    self.progress = {}
+    self.server = _Server((host or coordinator_host, coordinator_port if port is None else port), _Handler)
+    self.server.coordinator = self
+    self.address = self.server.server_address
+
+  def run(self):
+    JobQueue(self.path).requeue_running('tcp:')
+    self.log.info('Coordinator listening on {:s}:{:d}'.format(*self.address))
+    if self.token is None and not self.address[0].startswith('127.'):
+      self.log.warning('Coordinator is reachable from the network without a token')
+    try:
+      self.server.serve_forever()
+    finally:
+      self.server.server_close()
+
+  def status(self):
+    return dict(self.progress)
+
+  def shutdown(self):
+    self.server.shutdown()
+
+def _run_job(kind, args, conn):
+  os.setpgrp()
+  def progress(p):
+    conn.send({'fraction': p.fraction, 'fps': p.fps, 'speed': p.speed, 'eta': p.eta})
+  try:
+    resolve(kind)(progress=progress, **args)
+  except Exception:
+    conn.send({'error': format_exc()})
+  else:
+    conn.send({'done': True})
+  conn.close()
+
+class Worker(object):
+  def __init__(self, host, port=None, name=None, mapping=None, token=None):
+    self.host = host
+    self.port = port or coordinator_port
+    self.name = name or '{:s}:{:d}'.format(socket.gethostname(), os.getpid())
+    self.mapping = mapping if mapping is not None else path_map
+    self.token = token if token is not None else coordinator_token
+    self.log = getLogger()
+
+  def _abort(self, p):
+    if p.is_alive():
+      try:
+        os.killpg(p.pid, signal.SIGTERM)
+      except OSError:
+        p.terminate()
+    p.join()
+
+  def _execute(self, f, job):
+    reader, writer = multiprocessing.Pipe(False)
+    p = multiprocessing.Process(target=_run_job, args=(job['kind'], map_paths(job['args'], self.mapping), writer))
+    p.start()
+    writer.close()
+    result = None
+    sent = 0
+    beat = time()
+    try:
+      while True:
+        try:
+          message = reader.recv() if reader.poll(1) else None
+        except EOFError:
+          break
+        if message is None:
+          if not p.is_alive():
+            break
+        elif 'fraction' in message:
+          if time() - sent >= worker_progress_interval:
+            message.update({'op': 'progress', 'id': job['id']})
+            _send(f, message)
+            sent = time()
+        else:
+          result = message
+        if time() - beat >= worker_heartbeat:
+          _send(f, {'op': 'heartbeat'})
+          if _recv(f) is None:
+            raise socket.error('Coordinator closed the connection')
+          beat = time()
+    except (Exception, KeyboardInterrupt):
+      self.log.warning('Aborting job {:d}'.format(job['id']))
+      self._abort(p)
+      raise
+    p.join()
+    if result is not None and result.get('done'):
+      _send(f, {'op': 'done', 'id': job['id']})
+    else:
+      error = result['error'] if result is not None else 'Worker process exited with code {}'.format(p.exitcode)
+      _send(f, {'op': 'failed', 'id': job['id'], 'error': error})
+    _recv(f)
+
+  def _session(self):
+    s, f = _connect(self.host, self.port, self.token, self.name)
+    try:
+      self.log.info('Connected to coordinator {:s}:{:d}'.format(self.host, self.port))
+      while True:
+        _send(f, {'op': 'claim'})
+        message = _recv(f)
+        if message is None:
+          raise socket.error('Coordinator closed the connection')
+        if message['op'] == 'idle':
+          sleep(message['wait'])
+        elif message['op'] == 'job':
+          self.log.info('Starting {:s} job {:d}'.format(message['kind'], message['id']))
+          self._execute(f, message)
+    finally:
+      f.close()
+      s.close()
+
+  def run(self):
+    while True:
+      expire_checkpoints(log=self.log)
+      try:
+        self._session()
+      except (socket.error, IOError) as e:
+        self.log.warning('Coordinator connection failed: {}, retrying in {:d} seconds'.format(e, worker_reconnect))
+        sleep(worker_reconnect)
+
+if __name__ == '__main__':
+  setup_logging(os.path.join(config['log_path'], 'coordinator'))
+  Coordinator().run()
@@ -3,52 +3,114 @@ from __future__ import unicode_literals
 import math
 import sys
 if sys.version > '3':
-  from urllib.request import urlretrieve
   from plistlib import dumps as dumps
 else:
-  from urllib import urlretrieve
   from plistlib import writePlistToString as dumps
 import os
 import re
-import tmdbsimple as tmdb
-from tvdb_api import Tvdb, tvdb_error
-from subprocess import call, Popen, PIPE
+import struct
+from runner import Runner, watch_progress
 import json
 from logging import getLogger, LoggerAdapter
 from config import config
 from datetime import datetime
-from requests.exceptions import Timeout
 from qtfaststart import processor as qt
-from copy import copy
+from copy import copy, deepcopy
+from collections import OrderedDict
 from scipy import spatial
+from cache import DiskCache, fingerprint
+from cropengine import detect_crop, sample_positions
+from loudness import measure as measure_loudness
+from artwork import fetch as fetch_artwork
+import mp4
+from rarstream import RarStream, is_url, from_url
+from segments import SegmentedEncode, segment_seconds
+from metadata import tmdb_movie, tmdb_credits, tmdb_releases, tmdb_poster_url, tvdb_show, tvdb_episode
 
-tvdb_api_key = config['tvdb']
-tmdb.API_KEY = config['tmdb']
+cropdetect_params = '24:2:0'
+analysis_samples = config.get('analysis_samples', 24)
+analysis_window_frames = config.get('analysis_window_frames', 48)
+analysis_fused = config.get('analysis_fused', True)
+crop_engine = config.get('crop_engine', 'cropdetect')
+loudness_engine = config.get('loudness_engine', 'ebur128')
+loudness_rate = config.get('loudness_rate', 24000)
+native_tagging = config.get('native_tagging', True)
+mp4_padding = config.get('mp4_padding', 4 * 1024 * 1024)
+reserve_moov = config.get('reserve_moov', True)
+segmented_encode = config.get('segmented_encode', False)
+stereo_downmix = 'aformat=channel_layouts=stereo'
+analysis_cache = DiskCache('analysis', max_bytes=config.get('analysis_cache_size', 16 * 1024 * 1024))
+ffprobe_cache = DiskCache('ffprobe', max_bytes=config.get('ffprobe_cache_size', 64 * 1024 * 1024))
+ffprobe_memory = OrderedDict()
+ffprobe_memory_size = 256
+
+rcrop = re.compile(r'crop=(?P<width>\d+):(?P<height>\d+):(?P<x>\d+):(?P<y>\d+)(?!\d)', re.I)
+rdeint = re.compile(r'Multi\sframe\sdetection:\sTFF:\s*(?P<tff>\d+)\sBFF:\s*(?P<bff>\d+)\sProgressive:\s*(?P<pro>\d+)\sUndetermined:\s*(?P<und>\d+)', re.I)
+
+def _on_ebur128_summary(runner, callback):
+  # The summary spans several lines: remember which filter printed it until its integrated loudness shows up
+  state = {'filter': None}
+  def summary(m):
+    state['filter'] = (int(m.group('n')), int(m.group('position'), 16))
+  def integrated(m):
+    if state['filter'] is not None:
+      callback(state['filter'][0], state['filter'][1], float(m.group('loudness')))
+      state['filter'] = None
+  runner.on(r'\[Parsed_ebur128_(?P<n>\d+)\s@\s0x(?P<position>[\da-f]{1,16})\]\sSummary:', summary)
+  runner.on(r'^\s*I:\s+(?P<loudness>-?\d+\.\d)\sLUFS', integrated)
+  return runner
+
+def _ffprobe_key(filepath):
+  if is_url(filepath):
+    stream = from_url(filepath)
+    return [filepath, stream.size, stream.mtime]
+  st = os.stat(filepath)
+  return [os.path.abspath(filepath), st.st_size, st.st_mtime]
+
+def _remember_ffprobe(key, info):
+  ffprobe_memory[json.dumps(key)] = deepcopy(info)
+  while len(ffprobe_memory) > ffprobe_memory_size:
+    ffprobe_memory.popitem(last=False)
+
+def seed_ffprobe(filepath, info):
+  _remember_ffprobe(_ffprobe_key(filepath), info)
 
 def get_ffprobe(filepath):
-  cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', filepath]
-  proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-  out, err = proc.communicate()
-  if err:
-    raise Exception(err.decode())
-  return _all_keys_to_lowercase(json.loads(out))
+  key = _ffprobe_key(filepath)
+  mkey = json.dumps(key)
+  if mkey in ffprobe_memory:
+    info = ffprobe_memory.pop(mkey)
+    ffprobe_memory[mkey] = info
+    return deepcopy(info)
+  info = ffprobe_cache.get(key)
+  if info is None:
+    cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', filepath]
+    r = Runner(cmd, stdout='capture')
+    r.run()
+    if r.tail:
+      raise Exception(r.tail)
+    info = _all_keys_to_lowercase(json.loads(r.output.decode('utf-8')))
+    ffprobe_cache.set(key, info)
+  _remember_ffprobe(key, info)
+  return deepcopy(info)
 
 def get_file_version(filepath):
   if os.path.isfile(filepath):
-    cmd = ['AtomicParsley', filepath, '-t']
-    version_matcher = re.compile('Atom\suuid=0c5c9153-0bd4-5e72-be75-92dfec8ab00c\s\(AP\suuid\sfor\s\"©inf\"\)\scontains:\sFFVer(?P<version>\d+\.\d+\.\d+)', re.I)
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    out, _ = p.communicate()
-    found = version_matcher.search(out.decode('utf-8'))
-    if found:
-      parts = found.groupdict()['version'].split('.')
-      return {
-        'video': int(parts[0]),
-        'audio': int(parts[1]),
-        'tags' : int(parts[2])
-      }
+    try:
+      return mp4.read_version(filepath)
+    except (mp4.Mp4Error, struct.error) as e:
+      getLogger().warning('Unable to read version from {:s}: {}'.format(filepath, e))
   return None
 
+def _wilson(k, n, z=2.576):
+  if n == 0:
+    return 0.0, 1.0
+  p = float(k) / n
+  d = 1 + z * z / n
+  centre = (p + z * z / (2 * n)) / d
+  spread = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / d
+  return centre - spread, centre + spread
+
 def _plist_to_string(root_object):
   return dumps(root_object).decode('utf-8')
 
@@ -170,14 +232,32 @@ def _fix_crop(original, max_height, crop=None):
 
   return result
 
+def resolution_label(width, height):
+  return '1080p' if height > 720 or width > 1280 else ('720p' if height > 480 or width > 854 else '480p')
+
+def _frame_rate(stream):
+  for key in ['avg_frame_rate', 'r_frame_rate']:
+    num, _, den = stream.get(key, '0/0').partition('/')
+    if num.isdigit() and den.isdigit() and int(den) > 0 and int(num) > 0:
+      return float(num) / float(den)
+  return 60.0
+
+class MoovTooSmall(IOError):
+  pass
+
 class FfMpeg(object):
   version = {
     'video': 0,
     'audio': 1,
     'tags' : 1
   }
+  analysis_version = 2
   def __init__(self, filepath, cleaner=None, ident=None):
-    if os.path.exists(filepath) and os.path.isfile(filepath):
+    self._names = {}
+    if isinstance(filepath, RarStream):
+      self._names[filepath.url] = filepath.name
+      self.in_file = filepath.url
+    elif os.path.exists(filepath) and os.path.isfile(filepath):
       self.in_file = filepath
     self.log = getLogger()
     if ident:
@@ -200,6 +280,7 @@ class FfMpeg(object):
     self.audio_streams = []
     self.subtitle_streams = []
     self.subtitle_files_to_add = []
+    self._analysis = {}
     self._refresh(self.in_file)
     self.needs_aac_to_ac3_conversion = False
 
@@ -209,22 +290,38 @@ class FfMpeg(object):
   def __exit__(self, exc_type, exc_val, exc_tb):
     return False
 
-  def _refresh(self, path):
+  def _refresh(self, path, info=None):
     if not path is None:
-      if os.path.exists(path) and os.path.isfile(path):
-        root, ext = os.path.splitext(os.path.basename(path))
+      if path in self._names or (os.path.exists(path) and os.path.isfile(path)):
+        root, ext = os.path.splitext(os.path.basename(self._names.get(path, path)))
         if ext.lower() in ['.mkv', '.mp4', '.avi']:
           self.current_file = path
           self.current_file_ext = ext.lstrip('.')
           self.current_file_basename = root
           self.log.debug('Setting current file to \'{:s}\''.format(self.current_file))
-          self.current_file_info = get_ffprobe(self.current_file)
+          if info is None:
+            self.current_file_info = get_ffprobe(self.current_file)
+          else:
+            seed_ffprobe(self.current_file, info)
+            self.current_file_info = deepcopy(info)
           self.video_streams = sorted([s for s in self.current_file_info['streams'] if s['codec_type'] == 'video' and s['codec_name'] != 'mjpeg'], key=lambda st: st['index'])
           self.audio_streams = sorted([s for s in self.current_file_info['streams'] if s['codec_type'] == 'audio'], key=lambda st: st['index'])
           self.subtitle_streams = sorted([s for s in self.current_file_info['streams'] if s['codec_type'] == 'subtitle'], key=lambda st: st['index'])
           self.log.debug('Has video: {:d}, audio: {:d}, subtitle: {:d}'.format(len(self.video_streams), len(self.audio_streams), len(self.subtitle_streams)))
 
-  def _analyze_audio(self, keep_others):
+  def resume(self, path):
+    self.cleaner.add_path(path)
+    self._refresh(path)
+    return self
+
+  def _carried_info(self, path):
+    info = deepcopy(self.current_file_info)
+    info['format']['filename'] = path
+    info['format']['size'] = str(os.path.getsize(path))
+    info['streams'] = [dict((k, v) for k, v in s.items() if not k.startswith('_')) for s in info['streams']]
+    return info
+
+  def _select_audio_streams(self, keep_others):
     # TODO: Always request_channels 2 when codec_name is ac3 or dca!
     if len(self.audio_streams) < 1:
       raise Exception('No audio streams detected!')
@@ -242,8 +339,7 @@ class FfMpeg(object):
       self.needs_aac_to_ac3_conversion = True
     default['_default'] = True
     default['_measure'] = True
-    default['_copy'] = False if (default['codec_name'] in ['aac', 'libfdk_aac'] and default['channels'] > 2) \
-                                or (default['codec_name'] not in ['dca', 'ac3', 'libfdk_aac', 'aac']) else True
+    default['_copy'] = False if default['codec_name'] not in ['dca', 'ac3', 'libfdk_aac', 'aac'] else True
     default['_convert'] = False if default['codec_name'] in ['aac', 'libfdk_aac'] and default['channels'] <= 2 else True
     self.default_audio_stream = default
     for stream in self.audio_streams:
@@ -262,19 +358,51 @@ class FfMpeg(object):
       if stream['tags']['language'] == 'und':
         stream['tags']['language'] = 'eng'
     self.audio_streams = sorted(self.audio_streams, key=lambda st: (-st['_default'], st['index']))
-    if any([s['_measure'] for s in self.audio_streams]):
-      self._measure_loudness()
 
-  def _analyze_crop_scale_deint(self, crop, max_height, deint, force_field_order):
+  def _analyze_audio(self, keep_others):
+    self._select_audio_streams(keep_others)
+    measured = [s for s in self.audio_streams if s['_measure'] == True]
+    if len(measured) > 0:
+      cached = self._analysis.get('loudness', {})
+      if all([str(s['index']) in cached for s in measured]):
+        self.log.debug('Using cached loudness analysis')
+        for stream in measured:
+          if cached[str(stream['index'])] is None:
+            self.log.warning('Stream {:d} too short to measure loudness'.format(stream['index']))
+            continue
+          stream['_loudness'] = cached[str(stream['index'])]
+          self.log.info('Stream {:d} had loudness {:.1f}dB'.format(stream['index'], stream['_loudness']))
+      else:
+        self._measure_loudness()
+        self._analysis['loudness'] = {str(s['index']): s.get('_loudness') for s in measured}
+      self._apply_gain()
+
+  def _numpy_crop(self, samples=None):
+    vs = self.default_video_stream
+    return detect_crop(self.current_file, vs['index'], vs['width'], vs['height'], float(self.current_file_info['format']['duration']),
+                       samples=samples or analysis_samples, limit=int(cropdetect_params.split(':')[0]), log=self.log)
+
+  def _detect_crop_deint(self, crop, deint, force_field_order, samples=None):
+    if crop and crop_engine == 'numpy':
+      detected = self._detect_crop_deint(False, deint, force_field_order, samples=samples)
+      detected['cropdetect'] = self._numpy_crop(samples)
+      return detected
+    if samples and (crop or (deint and force_field_order is None)):
+      cropmatches, deint_data = self._sample_crop_deint(crop, deint and force_field_order is None, samples)
+      detected = {'cropdetect': None, 'fieldorder': None}
+      if crop:
+        detected['cropdetect'] = self._widest_crop(cropmatches)
+      if deint and force_field_order is None:
+        detected['fieldorder'] = self._decide_fieldorder(deint_data)
+      return detected
     cropmatches = []
     deintmatches = []
     filters = []
-    rcrop = re.compile(r'crop=(?P<width>\d+):(?P<height>\d+):(?P<x>\d+):(?P<y>\d+)\D', re.I)
-    rdeint = re.compile(r'Multi\sframe\sdetection:\sTFF:\s*(?P<tff>\d+)\sBFF:\s*(?P<bff>\d+)\sProgressive:\s*(?P<pro>\d+)\sUndetermined:\s*(?P<und>\d+)', re.I)
+    detected = {'cropdetect': None, 'fieldorder': None}
     if deint and force_field_order is None:
       filters.append('idet')
     if crop:
-      filters.append('cropdetect=24:2:0')
+      filters.append('cropdetect={:s}'.format(cropdetect_params))
     if crop or (deint and force_field_order is None):
       n = int(math.floor(float(self.current_file_info['format']['duration']) / 240))
       if n > 1 and not deint:
@@ -291,14 +419,10 @@ class FfMpeg(object):
                  '-f', 'null',
                  '-']
           self.log.debug(_command_to_string(cmd))
-          p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-          _, err = p.communicate()
+          r = Runner(cmd, log=self.log)
           if crop:
-            found = [m.groupdict() for m in rcrop.finditer(err.decode('latin-1'))]
-            cropmatches.extend(found)
-          if deint:
-            found = [m.groupdict() for m in rdeint.finditer(err.decode('latin-1'))]
-            deintmatches.extend(found)
+            r.on(rcrop, lambda m: cropmatches.append(m.groupdict()))
+          r.run()
       else:
         cmd = ['ffmpeg',
                '-hide_banner',
@@ -310,38 +434,189 @@ class FfMpeg(object):
                '-f', 'null',
                '-']
         self.log.debug(_command_to_string(cmd))
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        _, err = p.communicate()
+        r = Runner(cmd, log=self.log)
         if crop:
-          found = [m.groupdict() for m in rcrop.finditer(err.decode('latin-1'))]
-          cropmatches.extend(found)
+          r.on(rcrop, lambda m: cropmatches.append(m.groupdict()))
         if deint:
-          found = [m.groupdict() for m in rdeint.finditer(err.decode('latin-1'))]
-          deintmatches.extend(found)
+          r.on(rdeint, lambda m: deintmatches.append(m.groupdict()))
+        r.run()
     if crop:
-      match = {k: int(v) for k,v in max(cropmatches, key=lambda ma:(int(ma['width']), int(ma['height']))).items()}
-      results = _new_fix_crop(self.default_video_stream, max_height=max_height, crop=match)
+      detected['cropdetect'] = self._widest_crop(cropmatches)
+    if deint and force_field_order is None:
+      deint_data = {
+        'TFF': sum([int(m['tff']) for m in deintmatches]),
+        'BFF': sum([int(m['bff']) for m in deintmatches]),
+        'Progressive': sum([int(m['pro']) for m in deintmatches]),
+        'Undetermined': sum([int(m['und']) for m in deintmatches])
+      }
+      detected['fieldorder'] = self._decide_fieldorder(deint_data)
+    return detected
+
+  def _widest_crop(self, cropmatches):
+    if len(cropmatches) == 0:
+      self.log.warning('cropdetect reported nothing, not cropping')
+      return None
+    return {k: int(v) for k,v in max(cropmatches, key=lambda ma:(int(ma['width']), int(ma['height']))).items()}
+
+  def _decide_fieldorder(self, deint_data):
+    totalframes = float(sum(deint_data.values()))
+    detectedframes = float(sum([v for k,v in deint_data.items() if k != 'Undetermined']))
+    self.log.debug('TFF: {TFF:d} BFF: {BFF:d} Progressive: {Progressive:d} Undetermined: {Undetermined:d}'.format(**deint_data))
+    self.log.debug('totalframes: {:f} detectedframes: {:f}'.format(totalframes, detectedframes))
+    if detectedframes == 0:
+      return 'Undetermined'
+    deint_data = {k: [float(v) / totalframes, float(v)/detectedframes] for k, v in deint_data.items()}
+    fieldorder, pct = max(deint_data.items(), key=lambda x:x[1][0])
+    if fieldorder in ['TFF', 'BFF', 'Progressive'] and pct[0] >= 0.75 and pct[1] >= 0.95:
+      return fieldorder
+    return 'Undetermined'
+
+  def _fieldorder_settled(self, deint_data):
+    totalframes = sum(deint_data.values())
+    if totalframes < 200:
+      return False
+    detectedframes = sum([v for k,v in deint_data.items() if k != 'Undetermined'])
+    leader = max(['TFF', 'BFF', 'Progressive'], key=lambda k: deint_data[k])
+    total_lo, total_hi = _wilson(deint_data[leader], totalframes)
+    detected_lo, detected_hi = _wilson(deint_data[leader], detectedframes)
+    if total_lo >= 0.75 and detected_lo >= 0.95:
+      return True
+    if total_hi < 0.75 or detected_hi < 0.95:
+      return True
+    return False
+
+  def _sample_windows(self, samples, first_input=0):
+    vs = self.default_video_stream
+    duration = float(self.current_file_info['format']['duration'])
+    rate = vs.get('avg_frame_rate', vs.get('r_frame_rate', '24/1')).split('/')
+    fps = float(rate[0]) / float(rate[1]) if len(rate) == 2 and float(rate[1]) != 0 and float(rate[0]) != 0 else 24.0
+    window = (analysis_window_frames / fps) + 2.0
+    inputs = []
+    graph = []
+    for i, position in enumerate(sample_positions(duration, samples)):
+      start = max(0.0, position - window / 2.0)
+      inputs.extend(['-noaccurate_seek', '-ss', '{:.3f}'.format(start), '-t', '{:.3f}'.format(window), '-i', self.current_file])
+      graph.append('[{:d}:{:d}]trim=end_frame={:d}[w{:d}]'.format(first_input + i, vs['index'], analysis_window_frames, i))
+    concat = '{:s}concat=n={:d}:v=1:a=0'.format(''.join(['[w{:d}]'.format(i) for i in range(len(graph))]), len(graph))
+    return inputs, graph, concat
+
+  def _sample_crop_deint(self, crop, deint, samples):
+    cmd = ['ffmpeg', '-hide_banner', '-nostats']
+    inputs, graph, concat = self._sample_windows(samples)
+    cmd.extend(inputs)
+    filters = []
+    if deint:
+      filters.extend(['idet', 'metadata=mode=print:key=lavfi.idet.multiple.current_frame'])
+    if crop:
+      filters.append('cropdetect={:s}'.format(cropdetect_params))
+    graph.append('{:s},{:s}[out]'.format(concat, ','.join(filters)))
+    cmd.extend(['-filter_complex', ';'.join(graph), '-map', '[out]', '-an', '-sn', '-f', 'null', '-'])
+    self.log.debug(_command_to_string(cmd))
+    rframe = re.compile(r'lavfi\.idet\.multiple\.current_frame=(?P<type>tff|bff|progressive|undetermined)', re.I)
+    types = {'tff': 'TFF', 'bff': 'BFF', 'progressive': 'Progressive', 'undetermined': 'Undetermined'}
+    cropmatches = []
+    deint_data = {'TFF': 0, 'BFF': 0, 'Progressive': 0, 'Undetermined': 0}
+    min_frames = analysis_window_frames * (samples // 2 if crop else 1)
+    r = Runner(cmd, log=self.log)
+    def on_frame(found):
+      if r.terminated:
+        return
+      deint_data[types[found.group('type').lower()]] += 1
+      frames = sum(deint_data.values())
+      if frames >= min_frames and frames % 24 == 0 and self._fieldorder_settled(deint_data):
+        self.log.debug('Field order settled after {:d} frames, stopping early'.format(frames))
+        r.terminate()
+    if crop:
+      r.on(rcrop, lambda m: cropmatches.append(m.groupdict()))
+    if deint:
+      r.on(rframe, on_frame)
+    if r.run() != 0 and not r.terminated:
+      raise IOError('Sampled analysis failed with exit code {:d}\n\n{:s}'.format(r.returncode, r.tail))
+    return cropmatches, deint_data
+
+  def _fused_analysis(self, crop, deint, samples=None):
+    # With samples, video is analysed on the sampled windows while ebur128 still decodes the whole audio track
+    vs = self.default_video_stream
+    measured = [s for s in self.audio_streams if s['_measure'] == True] if loudness_engine == 'ebur128' else []
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-request_channels', '2', '-i', self.current_file]
+    graph = []
+    filter_count = 0
+    video_filters = []
+    if deint:
+      video_filters.append('idet')
+    if crop:
+      video_filters.append('cropdetect={:s}'.format(cropdetect_params))
+    if len(video_filters) > 0:
+      if samples:
+        inputs, windows, concat = self._sample_windows(samples, first_input=1)
+        cmd.extend(inputs)
+        graph.extend(windows)
+        graph.append('{:s},{:s}[vout]'.format(concat, ','.join(video_filters)))
+        filter_count += len(windows) + 1
+      else:
+        graph.append('[0:{:d}]{:s}[vout]'.format(vs['index'], ','.join(video_filters)))
+      filter_count += len(video_filters)
+    ebur128_streams = {}
+    for n, stream in enumerate(measured):
+      audio_filters = []
+      if stream['channels'] > 2:
+        audio_filters.append('aformat=channel_layouts=stereo')
+      audio_filters.append('ebur128=framelog=verbose')
+      ebur128_streams[filter_count + len(audio_filters) - 1] = stream
+      filter_count += len(audio_filters)
+      graph.append('[0:{:d}]{:s}[a{:d}]'.format(stream['index'], ','.join(audio_filters), n))
+    if len(graph) == 0:
+      self._analysis['video'] = {'cropdetect': None, 'fieldorder': None}
+      return
+    cmd.extend(['-filter_complex', ';'.join(graph)])
+    if len(video_filters) > 0:
+      cmd.extend(['-map', '[vout]'])
+    for n in range(len(measured)):
+      cmd.extend(['-map', '[a{:d}]'.format(n)])
+    cmd.extend(['-sn', '-f', 'null', '-'])
+    self.log.debug(_command_to_string(cmd))
+    cropmatches = []
+    deintmatches = []
+    loudness = {}
+    def on_summary(n, position, value):
+      loudness[str(ebur128_streams[n]['index'])] = value
+    r = Runner(cmd, log=self.log)
+    r.on(rcrop, lambda m: cropmatches.append(m.groupdict()))
+    r.on(rdeint, lambda m: deintmatches.append(m.groupdict()))
+    _on_ebur128_summary(r, on_summary)
+    if r.run() != 0:
+      r.write_faillog()
+      raise IOError('Analysis failed with exit code {:d}'.format(r.returncode))
+    detected = {'cropdetect': None, 'fieldorder': None}
+    if crop:
+      detected['cropdetect'] = self._widest_crop(cropmatches)
+    if deint:
+      detected['fieldorder'] = self._decide_fieldorder({
+        'TFF': sum([int(m['tff']) for m in deintmatches]),
+        'BFF': sum([int(m['bff']) for m in deintmatches]),
+        'Progressive': sum([int(m['pro']) for m in deintmatches]),
+        'Undetermined': sum([int(m['und']) for m in deintmatches])
+      })
+    self._analysis['video'] = detected
+    if len(measured) > 0:
+      self._analysis['loudness'] = {str(s['index']): loudness.get(str(s['index'])) for s in measured}
+
+  def _analyze_crop_scale_deint(self, crop, max_height, deint, force_field_order, samples=None):
+    if 'video' in self._analysis:
+      self.log.debug('Using cached crop and field order analysis')
+      detected = self._analysis['video']
+    else:
+      detected = self._detect_crop_deint(crop, deint, force_field_order, samples=samples)
+      self._analysis['video'] = detected
+    if detected['cropdetect'] is not None:
+      self.default_video_stream['_cropdetect'] = copy(detected['cropdetect'])
+      results = _new_fix_crop(self.default_video_stream, max_height=max_height, crop=copy(detected['cropdetect']))
     else:
       results = _new_fix_crop(self.default_video_stream, max_height=max_height)
 
     if deint:
       if force_field_order is None:
-        deint_data = {
-          'TFF': sum([int(m['tff']) for m in deintmatches]),
-          'BFF': sum([int(m['bff']) for m in deintmatches]),
-          'Progressive': sum([int(m['pro']) for m in deintmatches]),
-          'Undetermined': sum([int(m['und']) for m in deintmatches])
-        }
-        totalframes = float(sum(deint_data.values()))
-        detectedframes = float(sum([v for k,v in deint_data.items() if k != 'Undetermined']))
-        self.log.debug('TFF: {TFF:d} BFF: {BFF:d} Progressive: {Progressive:d} Undetermined: {Undetermined:d}'.format(**deint_data))
-        self.log.debug('totalframes: {:f} detectedframes: {:f}'.format(totalframes, detectedframes))
-        deint_data = {k: [float(v) / totalframes, float(v)/detectedframes] for k, v in deint_data.items()}
-        fieldorder, pct = max(deint_data.items(), key=lambda x:x[1][0])
-        if fieldorder in ['TFF', 'BFF', 'Progressive'] and pct[0] >= 0.75 and pct[1] >= 0.95:
-          self.default_video_stream['_fieldorder'] = fieldorder
-        else:
-          self.default_video_stream['_fieldorder'] = 'Undetermined'
+        self.default_video_stream['_fieldorder'] = detected['fieldorder']
         self.log.info('Field order is: {:s}'.format(self.default_video_stream['_fieldorder']))
       else:
         self.default_video_stream['_fieldorder'] = force_field_order
@@ -357,7 +632,7 @@ class FfMpeg(object):
       self.log.info('Will scale to {width:d}:{height:d}'.format(**(results['scale'])))
       self.default_video_stream['_scale'] = results['scale']
 
-  def _analyze_video(self, allow_crop, max_height, deint, force_field_order):
+  def _select_video_stream(self):
     if len(self.video_streams) < 1:
       raise Exception('No video streams detected!')
     elif len(self.video_streams) > 1:
@@ -371,59 +646,66 @@ class FfMpeg(object):
         self.default_video_stream = self.video_streams[0]
     else:
       self.default_video_stream = self.video_streams[0]
+
+  def _analyze_video(self, allow_crop, max_height, deint, force_field_order, samples=None):
+    self._select_video_stream()
     if allow_crop or deint or max_height is not None:
-      self._analyze_crop_scale_deint(crop=allow_crop, max_height=max_height, deint=deint, force_field_order=force_field_order)
+      self._analyze_crop_scale_deint(crop=allow_crop, max_height=max_height, deint=deint, force_field_order=force_field_order, samples=samples)
     vs = self.default_video_stream
     if vs['codec_name'] != 'h264' or '_pad' in vs or '_crop' in vs or '_scale' in vs or (deint and vs['_fieldorder'] in ['TFF', 'BFF']):
       vs['_convert'] = True
     else:
       vs['_convert'] = False
 
-  def analyze(self, allow_crop=True, max_height=None, keep_other_audio=False, deint=False, force_field_order=None):
+  def analyze(self, allow_crop=True, max_height=None, keep_other_audio=False, deint=False, force_field_order=None, samples=analysis_samples, fused=analysis_fused):
     self._max_height = max_height
-    self._analyze_video(allow_crop=allow_crop, max_height=max_height, deint=deint, force_field_order=force_field_order)
+    key = [fingerprint(self.current_file), FfMpeg.analysis_version, cropdetect_params, crop_engine, loudness_engine,
+           {'crop': allow_crop, 'deint': deint, 'force_field_order': force_field_order, 'keep_other_audio': keep_other_audio,
+            'samples': samples, 'window_frames': analysis_window_frames if samples else None}]
+    self._analysis = analysis_cache.get(key) or {}
+    if fused and 'video' not in self._analysis and (allow_crop or (deint and force_field_order is None)):
+      duration = float(self.current_file_info['format']['duration'])
+      if samples or (deint and force_field_order is None) or int(math.floor(duration / 240)) <= 1:
+        self._select_video_stream()
+        self._select_audio_streams(keep_others=keep_other_audio)
+        with_deint = deint and force_field_order is None
+        self.log.debug('Running fused {:s}{:s}ebur128 analysis{:s}'.format('cropdetect+' if allow_crop else '', 'idet+' if with_deint else '', ' on {:d} samples'.format(samples) if samples else ''))
+        self._fused_analysis(allow_crop and crop_engine != 'numpy', with_deint, samples=samples)
+        if allow_crop and crop_engine == 'numpy':
+          self._analysis['video']['cropdetect'] = self._numpy_crop(samples)
+    self._analyze_video(allow_crop=allow_crop, max_height=max_height, deint=deint, force_field_order=force_field_order, samples=samples)
     self._analyze_audio(keep_others=keep_other_audio)
+    analysis_cache.set(key, self._analysis)
 
-  def _build_aac_to_ac3_pipeline(self):
-    aac_multi_streams = 0
-    cmd = ['ffmpeg', '-hide_banner', '-v', 'quiet', '-i', self.current_file]
-    maps = []
-    converts = []
-    audio_index = 0
-    for stream in [stream for stream in self.audio_streams if stream['_measure'] == True]:
-      if stream['codec_name'] in ['aac', 'libfdk_aac'] and stream['channels'] > 2:
-        aac_multi_streams += 1
-        maps.extend(['-map', '0:{:d}'.format(stream['index'])])
-        converts.extend(['-c:a:{:d}'.format(audio_index), 'ac3'])
-    if len(maps) > 0:
-      converts.extend(['-vn', '-sn'])
-      cmd.extend(maps)
-      cmd.extend(converts)
-      cmd.extend(['-f', 'ac3', '-'])
-    return cmd
+  def _measure_loudness_numpy(self):
+    measured = [s for s in self.audio_streams if s['_measure'] == True]
+    results = measure_loudness(self.current_file, [s['index'] for s in measured], rate=loudness_rate, log=self.log)
+    for stream in measured:
+      if results[stream['index']] is None:
+        self.log.warning('Stream {:d} too short to measure loudness'.format(stream['index']))
+        continue
+      stream['_loudness'] = round(results[stream['index']], 1)
+      self.log.info('Stream {:d} had loudness {:.1f}dB'.format(stream['index'], stream['_loudness']))
+    return self
 
   def _measure_loudness(self):
+    if loudness_engine == 'numpy':
+      return self._measure_loudness_numpy()
     cmd = ['ffmpeg', '-hide_banner', '-stats']
     inputs = []
     maps = []
     filters = []
     input_count = 0
-    input_indices = {'main': None, 'aac_to_ac3': None, 'request_channels': None}
-    aac_to_ac3_audio_index = 0
+    input_indices = {'main': None, 'request_channels': None}
     audio_index = 0
     for stream in [stream for stream in self.audio_streams if stream['_measure'] == True]:
       if stream['codec_name'] in ['aac', 'libfdk_aac'] and stream['channels'] > 2:
-        if input_indices['aac_to_ac3'] is None:
-          pre = self._build_aac_to_ac3_pipeline()
-          pre.append('|')
-          pre.extend(cmd)
-          cmd = pre
-          inputs.extend(['-f', 'ac3', '-request_channels', '2', '-i', '-'])
-          input_indices['aac_to_ac3'] = input_count
+        if input_indices['main'] is None:
+          inputs.extend(['-i', self.current_file])
+          input_indices['main'] = input_count
           input_count += 1
-        maps.extend(['-map', '{:d}:{:d}'.format(input_indices['aac_to_ac3'], aac_to_ac3_audio_index)])
-        filters.extend(['-filter:a:{:d}'.format(audio_index), 'ebur128'])
-        aac_to_ac3_audio_index += 1
+        maps.extend(['-map', '{:d}:{:d}'.format(input_indices['main'], stream['index'])])
+        filters.extend(['-filter:a:{:d}'.format(audio_index), '{:s},ebur128'.format(stereo_downmix)])
         audio_index += 1
       elif stream['channels'] > 2 or stream['codec_name'] in ['ac3', 'dca']:
         if input_indices['request_channels'] is None:
@@ -446,19 +728,10 @@ class FfMpeg(object):
     cmd.extend(filters)
     cmd.extend(['-f', 'null', '-'])
     self.log.debug(_command_to_string(cmd))
-    if '|' in cmd:
-      a = cmd[:cmd.index('|')]
-      b = cmd[cmd.index('|') + 1:]
-      pa = Popen(a, stdout=PIPE, stderr=PIPE)
-      pb = Popen(b, stdin=pa.stdout, stdout=PIPE, stderr=PIPE)
-      _, err = pb.communicate()
-    else:
-      p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-      _, err = p.communicate()
-    output = err.decode('latin-1')
-    summary_finder = re.compile(r'\[Parsed_ebur128_\d\s@\s0x(?P<position>[\da-f]{1,16})\]\sSummary:\s+Integrated\sloudness:\s+I:\s+(?P<loudness>-?\d\d.\d)\sLUFS')
-    matches = [m for m in summary_finder.finditer(output)]
-    matches.sort(key=lambda ma: int(ma.groupdict()['position'], 16))
+    matches = []
+    r = _on_ebur128_summary(Runner(cmd, log=self.log), lambda n, position, value: matches.append((position, value)))
+    r.run()
+    matches.sort(key=lambda ma: ma[0])
 
     # if len(matches) > len([s for s in self.audio_streams if s['_measure'] == True]):
     #   # Input stream #0:1 frame changed from rate:48000 fmt:fltp ch:2 chl:stereo to rate:48000 fmt:fltp ch:6 chl:5.1(side)
@@ -486,8 +759,12 @@ class FfMpeg(object):
         self.log.error('assuming discontinuity; continuing...')
         stream = [s for s in self.audio_streams if s['_measure'] == True][n - 1]
         # raise e
-      stream['_loudness'] = float(matches[n].group('loudness'))
+      stream['_loudness'] = matches[n][1]
       self.log.info('Stream {:d} had loudness {:.1f}dB'.format(stream['index'], stream['_loudness']))
+    return self
+
+  def _apply_gain(self):
+    for stream in [s for s in self.audio_streams if s['_measure'] == True and '_loudness' in s]:
       if abs(-23 - stream['_loudness']) > 1:
         stream['_gain'] = -23 - stream['_loudness']
         self.log.info('Stream {:d} needs {:+.1f}dB of gain'.format(stream['index'], stream['_gain']))
@@ -496,75 +773,52 @@ class FfMpeg(object):
           stream['_copy'] = False
     return self
 
-  def convert_and_normalize(self, add_filters=None):
-    cmd = ['ffmpeg', '-hide_banner', '-stats', '-y']#, '-v', 'quiet']
-    inputs = []
+  def _rendition_filters(self, rendition):
+    f = []
+    if 'pad' in rendition:
+      f.append('pad={width:d}:{height:d}:{x:d}:{y:d}'.format(**(rendition['pad'])))
+    if 'crop' in rendition:
+      f.append('crop={width:d}:{height:d}:{x:d}:{y:d}'.format(**(rendition['crop'])))
+    if 'scale' in rendition:
+      f.append('scale={width:d}:{height:d}'.format(**(rendition['scale'])))
+    return f
+
+  def _video_filters(self, add_filters=None, rendition=None):
+    vs = self.default_video_stream
+    if rendition is None:
+      rendition = {k.lstrip('_'): vs[k] for k in ['_pad', '_crop', '_scale'] if k in vs}
+    f = []
+    if add_filters is not None:
+      f.extend(add_filters)
+    if '_fieldorder' in vs and vs['_fieldorder'] in ['TFF', 'BFF']:
+      f.append('idet')
+      f.append('yadif=0:{:d}:0'.format(0 if vs['_fieldorder'] == 'TFF' else 1))
+    f.extend(self._rendition_filters(rendition))
+    return f
+
+  def _build_audio(self, cmd, inputs, input_indices, input_count):
     maps = []
     filters = []
     converts = []
-    input_count = 0
-    input_indices = {'main': None, 'aac_to_ac3': None, 'request_channels': None, 'aac_request_channels': None}
-    aac_to_ac3_audio_index = 0
     audio_index = 0
-    ### Video
-    if input_indices['main'] is None:
-      inputs.extend(['-i', self.current_file])
-      input_indices['main'] = input_count
-      input_count += 1
-    maps.extend(['-map', '{:d}:{:d}'.format(input_indices['main'], self.default_video_stream['index'])])
-    if self.default_video_stream['_convert']:
-      f = []
-      if add_filters is not None:
-        f.extend(add_filters)
-      if '_fieldorder' in self.default_video_stream and self.default_video_stream['_fieldorder'] in ['TFF', 'BFF']:
-        f.append('idet')
-        f.append('yadif=0:{:d}:0'.format(0 if self.default_video_stream['_fieldorder'] == 'TFF' else 1))
-      if '_pad' in self.default_video_stream:
-        f.append('pad={width:d}:{height:d}:{x:d}:{y:d}'.format(**(self.default_video_stream['_pad'])))
-      if '_crop' in self.default_video_stream:
-        f.append('crop={width:d}:{height:d}:{x:d}:{y:d}'.format(**(self.default_video_stream['_crop'])))
-      if '_scale' in self.default_video_stream:
-        f.append('scale={width:d}:{height:d}'.format(**(self.default_video_stream['_scale'])))
-      if len(f) > 0:
-        filters.extend(['-filter:v:0', ','.join(f)])
-      converts.extend(['-c:v:0', 'libx264', '-preset:v:0', 'fast', '-crf:v:0', '21'])
-    else:
-      converts.extend(['-c:v:0', 'copy'])
-    ### Audio
     for stream in self.audio_streams:
       if stream['codec_name'] in ['aac', 'libfdk_aac'] and stream['channels'] > 2:
+        if (stream['_copy'] or stream['_convert']) and input_indices['main'] is None:
+          inputs.extend(['-i', self.current_file])
+          input_indices['main'] = input_count
+          input_count += 1
         if stream['_copy']:
-          if input_indices['aac_to_ac3'] is None:
-            if input_indices['aac_request_channels'] is None:
-              pre = self._build_aac_to_ac3_pipeline()
-              if len(pre) > 0:
-                pre.append('|')
-                pre.extend(cmd)
-                cmd = pre
-            inputs.extend(['-f', 'ac3', '-i', '-'])
-            input_indices['aac_to_ac3'] = input_count
-            input_count += 1
-          maps.extend(['-map', '{:d}:{:d}'.format(input_indices['aac_to_ac3'], aac_to_ac3_audio_index)])
-          converts.extend(['-c:a:{:d}'.format(audio_index), 'copy', '-metadata:s:a:{:d}'.format(audio_index), 'language={:s}'.format(stream['tags']['language'])])
+          maps.extend(['-map', '{:d}:{:d}'.format(input_indices['main'], stream['index'])])
+          converts.extend(['-c:a:{:d}'.format(audio_index), 'ac3', '-metadata:s:a:{:d}'.format(audio_index), 'language={:s}'.format(stream['tags']['language'])])
           audio_index += 1
         if stream['_convert']:
-          if input_indices['aac_request_channels'] is None:
-            if input_indices['aac_to_ac3'] is None:
-              pre = self._build_aac_to_ac3_pipeline()
-              if len(pre) > 0:
-                pre.append('|')
-                pre.extend(cmd)
-                cmd = pre
-            inputs.extend(['-f', 'ac3', '-request_channels', '2', '-i', '-'])
-            input_indices['aac_request_channels'] = input_count
-            input_count += 1
-          maps.extend(['-map', '{:d}:{:d}'.format(input_indices['aac_request_channels'], aac_to_ac3_audio_index)])
+          maps.extend(['-map', '{:d}:{:d}'.format(input_indices['main'], stream['index'])])
+          f = [stereo_downmix]
           if '_gain' in stream:
-            filters.extend(['-filter:a:{:d}'.format(audio_index), 'volume={:.1f}dB'.format(stream['_gain'])])
+            f.append('volume={:.1f}dB'.format(stream['_gain']))
+          filters.extend(['-filter:a:{:d}'.format(audio_index), ','.join(f)])
           converts.extend(['-c:a:{:d}'.format(audio_index), 'libfdk_aac', '-vbr:a:{:d}'.format(audio_index), '5', '-cutoff:a:{:d}'.format(audio_index), '20000', '-metadata:s:a:{:d}'.format(audio_index), 'language={:s}'.format(stream['tags']['language'])])
           audio_index += 1
-        if stream['_copy'] or stream['_convert']:
-          aac_to_ac3_audio_index += 1
       elif stream['channels'] > 2 or stream['codec_name'] in ['ac3', 'dca']:
         if stream['_copy']:
           if input_indices['main'] is None:
@@ -587,7 +841,7 @@ class FfMpeg(object):
       else:
         if stream['_copy']:
           if input_indices['main'] is None:
-            inputs.append(['-i', self.current_file])
+            inputs.extend(['-i', self.current_file])
             input_indices['main'] = input_count
             input_count += 1
           maps.extend(['-map', '{:d}:{:d}'.format(input_indices['main'], stream['index'])])
@@ -595,7 +849,7 @@ class FfMpeg(object):
           audio_index += 1
         if stream['_convert']:
           if input_indices['main'] is None:
-            inputs.append(['-i', self.current_file])
+            inputs.extend(['-i', self.current_file])
             input_indices['main'] = input_count
             input_count += 1
           maps.extend(['-map', '{:d}:{:d}'.format(input_indices['main'], stream['index'])])
@@ -603,7 +857,110 @@ class FfMpeg(object):
             filters.extend(['-filter:a:{:d}'.format(audio_index), 'volume={:.1f}dB'.format(stream['_gain'])])
           converts.extend(['-c:a:{:d}'.format(audio_index), 'libfdk_aac', '-vbr:a:{:d}'.format(audio_index), '5', '-cutoff:a:{:d}'.format(audio_index), '20000', '-metadata:s:a:{:d}'.format(audio_index), 'language={:s}'.format(stream['tags']['language'])])
           audio_index += 1
-        ### Subtitle
+    return cmd, input_count, maps, filters, converts
+
+  def _run_encode(self, cmd, progress=None):
+    last = len(cmd) - cmd[::-1].index('|') if '|' in cmd else 0
+    cmd = cmd[:last + 1] + ['-progress', 'pipe:1', '-nostats'] + cmd[last + 1:]
+    self.log.debug(_command_to_string(cmd))
+    r = Runner(cmd, log=self.log, stdout='lines')
+    logged = {'decile': 0}
+    def on_progress(p):
+      if p.fraction is not None and p.speed and int(p.fraction * 10) > logged['decile']:
+        logged['decile'] = int(p.fraction * 10)
+        self.log.info('Encoded {:.0%} at {:.1f}fps ({:.2f}x), ETA {:.0f} seconds'.format(p.fraction, p.fps, p.speed, p.eta))
+      if progress is not None:
+        progress(p)
+    watch_progress(r, on_progress, float(self.current_file_info['format']['duration']))
+    too_small = []
+    r.on(r'reserved_moov_size is too small', too_small.append)
+    rc = r.run()
+    if too_small:
+      raise MoovTooSmall('Reserved moov space is too small')
+    if rc != 0:
+      r.write_faillog()
+      raise IOError('Normalization failed with exit code {:d}'.format(rc))
+
+  def _moov_size(self, audio_outputs):
+    duration = float(self.current_file_info['format']['duration'])
+    video_samples = duration * _frame_rate(self.default_video_stream)
+    audio_samples = duration * 48000 / 1024.0 * audio_outputs
+    return int((65536 + video_samples * 20 + audio_samples * 12) * 1.1) + mp4_padding
+
+  def _encode_faststart(self, cmd, outputs, audio_outputs, progress=None):
+    if reserve_moov:
+      reserve = ['-moov_size', '{:d}'.format(self._moov_size(audio_outputs))]
+      try:
+        self._run_encode(cmd + [a for o in outputs for a in o[:-1] + reserve + o[-1:]], progress=progress)
+        return
+      except MoovTooSmall:
+        self.log.warning('Reserved moov space was too small, encoding again with +faststart')
+    self._run_encode(cmd + [a for o in outputs for a in o[:-1] + ['-movflags', '+faststart'] + o[-1:]], progress=progress)
+
+  def _convert_segmented(self, add_filters=None, progress=None):
+    vs = self.default_video_stream
+    duration = float(self.current_file_info['format']['duration'])
+    start_time = float(self.current_file_info['format'].get('start_time', 0))
+    video = SegmentedEncode(self.current_file, vs['index'], duration, ','.join(self._video_filters(add_filters)),
+                            ['-c:v:0', 'libx264', '-preset:v:0', 'fast', '-crf:v:0', '21'],
+                            self.cleaner.temp_dir, self.current_file_basename, start_time=start_time, log=self.log)
+    ### Audio
+    cmd = ['ffmpeg', '-hide_banner', '-stats', '-y']
+    inputs = []
+    input_indices = {'main': None, 'request_channels': None}
+    cmd, input_count, maps, filters, converts = self._build_audio(cmd, inputs, input_indices, 0)
+    audio_file = os.path.join(video.folder, 'audio.mp4')
+    if len(maps) > 0 and not os.path.exists(audio_file):
+      if not os.path.exists(video.folder):
+        os.makedirs(video.folder)
+      self.log.info('Encoding audio')
+      self._run_encode(cmd + inputs + maps + filters + converts + ['-vn', '-sn', '-f', 'mp4', audio_file + '.part'])
+      os.rename(audio_file + '.part', audio_file)
+    ### Video
+    list_file = video.run(progress=progress)
+    ### Final
+    cmd = ['ffmpeg', '-hide_banner', '-stats', '-y', '-f', 'concat', '-safe', '0', '-i', list_file]
+    if len(maps) > 0:
+      cmd.extend(['-i', audio_file, '-map', '0:v:0', '-map', '1:a'])
+    else:
+      cmd.extend(['-map', '0:v:0'])
+    cmd.extend(['-c', 'copy', '-sn'])
+    dest = os.path.join(self.cleaner.temp_dir, '.'.join([self.current_file_basename, 'norm', 'mp4']))
+    self._encode_faststart(cmd, [['-f', 'mp4', dest]], len(maps) // 2)
+    self.cleaner.add_path(dest)
+    video.clear()
+    self._refresh(dest)
+    return self
+
+  def convert_and_normalize(self, add_filters=None, progress=None):
+    if segmented_encode and self.default_video_stream['_convert'] and float(self.current_file_info['format']['duration']) > 2 * segment_seconds:
+      return self._convert_segmented(add_filters, progress=progress)
+    cmd = ['ffmpeg', '-hide_banner', '-stats', '-y']#, '-v', 'quiet']
+    inputs = []
+    maps = []
+    filters = []
+    converts = []
+    input_count = 0
+    input_indices = {'main': None, 'request_channels': None}
+    ### Video
+    if input_indices['main'] is None:
+      inputs.extend(['-i', self.current_file])
+      input_indices['main'] = input_count
+      input_count += 1
+    maps.extend(['-map', '{:d}:{:d}'.format(input_indices['main'], self.default_video_stream['index'])])
+    if self.default_video_stream['_convert']:
+      f = self._video_filters(add_filters)
+      if len(f) > 0:
+        filters.extend(['-filter:v:0', ','.join(f)])
+      converts.extend(['-c:v:0', 'libx264', '-preset:v:0', 'fast', '-crf:v:0', '21'])
+    else:
+      converts.extend(['-c:v:0', 'copy'])
+    ### Audio
+    cmd, input_count, audio_maps, audio_filters, audio_converts = self._build_audio(cmd, inputs, input_indices, input_count)
+    maps.extend(audio_maps)
+    filters.extend(audio_filters)
+    converts.extend(audio_converts)
+    ### Subtitle
     converts.append('-sn')
     ### Final
     cmd.extend(inputs)
@@ -611,30 +968,71 @@ class FfMpeg(object):
     cmd.extend(filters)
     cmd.extend(converts)
     dest = os.path.join(self.cleaner.temp_dir, '.'.join([self.current_file_basename, 'norm', 'mp4']))
-    cmd.extend(['-f', 'mp4', dest])
-    self.log.debug(_command_to_string(cmd))
-    if '|' in cmd:
-      a = cmd[:cmd.index('|')]
-      b = cmd[cmd.index('|') + 1:]
-      pa = Popen(a, stdout=PIPE, stderr=PIPE)
-      pb = Popen(b, stdin=pa.stdout, stdout=PIPE, stderr=PIPE)
-      _, err = pb.communicate()
-      rc = pb.returncode
-    else:
-      p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-      _, err = p.communicate()
-      rc = p.returncode
-    if rc != 0:
-      with open('faillog.log', 'w') as f:
-        f.write(err)
-      raise IOError('Normalization failed with exit code {:d}'.format(rc))
+    self._encode_faststart(cmd, [['-f', 'mp4', dest]], len(audio_maps) // 2, progress=progress)
     self.cleaner.add_path(dest)
     self._refresh(dest)
     return self
 
+  def rendition(self, max_height):
+    vs = self.default_video_stream
+    crop = copy(vs['_cropdetect']) if '_cropdetect' in vs else None
+    result = _new_fix_crop(vs, max_height=max_height, crop=crop)
+    size = result.get('scale', result.get('crop', {'width': vs['width'], 'height': vs['height']}))
+    result['width'] = int(size['width'])
+    result['height'] = int(size['height'])
+    return result
+
+  def resolution(self, max_height=None):
+    self._select_video_stream()
+    vs = self.default_video_stream
+    size = {'width': vs['width'], 'height': vs['height']}
+    if max_height is not None:
+      size = _new_fix_crop(vs, max_height=max_height).get('scale', size)
+    return resolution_label(int(size['width']), int(size['height']))
+
+  def convert_ladder(self, heights, add_filters=None, progress=None):
+    vs = self.default_video_stream
+    cmd = ['ffmpeg', '-hide_banner', '-stats', '-y']
+    inputs = ['-i', self.current_file]
+    input_indices = {'main': 0, 'request_channels': None}
+    cmd, input_count, audio_maps, audio_filters, audio_converts = self._build_audio(cmd, inputs, input_indices, 1)
+    shared = self._video_filters(add_filters, rendition={})
+    shared.append('split={:d}'.format(len(heights)))
+    graph = ['[{:d}:{:d}]{:s}{:s}'.format(input_indices['main'], vs['index'], ','.join(shared), ''.join(['[s{:d}]'.format(i) for i in range(len(heights))]))]
+    outputs = []
+    renditions = []
+    for i, max_height in enumerate(heights):
+      r = self.rendition(max_height)
+      f = self._rendition_filters(r)
+      graph.append('[s{:d}]{:s}[v{:d}]'.format(i, ','.join(f) if len(f) > 0 else 'null', i))
+      dest = os.path.join(self.cleaner.temp_dir, '.'.join([self.current_file_basename, '{:d}p'.format(max_height), 'norm', 'mp4']))
+      output = ['-map', '[v{:d}]'.format(i)]
+      output.extend(audio_maps)
+      output.extend(audio_filters)
+      output.extend(['-c:v:0', 'libx264', '-preset:v:0', 'fast', '-crf:v:0', '21'])
+      output.extend(audio_converts)
+      output.extend(['-sn', '-f', 'mp4', dest])
+      outputs.append(output)
+      renditions.append({'max_height': max_height, 'width': r['width'], 'height': r['height'], 'path': dest})
+    cmd.extend(inputs)
+    cmd.extend(['-filter_complex', ';'.join(graph)])
+    self._encode_faststart(cmd, outputs, len(audio_maps) // 2, progress=progress)
+    for r in renditions:
+      self.cleaner.add_path(r['path'])
+    return renditions
+
   def _garnish(self, parsley):
     parsley['information'] = 'zzzzFFVer{video:d}.{audio:d}.{tags:d}'.format(**(FfMpeg.version))
     tagged_file = os.path.join(self.cleaner.temp_dir, '.'.join([self.current_file_basename, 'tagged', self.current_file_ext]))
+    if native_tagging:
+      try:
+        mp4.write_tags(self.current_file, parsley, output=tagged_file, padding=mp4_padding, log=self.log)
+      except (mp4.Mp4Error, struct.error) as e:
+        self.log.warning('Native tagging failed, falling back to AtomicParsley: {}'.format(e))
+      else:
+        self.cleaner.add_path(tagged_file)
+        self._refresh(tagged_file)
+        return
     cmd = ['AtomicParsley', self.current_file, '--metaEnema', '--output', tagged_file]
     for key, value in parsley.items():
       if key == 'rDNSatom':
@@ -646,33 +1044,22 @@ class FfMpeg(object):
         cmd.extend(['--{:s}'.format(key), unicode(value)])
     self.log.debug(_command_to_string(cmd))
     cmd = [v.encode('utf-8') for v in cmd]
+    r = Runner(cmd, log=self.log, stdout='lines')
     try:
-      p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+      r.start()
     except TypeError as e:
       for c in cmd:
         self.log.error('{} : {}'.format(type(c).__name__, c))
       raise e
-    (out, err) = p.communicate()
-    if p.returncode != 0:
-      raise IOError('Tagging failed with exit code {:d}\n\n{:s}\n\n{:s}'.format(p.returncode, out, err))
+    if r.wait() != 0:
+      raise IOError('Tagging failed with exit code {:d}\n\n{:s}'.format(r.returncode, r.tail))
     self.cleaner.add_path(tagged_file)
     self._refresh(tagged_file)
 
   def tag_movie(self, tmdb_id, collection=None):
-    for i in range(0,4):
-      try:
-        movie = tmdb.Movies(tmdb_id)
-        info = movie.info()
-        cred = movie.credits()
-        releases = movie.releases()
-      except Timeout as e:
-        if i < 3:
-          self.log.warning('Unable to connect to TMDB, retrying ({:d} of 3'.format(i+1))
-          continue
-        else:
-          self.log.critical('Unable to connect to TMDB after 3 retries')
-          raise e
-      break
+    info = tmdb_movie(tmdb_id, log=self.log)
+    cred = tmdb_credits(tmdb_id, log=self.log)
+    releases = tmdb_releases(tmdb_id, log=self.log)
     cast = cred['cast']
     crew = cred['crew']
     release_date = datetime.strptime(info['release_date'], '%Y-%m-%d') if 'release_date' in info and info['release_date'] != '' else None
@@ -726,41 +1113,25 @@ class FfMpeg(object):
       parsley['hdvideo'] = 1
     else:
       parsley['hdvideo'] = 0
-    if 'poster_path' in info and info['poster_path'] is not None:
-      tmdb_config = tmdb.Configuration().info()
-      poster_path = '{:s}{:s}{:s}'.format(tmdb_config['images']['base_url'], 'original', info['poster_path'])
-      self.log.debug('Downloading temporary jpeg from {:s}'.format(poster_path))
-      cover_file = os.path.join(self.cleaner.temp_dir, os.path.basename(poster_path))
-      urlretrieve(poster_path, cover_file)
-      self.cleaner.add_path(cover_file)
-      parsley['artwork'] = cover_file
+    poster_path = tmdb_poster_url(info, log=self.log)
+    if poster_path is not None:
+      parsley['artwork'] = fetch_artwork(poster_path, log=self.log)
     self._garnish(parsley)
     return self
 
   def tag_tv(self, show_id, season_num, episode_num, dvdOrder=False):
-    for i in range(0,4):
-      try:
-        tvdb = Tvdb(apikey=tvdb_api_key, language='en', banners=True, actors=True, dvdorder=dvdOrder)
-        show = tvdb[show_id]
-        episode = show[season_num][episode_num]
-      except tvdb_error as e:
-        if i < 3:
-          self.log.warning('Unable to connect to TVDB, retrying ({:d} of 3)'.format(i+1))
-          continue
-        else:
-          self.log.critical('Unable to connect to TVDB after 3 retries')
-          raise e
-      break
+    show = tvdb_show(show_id, dvdorder=dvdOrder, log=self.log)
+    episode = tvdb_episode(show_id, season_num, episode_num, dvdorder=dvdOrder, log=self.log)
     # Build the plist
     plist = {}
     plist_string = None
-    if '_actors' in show.data and len(show['_actors']) > 0:
+    if '_actors' in show and len(show['_actors']) > 0:
       plist['cast'] = [{'name': a['name']} for a in show['_actors'] if a['name'] is not None]
     if 'director' in episode and episode['director'] is not None:
       plist['directors'] = [{'name': d} for d in episode['director'].strip('|').split('|')]
     if 'writer' in episode and episode['writer'] is not None:
       plist['screenwriters'] = [{'name': w} for w in episode['writer'].strip('|').split('|')]
-    if 'network' in show.data and show['network'] is not None:
+    if 'network' in show and show['network'] is not None:
       plist['studio'] = show['network']
     if plist != {}:
       plist_string = _plist_to_string(plist)
@@ -768,25 +1139,25 @@ class FfMpeg(object):
     parsley = {'stik': u'TV Show', 'track': unicode(episode_num), 'TVEpisodeNum': unicode(episode_num), 'TVSeasonNum': unicode(season_num), 'disk': '0'}
     if plist_string is not None:
       parsley['rDNSatom'] = {'name': 'iTunMOVI', 'domain': 'com.apple.iTunes', 'value': plist_string}
-    if 'contentrating' in show.data and show.data['contentrating'] is not None:
+    if 'contentrating' in show and show['contentrating'] is not None:
       parsley['contentRating'] = show['contentrating']
     if 'episodename' in episode and episode['episodename'] is not None:
       parsley['title'] = episode['episodename']
       parsley['TVEpisode'] = '{:02d} - {:s}'.format(episode_num, episode['episodename'])
-    if '_actors' in show.data and len(show['_actors']) > 0:
+    if '_actors' in show and len(show['_actors']) > 0:
       parsley['artist'] = _join_and_ellipsize([a['name'] for a in show['_actors']], ', ', 255, '')
-    if 'seriesname' in show.data and show.data['seriesname'] is not None:
+    if 'seriesname' in show and show['seriesname'] is not None:
       parsley['albumArtist'] = show['seriesname']
       parsley['TVShowName'] = show['seriesname']
       if season_num == 0:
         parsley['album'] = '{:s}, Specials'.format(show['seriesname'])
       else:
         parsley['album'] = '{:s}, Season {:d}'.format(show['seriesname'], season_num)
-    if 'genre' in show.data and show.data['genre'] is not None:
+    if 'genre' in show and show['genre'] is not None:
       parsley['genre'] = _join_and_ellipsize(show['genre'].strip('|').split('|'), ', ', 255, '')
     if 'firstaired' in episode and episode['firstaired'] is not None:
       parsley['year'] = episode['firstaired']
-    if 'network' in show.data and show.data['network'] is not None:
+    if 'network' in show and show['network'] is not None:
       parsley['TVNetwork'] = show['network']
     if 'overview' in episode and episode['overview'] is not None:
       parsley['description'] = _join_and_ellipsize(episode['overview'].split(' '), ' ', 255)
@@ -798,17 +1169,7 @@ class FfMpeg(object):
     else:
       parsley['hdvideo'] = '0'
     if 'filename' in episode and episode['filename'] is not None:
-      self.log.debug('Downloading temporary jpeg from {:s}'.format(episode['filename']))
-      cover_file = os.path.join(self.cleaner.temp_dir, os.path.basename(episode['filename']))
-      urlretrieve(episode['filename'], cover_file)
-      self.cleaner.add_path(cover_file)
-      parsley['artwork'] = cover_file
-      if os.path.splitext(cover_file)[1].lower() == '.jpg':
-        with open(cover_file, 'r+b') as f:
-          fourbytes = [ord(b) for b in f.read(4)]
-          if fourbytes[0] == 0xff and fourbytes[1] == 0xd8 and fourbytes[2] == 0xff and fourbytes[3] != 0xe0:
-            f.seek(3)
-            f.write(chr(0xe0))
+      parsley['artwork'] = fetch_artwork(episode['filename'], log=self.log)
     self._garnish(parsley)
     return self
 
@@ -819,20 +1180,17 @@ class FfMpeg(object):
       qt.process(self.current_file, faststart_file)
       self.cleaner.add_path(faststart_file)
       self.log.debug('moov atom moved successfully')
-      self._refresh(faststart_file)
+      self._refresh(faststart_file, info=self._carried_info(faststart_file))
     return self
 
   def _is_faststart(self):
     if not os.path.exists(self.current_file):
       self.log.error('\'{:s}\' does not exist!'.format(self.current_file))
       raise IOError('{:s} does not exist!'.format(self.current_file))
-    p = Popen(['AtomicParsley', self.current_file, '-T'], stdout=PIPE)
     self.log.debug('Testing for faststart')
-    (out, err) = p.communicate()
-    match = re.search('Atom moov @ (\d+) of', out)
-    if int(match.group(1)) > 32:
-      self.log.debug('moov offset is {:d}, not faststart'.format(int(match.group(1))))
+    if not mp4.is_faststart(self.current_file):
+      self.log.debug('moov follows mdat, not faststart')
       return False
     else:
-      self.log.debug('moov offset is {:d}, is faststart'.format(int(match.group(1))))
+      self.log.debug('moov precedes mdat, is faststart')
       return True
@@ -0,0 +1,257 @@
+from __future__ import unicode_literals
+import os
+import json
+import errno
+import select
+import socket
+import sqlite3
+import importlib
+import multiprocessing
+from time import time, sleep
+from traceback import format_exc
+from logging import getLogger
+from logs import setup_logging
+from cache import fingerprint
+from checkpoint import expire as expire_checkpoints
+from config import config
+
+queue_path = config.get('queue_path', os.path.join(os.path.expanduser('~'), '.convert', 'queue.sqlite'))
+queue_slots = config.get('queue_slots', 3)
+queue_backoff = config.get('queue_backoff', 300)
+queue_sweep = config.get('queue_sweep', 3600)
+
+priorities = {
+  'priority': 0,
+  'normal': 10,
+  'bulk': 20
+}
+
+handlers = {
+  'movie': 'newfinished:process_movie',
+  'movie_ladder': 'newfinished:process_movie_ladder',
+  'tv': 'newfinished:process_tv'
+}
+
+def _dict_row(cursor, row):
+  return dict((column[0], value) for column, value in zip(cursor.description, row))
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  args TEXT NOT NULL,
+  priority INTEGER NOT NULL,
+  state TEXT NOT NULL DEFAULT 'queued',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  max_attempts INTEGER NOT NULL,
+  not_before REAL NOT NULL DEFAULT 0,
+  source TEXT,
+  source_fingerprint TEXT,
+  mark_done INTEGER NOT NULL DEFAULT 0,
+  worker TEXT,
+  error TEXT,
+  created REAL NOT NULL,
+  started REAL,
+  finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (state, priority, id);
+'''
+
+class JobQueue(object):
+  def __init__(self, path=None, backoff=None):
+    self.path = path or queue_path
+    self.socket_path = self.path + '.sock'
+    self.backoff = backoff or queue_backoff
+    self.log = getLogger()
+    if not os.path.exists(os.path.dirname(self.path)):
+      os.makedirs(os.path.dirname(self.path))
+    self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+    self.db.row_factory = _dict_row
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.executescript(_schema)
+    if 'source_fingerprint' not in [row['name'] for row in self.db.execute('PRAGMA table_info(jobs)').fetchall()]:
+      self.db.execute('ALTER TABLE jobs ADD COLUMN source_fingerprint TEXT')
+
+  def submit(self, kind, args, priority='normal', max_attempts=3, source=None, mark_done=False):
+    if kind not in handlers:
+      raise ValueError('Unknown job kind {:s}'.format(kind))
+    if source is not None:
+      row = self.db.execute("SELECT id FROM jobs WHERE source = ? AND state IN ('queued', 'running')", (source,)).fetchone()
+      if row is not None:
+        self.log.debug('{:s} is already queued as job {:d}'.format(source, row['id']))
+        return row['id']
+    source_fingerprint = fingerprint(source) if source is not None and os.path.isfile(source) else None
+    cur = self.db.execute('INSERT INTO jobs (kind, args, priority, max_attempts, source, source_fingerprint, mark_done, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (kind, json.dumps(args), priorities[priority], max_attempts, source, source_fingerprint, 1 if mark_done else 0, time()))
+    self.log.debug('Queued {:s} job {:d}'.format(kind, cur.lastrowid))
+    self.notify()
+    return cur.lastrowid
+
+  def notify(self):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      s.sendto(b'!', self.socket_path)
+    except socket.error:
+      pass
+    finally:
+      s.close()
+
+  def daemon_running(self):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      s.connect(self.socket_path)
+      return True
+    except socket.error:
+      return False
+    finally:
+      s.close()
+
+  def failed(self, source, source_fingerprint):
+    return self.db.execute("SELECT * FROM jobs WHERE source = ? AND source_fingerprint = ? AND state = 'failed' ORDER BY id DESC LIMIT 1",
+                           (source, source_fingerprint)).fetchone()
+
+  def get(self, job_id):
+    return self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+  def jobs(self, states=None):
+    if states is None:
+      return self.db.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+    return self.db.execute('SELECT * FROM jobs WHERE state IN ({:s}) ORDER BY priority, id'.format(','.join('?' * len(states))), states).fetchall()
+
+  def claim(self, worker):
+    now = time()
+    self.db.execute('BEGIN IMMEDIATE')
+    try:
+      row = self.db.execute("SELECT * FROM jobs WHERE state = 'queued' AND not_before <= ? ORDER BY priority, id LIMIT 1", (now,)).fetchone()
+      if row is not None:
+        self.db.execute("UPDATE jobs SET state = 'running', worker = ?, started = ?, attempts = attempts + 1 WHERE id = ?", (worker, now, row['id']))
+      self.db.execute('COMMIT')
+    except Exception:
+      self.db.execute('ROLLBACK')
+      raise
+    return None if row is None else self.get(row['id'])
+
+  def next_due(self):
+    row = self.db.execute("SELECT MIN(not_before) AS due FROM jobs WHERE state = 'queued'").fetchone()
+    return row['due']
+
+  def finish(self, job_id):
+    self.db.execute("UPDATE jobs SET state = 'done', error = NULL, finished = ? WHERE id = ?", (time(), job_id))
+    job = self.get(job_id)
+    if job['mark_done'] and job['source'] and os.path.exists(job['source']):
+      os.rename(job['source'], job['source'] + '.done')
+
+  def fail(self, job_id, error):
+    job = self.get(job_id)
+    if job['attempts'] < job['max_attempts']:
+      delay = self.backoff * 2 ** (job['attempts'] - 1)
+      self.log.warning('Job {:d} failed, retrying in {:d} seconds'.format(job_id, int(delay)))
+      self.db.execute("UPDATE jobs SET state = 'queued', error = ?, not_before = ? WHERE id = ?", (error, time() + delay, job_id))
+    else:
+      self.log.error('Job {:d} failed after {:d} attempts'.format(job_id, job['attempts']))
+      self.db.execute("UPDATE jobs SET state = 'failed', error = ?, finished = ? WHERE id = ?", (error, time(), job_id))
+      source = json.loads(job['args']).get('file_path')
+      if source is not None:
+        expire_checkpoints(source=source, log=self.log)
+    self.notify()
+
+  def requeue_running(self, worker_prefix):
+    self.db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running' AND worker LIKE ?", (worker_prefix + '%',))
+
+  def wait(self, job_id, interval=5, timeout=None, daemon=False):
+    deadline = None if timeout is None else time() + timeout
+    while True:
+      job = self.get(job_id)
+      if job['state'] in ['done', 'failed']:
+        return job
+      if deadline is not None and time() >= deadline:
+        return job
+      if daemon and not self.daemon_running():
+        return job
+      sleep(interval)
+
+def resolve(kind):
+  module, function = handlers[kind].split(':')
+  return getattr(importlib.import_module(module), function)
+
+def _run_job(path, job_id):
+  q = JobQueue(path)
+  job = q.get(job_id)
+  try:
+    resolve(job['kind'])(**json.loads(job['args']))
+  except Exception:
+    q.fail(job_id, format_exc())
+  else:
+    q.finish(job_id)
+    q.notify()
+
+class Daemon(object):
+  def __init__(self, path=None, slots=None):
+    self.queue = JobQueue(path)
+    self.slots = slots or queue_slots
+    self.running = {}
+    self.worker = '{:s}:{:d}'.format(socket.gethostname(), os.getpid())
+    self.swept = 0
+    self.log = getLogger()
+
+  def _listen(self):
+    if os.path.exists(self.queue.socket_path):
+      os.remove(self.queue.socket_path)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    s.bind(self.queue.socket_path)
+    s.setblocking(False)
+    return s
+
+  def _reap(self):
+    for job_id, p in list(self.running.items()):
+      if not p.is_alive():
+        p.join()
+        del self.running[job_id]
+        if self.queue.get(job_id)['state'] == 'running':
+          self.queue.fail(job_id, 'Worker exited with code {}'.format(p.exitcode))
+        self.log.info('Job {:d} finished with state {:s}'.format(job_id, self.queue.get(job_id)['state']))
+
+  def _fill(self):
+    while len(self.running) < self.slots:
+      job = self.queue.claim(self.worker)
+      if job is None:
+        break
+      self.log.info('Starting {:s} job {:d} (attempt {:d})'.format(job['kind'], job['id'], job['attempts']))
+      p = multiprocessing.Process(target=_run_job, args=(self.queue.path, job['id']))
+      p.start()
+      self.running[job['id']] = p
+
+  def run(self):
+    self.queue.requeue_running(socket.gethostname() + ':')
+    s = self._listen()
+    self.log.info('Job queue daemon started with {:d} slots'.format(self.slots))
+    try:
+      while True:
+        self._reap()
+        self._fill()
+        if time() - self.swept >= queue_sweep:
+          expire_checkpoints(log=self.log)
+          self.swept = time()
+        timeout = 30.0
+        due = self.queue.next_due()
+        if due is not None and len(self.running) < self.slots:
+          timeout = max(0.1, min(timeout, due - time()))
+        try:
+          ready, _, _ = select.select([s], [], [], timeout)
+        except select.error as e:
+          if e.args[0] != errno.EINTR:
+            raise
+          ready = []
+        if ready:
+          try:
+            while s.recv(64):
+              pass
+          except socket.error:
+            pass
+    finally:
+      s.close()
+      os.remove(self.queue.socket_path)
+
+if __name__ == '__main__':
+  setup_logging(os.path.join(config['log_path'], 'queue'))
+  Daemon().run()
@@ -0,0 +1,195 @@
+from __future__ import unicode_literals
+import os
+import stat
+import struct
+import sqlite3
+from time import time
+from multiprocessing.pool import ThreadPool
+from logging import getLogger
+import mp4
+from config import config
+
+library_path = config.get('library_path', os.path.join(os.path.expanduser('~'), '.convert', 'library.sqlite'))
+library_workers = config.get('library_workers', 8)
+pinned_outputs = set(config.get('pinned_outputs', []))
+
+# Used to estimate encode time for files whose duration can't be read
+fallback_bitrate = 4 * 1000 * 1000
+
+def _dict_row(cursor, row):
+  return dict((column[0], value) for column, value in zip(cursor.description, row))
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS outputs (
+  path TEXT PRIMARY KEY,
+  kind TEXT,
+  tmdb_id INTEGER,
+  tvdb_id INTEGER,
+  season INTEGER,
+  episode INTEGER,
+  width INTEGER,
+  height INTEGER,
+  duration REAL,
+  video INTEGER,
+  audio INTEGER,
+  tags INTEGER,
+  size INTEGER,
+  mtime REAL,
+  source TEXT,
+  source_fingerprint TEXT,
+  pinned INTEGER NOT NULL DEFAULT 0,
+  published REAL,
+  scanned REAL
+);
+'''
+
+def _scan(path):
+  try:
+    st = os.stat(path)
+    summary = mp4.read_summary(path)
+  except (OSError, IOError, mp4.Mp4Error, struct.error) as e:
+    return path, None, e
+  version = summary['version'] or {}
+  return path, {
+    'width': summary['width'] or None,
+    'height': summary['height'] or None,
+    'duration': summary['duration'],
+    'video': version.get('video'),
+    'audio': version.get('audio'),
+    'tags': version.get('tags'),
+    'size': st.st_size,
+    'mtime': st.st_mtime
+  }, None
+
+def cost(row):
+  pixels = (row['width'] or 1920) * (row['height'] or 1080)
+  duration = row['duration']
+  if duration is None:
+    duration = float(row['size'] or 0) * 8 / fallback_bitrate
+  return duration * pixels / (1920 * 1080)
+
+class Library(object):
+  def __init__(self, path=None):
+    self.path = path or library_path
+    self.log = getLogger()
+    if not os.path.exists(os.path.dirname(self.path)):
+      os.makedirs(os.path.dirname(self.path))
+    self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+    self.db.row_factory = _dict_row
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.executescript(_schema)
+
+  def get(self, path):
+    return self.db.execute('SELECT * FROM outputs WHERE path = ?', (path,)).fetchone()
+
+  def _update(self, path, fields):
+    self.db.execute('INSERT OR IGNORE INTO outputs (path) VALUES (?)', (path,))
+    self.db.execute('UPDATE outputs SET {:s} WHERE path = ?'.format(', '.join('{:s} = ?'.format(k) for k in fields)),
+                    list(fields.values()) + [path])
+
+  def _refresh(self, path):
+    _, fields, error = _scan(path)
+    if error is not None:
+      self.log.warning('Unable to index {:s}: {}'.format(path, error))
+      return None
+    fields['scanned'] = time()
+    self._update(path, fields)
+    return self.get(path)
+
+  def record(self, path, kind, source=None, source_fingerprint=None, tmdb_id=None, tvdb_id=None, season=None, episode=None):
+    self._update(path, {
+      'kind': kind,
+      'tmdb_id': tmdb_id,
+      'tvdb_id': tvdb_id,
+      'season': season,
+      'episode': episode,
+      'source': source,
+      'source_fingerprint': source_fingerprint,
+      'published': time()
+    })
+    self._refresh(path)
+
+  def check(self, path, version):
+    if path in pinned_outputs:
+      return 'skip'
+    try:
+      st = os.stat(path)
+    except OSError:
+      return False
+    if not stat.S_ISREG(st.st_mode):
+      return False
+    row = self.get(path)
+    if row is None or row['size'] != st.st_size or row['mtime'] != st.st_mtime:
+      row = self._refresh(path)
+      if row is None:
+        return 'replace'
+    if row['pinned']:
+      return 'skip'
+    if row['video'] != version['video']:
+      return 'replace'
+    if row['audio'] != version['audio']:
+      # return 'audio'
+      return 'replace'
+    if row['tags'] != version['tags']:
+      # return 'retag'
+      return 'replace'
+    return 'skip'
+
+  def pin(self, paths, pinned=True):
+    self.db.execute('BEGIN')
+    for path in paths:
+      self.db.execute('INSERT OR IGNORE INTO outputs (path) VALUES (?)', (path,))
+      self.db.execute('UPDATE outputs SET pinned = ? WHERE path = ?', (1 if pinned else 0, path))
+    self.db.execute('COMMIT')
+
+  def rebuild(self, sections, workers=None, full=False):
+    if len(pinned_outputs) > 0:
+      self.pin(pinned_outputs)
+    known = dict((row['path'], (row['size'], row['mtime'])) for row in self.db.execute('SELECT path, size, mtime FROM outputs'))
+    found = set()
+    pending = []
+    for section in sections:
+      for root, dirs, fs in os.walk(section):
+        for f in fs:
+          if os.path.splitext(f)[1].lower() not in ['.mp4', '.m4v']:
+            continue
+          path = os.path.join(root, f)
+          found.add(path)
+          if not full and path in known:
+            try:
+              st = os.stat(path)
+            except OSError:
+              continue
+            if known[path] == (st.st_size, st.st_mtime):
+              continue
+          pending.append(path)
+    self.log.info('{:d} files found, {:d} to scan'.format(len(found), len(pending)))
+    pool = ThreadPool(workers or library_workers)
+    try:
+      results = pool.imap_unordered(_scan, pending, chunksize=16)
+      self.db.execute('BEGIN')
+      try:
+        now = time()
+        for path, fields, error in results:
+          if error is not None:
+            self.log.warning('Unable to index {:s}: {}'.format(path, error))
+            continue
+          fields['scanned'] = now
+          self._update(path, fields)
+        for path in known:
+          if path not in found and any(path.startswith(os.path.join(section, '')) for section in sections):
+            self.db.execute('DELETE FROM outputs WHERE path = ? AND pinned = 0', (path,))
+        self.db.execute('COMMIT')
+      except Exception:
+        self.db.execute('ROLLBACK')
+        raise
+    finally:
+      pool.close()
+      pool.join()
+    return len(pending)
+
+  def stale(self, version):
+    rows = self.db.execute('SELECT * FROM outputs WHERE pinned = 0 AND size IS NOT NULL AND '
+                           '(video IS NOT ? OR audio IS NOT ? OR tags IS NOT ?)',
+                           (version['video'], version['audio'], version['tags'])).fetchall()
+    return sorted([row for row in rows if row['path'] not in pinned_outputs], key=cost, reverse=True)
@@ -0,0 +1,112 @@
+from __future__ import unicode_literals
+from __future__ import division
+import os
+import math
+import threading
+import numpy as np
+from scipy.signal import lfilter, lfilter_zi
+from runner import Runner, spawn_lock
+from logging import getLogger
+
+def k_weighting(rate):
+  # Pre-filter (high shelf) and RLB high-pass from BS.1770, re-derived for any sample rate
+  f0 = 1681.974450955533
+  G = 3.999843853973347
+  Q = 0.7071752369554196
+  K = math.tan(math.pi * f0 / rate)
+  Vh = math.pow(10.0, G / 20.0)
+  Vb = math.pow(Vh, 0.4996667741545416)
+  a0 = 1.0 + K / Q + K * K
+  shelf_b = np.array([(Vh + Vb * K / Q + K * K) / a0, 2.0 * (K * K - Vh) / a0, (Vh - Vb * K / Q + K * K) / a0])
+  shelf_a = np.array([1.0, 2.0 * (K * K - 1.0) / a0, (1.0 - K / Q + K * K) / a0])
+  f0 = 38.13547087602444
+  Q = 0.5003270373238773
+  K = math.tan(math.pi * f0 / rate)
+  a0 = 1.0 + K / Q + K * K
+  highpass_b = np.array([1.0, -2.0, 1.0])
+  highpass_a = np.array([1.0, 2.0 * (K * K - 1.0) / a0, (1.0 - K / Q + K * K) / a0])
+  return (shelf_b, shelf_a), (highpass_b, highpass_a)
+
+class LoudnessMeter(object):
+  def __init__(self, rate, channels=2, weights=None):
+    self.rate = rate
+    self.channels = channels
+    self.weights = np.ones(channels) if weights is None else np.asarray(weights, dtype=np.float64)
+    self.step = int(round(rate * 0.1))
+    (self._shelf_b, self._shelf_a), (self._highpass_b, self._highpass_a) = k_weighting(rate)
+    self._shelf_zi = None
+    self._highpass_zi = None
+    self._carry = np.zeros(0)
+    self._subblocks = []
+
+  def feed(self, samples):
+    samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.channels)
+    if len(samples) == 0:
+      return
+    if self._shelf_zi is None:
+      self._shelf_zi = np.outer(lfilter_zi(self._shelf_b, self._shelf_a), samples[0])
+      self._highpass_zi = np.zeros((2, self.channels))
+    y, self._shelf_zi = lfilter(self._shelf_b, self._shelf_a, samples, axis=0, zi=self._shelf_zi)
+    y, self._highpass_zi = lfilter(self._highpass_b, self._highpass_a, y, axis=0, zi=self._highpass_zi)
+    energy = np.concatenate([self._carry, (y * y).dot(self.weights)])
+    full = len(energy) // self.step
+    if full > 0:
+      self._subblocks.extend(energy[:full * self.step].reshape(full, self.step).sum(axis=1).tolist())
+    self._carry = energy[full * self.step:]
+
+  def integrated(self):
+    subblocks = np.array(self._subblocks) / self.step
+    if len(subblocks) < 4:
+      return None
+    blocks = np.convolve(subblocks, np.ones(4) / 4.0, mode='valid')
+    with np.errstate(divide='ignore'):
+      levels = -0.691 + 10.0 * np.log10(blocks)
+    gated = blocks[levels > -70.0]
+    if len(gated) == 0:
+      return -70.0
+    relative = -0.691 + 10.0 * np.log10(gated.mean()) - 10.0
+    gated = blocks[(levels > -70.0) & (levels > relative)]
+    return -0.691 + 10.0 * math.log10(gated.mean())
+
+def _pump(pipe, meter, chunk_seconds=1.0):
+  frame_bytes = 4 * meter.channels
+  size = int(meter.rate * chunk_seconds) * frame_bytes
+  with os.fdopen(pipe, 'rb') as f:
+    while True:
+      buf = f.read(size)
+      if len(buf) == 0:
+        break
+      buf = buf[:len(buf) - len(buf) % frame_bytes]
+      meter.feed(np.frombuffer(buf, dtype='<f4'))
+
+def measure(filepath, stream_indices, rate=24000, log=None):
+  if log is None:
+    log = getLogger()
+  cmd = ['ffmpeg', '-hide_banner', '-nostats', '-v', 'error', '-i', filepath]
+  meters = []
+  pipes = []
+  with spawn_lock:
+    for index in stream_indices:
+      read_fd, write_fd = os.pipe()
+      cmd.extend(['-map', '0:{:d}'.format(index), '-vn', '-sn', '-ac', '2', '-ar', '{:d}'.format(rate), '-f', 'f32le', 'pipe:{:d}'.format(write_fd)])
+      meters.append(LoudnessMeter(rate))
+      pipes.append((read_fd, write_fd))
+    log.debug(' '.join(cmd))
+    try:
+      runner = Runner(cmd, log=log, pass_fds=[write_fd for _, write_fd in pipes]).start()
+    finally:
+      for _, write_fd in pipes:
+        os.close(write_fd)
+  threads = []
+  for (read_fd, _), meter in zip(pipes, meters):
+    t = threading.Thread(target=_pump, args=(read_fd, meter))
+    t.daemon = True
+    t.start()
+    threads.append(t)
+  for t in threads:
+    t.join()
+  rc = runner.wait()
+  if rc != 0:
+    runner.write_faillog()
+    raise IOError('Loudness measurement failed with exit code {:d}'.format(rc))
+  return dict((index, meter.integrated()) for index, meter in zip(stream_indices, meters))
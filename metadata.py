@@ -0,0 +1,142 @@
+from __future__ import unicode_literals
+import threading
+import tmdbsimple as tmdb
+from tvdb_api import Tvdb, tvdb_error
+from requests.exceptions import Timeout
+from logging import getLogger
+from traceback import format_exc
+from cache import DiskCache
+from artwork import fetch as fetch_artwork
+from config import config
+
+tmdb.API_KEY = config['tmdb']
+tvdb_api_key = config['tvdb']
+
+day = 24 * 60 * 60
+ttls = {
+  'tmdb_movie': 7 * day,
+  'tmdb_credits': 7 * day,
+  'tmdb_releases': 7 * day,
+  'tmdb_configuration': 3 * day,
+  'tvdb_series': 1 * day
+}
+ttls.update(config.get('metadata_ttls', {}))
+metadata_cache = DiskCache('metadata', max_bytes=config.get('metadata_cache_size', 256 * 1024 * 1024))
+
+def _plain(value):
+  if isinstance(value, dict):
+    return dict((unicode(k), _plain(v)) for k, v in value.items())
+  if isinstance(value, (list, tuple)):
+    return [_plain(v) for v in value]
+  if value is None or isinstance(value, (bool, int, long, float, unicode)):
+    return value
+  if isinstance(value, bytes):
+    return value.decode('utf-8')
+  return unicode(value)
+
+def _retry(fetch, errors, service, log, tries=4):
+  for i in range(0, tries):
+    try:
+      return fetch()
+    except errors as e:
+      if i < tries - 1:
+        log.warning('Unable to connect to {:s}, retrying ({:d} of {:d})'.format(service, i + 1, tries - 1))
+      else:
+        log.critical('Unable to connect to {:s} after {:d} retries'.format(service, tries - 1))
+        raise e
+
+def _cached(kind, key, fetch, errors, service, log, refresh=False):
+  key = [kind] + key
+  if not refresh:
+    value = metadata_cache.get(key, ttl=ttls[kind])
+    if value is not None:
+      return value
+  log.debug('Fetching {:s} {:s}'.format(kind, ':'.join(unicode(k) for k in key[1:])))
+  value = _plain(_retry(fetch, errors, service, log))
+  metadata_cache.set(key, value)
+  return value
+
+def tmdb_movie(tmdb_id, log=None):
+  log = log if log is not None else getLogger()
+  return _cached('tmdb_movie', [tmdb_id], lambda: tmdb.Movies(tmdb_id).info(), Timeout, 'TMDB', log)
+
+def tmdb_credits(tmdb_id, log=None):
+  log = log if log is not None else getLogger()
+  return _cached('tmdb_credits', [tmdb_id], lambda: tmdb.Movies(tmdb_id).credits(), Timeout, 'TMDB', log)
+
+def tmdb_releases(tmdb_id, log=None):
+  log = log if log is not None else getLogger()
+  return _cached('tmdb_releases', [tmdb_id], lambda: tmdb.Movies(tmdb_id).releases(), Timeout, 'TMDB', log)
+
+def tmdb_configuration(log=None):
+  log = log if log is not None else getLogger()
+  return _cached('tmdb_configuration', [], lambda: tmdb.Configuration().info(), Timeout, 'TMDB', log)
+
+def tmdb_poster_url(info, log=None):
+  if 'poster_path' not in info or info['poster_path'] is None:
+    return None
+  tmdb_config = tmdb_configuration(log=log)
+  return '{:s}{:s}{:s}'.format(tmdb_config['images']['base_url'], 'original', info['poster_path'])
+
+def _fetch_series(show_id, dvdorder):
+  show = Tvdb(apikey=tvdb_api_key, language='en', banners=True, actors=True, dvdorder=dvdorder)[show_id]
+  episodes = {}
+  for season_num, season in show.items():
+    for episode_num, episode in season.items():
+      episodes['{:d}:{:d}'.format(season_num, episode_num)] = dict(episode)
+  return {'series': dict(show.data), 'episodes': episodes}
+
+def tvdb_series(show_id, dvdorder=False, log=None, refresh=False):
+  log = log if log is not None else getLogger()
+  return _cached('tvdb_series', [show_id, dvdorder], lambda: _fetch_series(show_id, dvdorder), tvdb_error, 'TVDB', log, refresh=refresh)
+
+def tvdb_show(show_id, dvdorder=False, log=None):
+  return tvdb_series(show_id, dvdorder, log)['series']
+
+def tvdb_episode(show_id, season_num, episode_num, dvdorder=False, log=None):
+  key = '{:d}:{:d}'.format(season_num, episode_num)
+  series = tvdb_series(show_id, dvdorder, log)
+  if key not in series['episodes']:
+    series = tvdb_series(show_id, dvdorder, log, refresh=True)
+  if key not in series['episodes']:
+    raise KeyError('Show {:d} has no season {:d} episode {:d}'.format(show_id, season_num, episode_num))
+  return series['episodes'][key]
+
+class Prefetch(object):
+  def __init__(self, target, log=None):
+    self.log = log if log is not None else getLogger()
+    self.error = None
+    self._thread = threading.Thread(target=self._run, args=(target,))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self, target):
+    try:
+      target()
+    except Exception as e:
+      self.log.error('Metadata prefetch failed\n{:s}'.format(format_exc()))
+      self.error = e
+
+  def join(self):
+    self._thread.join()
+    if self.error is not None:
+      raise self.error
+
+def _prefetch_movie(tmdb_id, log):
+  info = tmdb_movie(tmdb_id, log=log)
+  tmdb_credits(tmdb_id, log=log)
+  tmdb_releases(tmdb_id, log=log)
+  poster = tmdb_poster_url(info, log=log)
+  if poster is not None:
+    fetch_artwork(poster, log=log)
+
+def _prefetch_tv(show_id, season_num, episode_num, dvdorder, log):
+  episode = tvdb_episode(show_id, season_num, episode_num, dvdorder=dvdorder, log=log)
+  if 'filename' in episode and episode['filename'] is not None:
+    fetch_artwork(episode['filename'], log=log)
+
+def prefetch_movie(tmdb_id, log=None):
+  return Prefetch(lambda: _prefetch_movie(tmdb_id, log), log=log)
+
+def prefetch_tv(show_id, season_num, episode_num, dvdorder=False, log=None):
+  return Prefetch(lambda: _prefetch_tv(show_id, season_num, episode_num, dvdorder, log), log=log)
@@ -0,0 +1,454 @@
+# coding=utf-8
+from __future__ import unicode_literals
+import os
+import re
+import errno
+import fcntl
+import struct
+from shutil import copyfileobj, copymode
+from tempfile import NamedTemporaryFile
+from logging import getLogger
+
+containers = [b'moov', b'trak', b'mdia', b'minf', b'stbl', b'udta', b'edts', b'dinf', b'mvex', b'ilst']
+
+ap_uuid = b'\x0c\x5c\x91\x53\x0b\xd4\x5e\x72\xbe\x75\x92\xdf\xec\x8a\xb0\x0c'
+
+text_atoms = {
+  'title': '©nam',
+  'artist': '©ART',
+  'albumArtist': 'aART',
+  'album': '©alb',
+  'genre': '©gen',
+  'year': '©day',
+  'comment': '©cmt',
+  'composer': '©wrt',
+  'copyright': 'cprt',
+  'description': 'desc',
+  'longdesc': 'ldes',
+  'TVShowName': 'tvsh',
+  'TVEpisode': 'tven',
+  'TVNetwork': 'tvnn'
+}
+
+sort_atoms = {
+  'name': 'sonm',
+  'artist': 'soar',
+  'albumartist': 'soaa',
+  'album': 'soal',
+  'composer': 'soco',
+  'show': 'sosn'
+}
+
+stik_values = {
+  'Normal': 1,
+  'Audiobook': 2,
+  'Music Video': 6,
+  'Movie': 9,
+  'TV Show': 10,
+  'Booklet': 11
+}
+
+content_ratings = {
+  'G': 'mpaa|G|100|',
+  'PG': 'mpaa|PG|200|',
+  'PG-13': 'mpaa|PG-13|300|',
+  'R': 'mpaa|R|400|',
+  'NC-17': 'mpaa|NC-17|500|',
+  'TV-Y': 'us-tv|TV-Y|100|',
+  'TV-Y7': 'us-tv|TV-Y7|200|',
+  'TV-G': 'us-tv|TV-G|300|',
+  'TV-PG': 'us-tv|TV-PG|400|',
+  'TV-14': 'us-tv|TV-14|500|',
+  'TV-MA': 'us-tv|TV-MA|600|'
+}
+
+FICLONE = 0x40049409
+
+rversion = re.compile(br'FFVer(\d+)\.(\d+)\.(\d+)')
+
+class Mp4Error(Exception):
+  pass
+
+class _NoClone(Exception):
+  pass
+
+def _atom_name(name):
+  return name.encode('latin-1')
+
+def _box(name, payload):
+  if len(payload) + 8 > 0xffffffff:
+    return struct.pack('>I4sQ', 1, name, len(payload) + 16) + payload
+  return struct.pack('>I4s', len(payload) + 8, name) + payload
+
+def _free(size):
+  return struct.pack('>I4s', size, b'free') + b'\0' * (size - 8)
+
+def read_header(f, end):
+  start = f.tell()
+  if end - start < 8:
+    raise Mp4Error('Truncated box header at {:d}'.format(start))
+  size, name = struct.unpack('>I4s', f.read(8))
+  header = 8
+  if size == 1:
+    size = struct.unpack('>Q', f.read(8))[0]
+    header = 16
+  elif size == 0:
+    size = end - start
+  if size < header or start + size > end:
+    raise Mp4Error('Invalid size {:d} for box {!r} at {:d}'.format(size, name, start))
+  return name, start, header, size
+
+def top_level(f, size=None):
+  if size is None:
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+  boxes = []
+  position = 0
+  while position < size:
+    f.seek(position)
+    name, start, header, box_size = read_header(f, size)
+    boxes.append((name, start, header, box_size))
+    position = start + box_size
+  return boxes
+
+def children(f, start, end):
+  position = start
+  while end - position >= 8:
+    f.seek(position)
+    name, box_start, header, size = read_header(f, end)
+    yield name, box_start, header, size
+    position = box_start + size
+
+def _child(f, start, end, name):
+  for box in children(f, start, end):
+    if box[0] == name:
+      return box
+  return None
+
+def moov_offset(path):
+  with open(path, 'rb') as f:
+    for name, start, _, _ in top_level(f):
+      if name == b'moov':
+        return start
+  return None
+
+def is_faststart(path):
+  with open(path, 'rb') as f:
+    for name, start, _, _ in top_level(f):
+      if name == b'moov':
+        return True
+      if name == b'mdat':
+        return False
+  raise Mp4Error('No moov or mdat box in {:s}'.format(path))
+
+def _read_version(f, moov):
+  udta = _child(f, moov[1] + moov[2], moov[1] + moov[3], b'udta')
+  if udta is None:
+    return None
+  parents = [udta]
+  meta = _child(f, udta[1] + udta[2], udta[1] + udta[3], b'meta')
+  if meta is not None:
+    f.seek(meta[1] + meta[2] + 4)
+    prefix = 0 if f.read(4) == b'hdlr' else 4
+    parents.append((meta[0], meta[1], meta[2] + prefix, meta[3]))
+  for _, start, header, size in parents:
+    for name, box_start, box_header, box_size in children(f, start + header, start + size):
+      if name != b'uuid' or box_size - box_header > 4096:
+        continue
+      f.seek(box_start + box_header)
+      payload = f.read(box_size - box_header)
+      if payload[:16] != ap_uuid:
+        continue
+      found = rversion.search(payload[16:])
+      if found:
+        return {
+          'video': int(found.group(1)),
+          'audio': int(found.group(2)),
+          'tags' : int(found.group(3))
+        }
+  return None
+
+def _find_moov(f):
+  f.seek(0, os.SEEK_END)
+  return _child(f, 0, f.tell(), b'moov')
+
+def read_version(path):
+  with open(path, 'rb') as f:
+    moov = _find_moov(f)
+    return None if moov is None else _read_version(f, moov)
+
+def read_summary(path):
+  with open(path, 'rb') as f:
+    moov = _find_moov(f)
+    if moov is None:
+      raise Mp4Error('No moov box in {:s}'.format(path))
+    summary = {'version': _read_version(f, moov), 'duration': None, 'width': 0, 'height': 0}
+    for name, start, header, size in children(f, moov[1] + moov[2], moov[1] + moov[3]):
+      f.seek(start + header)
+      if name == b'mvhd':
+        version = struct.unpack('>B', f.read(1))[0]
+        if version == 1:
+          f.seek(start + header + 20)
+          timescale, duration = struct.unpack('>IQ', f.read(12))
+        else:
+          f.seek(start + header + 12)
+          timescale, duration = struct.unpack('>II', f.read(8))
+        if timescale > 0:
+          summary['duration'] = float(duration) / timescale
+      elif name == b'trak':
+        tkhd = _child(f, start + header, start + size, b'tkhd')
+        if tkhd is None:
+          continue
+        f.seek(tkhd[1] + tkhd[2])
+        version = struct.unpack('>B', f.read(1))[0]
+        f.seek(tkhd[1] + tkhd[2] + (88 if version == 1 else 76))
+        width, height = struct.unpack('>II', f.read(8))
+        if height >> 16 > summary['height']:
+          summary['width'] = width >> 16
+          summary['height'] = height >> 16
+    return summary
+
+class Box(object):
+  def __init__(self, name, payload=b'', children=None, prefix=b''):
+    self.name = name
+    self.payload = payload
+    self.children = children
+    self.prefix = prefix
+
+  def find(self, name):
+    for child in self.children or []:
+      if child.name == name:
+        return child
+    return None
+
+  def walk(self):
+    yield self
+    for child in self.children or []:
+      for box in child.walk():
+        yield box
+
+  def serialize(self):
+    if self.children is None:
+      return _box(self.name, self.payload)
+    return _box(self.name, self.prefix + b''.join(c.serialize() for c in self.children))
+
+def parse(data, offset=0, end=None):
+  end = len(data) if end is None else end
+  boxes = []
+  while offset < end:
+    if end - offset < 8:
+      if data[offset:end].strip(b'\0') == b'':
+        break
+      raise Mp4Error('Truncated box at {:d}'.format(offset))
+    size, name = struct.unpack('>I4s', data[offset:offset + 8])
+    header = 8
+    if size == 1:
+      size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+      header = 16
+    elif size == 0:
+      size = end - offset
+    if size < header or offset + size > end:
+      raise Mp4Error('Invalid size {:d} for box {!r} at {:d}'.format(size, name, offset))
+    body = offset + header
+    if name in containers:
+      boxes.append(Box(name, children=parse(data, body, offset + size)))
+    elif name == b'meta':
+      prefix = b'' if data[body + 4:body + 8] == b'hdlr' else data[body:body + 4]
+      boxes.append(Box(name, children=parse(data, body + len(prefix), offset + size), prefix=prefix))
+    else:
+      boxes.append(Box(name, payload=data[body:offset + size]))
+    offset += size
+  return boxes
+
+def _data(type_code, payload):
+  return Box(b'data', payload=struct.pack('>II', type_code, 0) + payload)
+
+def _item(name, type_code, payload):
+  return Box(_atom_name(name), children=[_data(type_code, payload)])
+
+def _text(value):
+  return value.encode('utf-8') if not isinstance(value, bytes) else value
+
+def _image(path):
+  with open(path, 'rb') as f:
+    image = f.read()
+  if image[:8] == b'\x89PNG\r\n\x1a\n':
+    return _data(14, image)
+  return _data(13, image)
+
+def from_parsley(parsley, log=None):
+  if log is None:
+    log = getLogger()
+  items = []
+  information = None
+  for key, value in parsley.items():
+    if (key == 'stik' and value not in stik_values) or (key == 'sortOrder' and value[0] not in sort_atoms):
+      raise Mp4Error('No native mapping for {:s} {}'.format(key, value))
+    if key in text_atoms:
+      items.append(_item(text_atoms[key], 1, _text(value)))
+    elif key == 'stik':
+      items.append(_item('stik', 21, struct.pack('>B', stik_values[value])))
+    elif key == 'hdvideo':
+      items.append(_item('hdvd', 21, struct.pack('>B', int(value))))
+    elif key == 'TVSeasonNum':
+      items.append(_item('tvsn', 21, struct.pack('>I', int(value))))
+    elif key == 'TVEpisodeNum':
+      items.append(_item('tves', 21, struct.pack('>I', int(value))))
+    elif key == 'track':
+      number, _, total = unicode(value).partition('/')
+      items.append(_item('trkn', 0, struct.pack('>HHHH', 0, int(number), int(total or 0), 0)))
+    elif key == 'disk':
+      number, _, total = unicode(value).partition('/')
+      items.append(_item('disk', 0, struct.pack('>HHH', 0, int(number), int(total or 0))))
+    elif key == 'contentRating':
+      if value in content_ratings:
+        items.append(Box(b'----', children=[Box(b'mean', payload=b'\0\0\0\0com.apple.iTunes'), Box(b'name', payload=b'\0\0\0\0iTunEXTC'), _data(1, _text(content_ratings[value]))]))
+      else:
+        log.warning('Unknown content rating {:s}, not tagging it'.format(value))
+    elif key == 'rDNSatom':
+      items.append(Box(b'----', children=[Box(b'mean', payload=b'\0\0\0\0' + _text(value['domain'])), Box(b'name', payload=b'\0\0\0\0' + _text(value['name'])), _data(1, _text(value['value']))]))
+    elif key == 'sortOrder':
+      items.append(_item(sort_atoms[value[0]], 1, _text(value[1])))
+    elif key == 'artwork':
+      items.append(Box(b'covr', children=[_image(value)]))
+    elif key == 'information':
+      information = Box(b'uuid', payload=ap_uuid + struct.pack('>II', 1, 0) + _text(value))
+    else:
+      raise Mp4Error('No native mapping for {:s}'.format(key))
+  return items, information
+
+def _meta(items, information):
+  hdlr = Box(b'hdlr', payload=b'\0\0\0\0' + b'\0\0\0\0' + b'mdir' + b'appl' + b'\0' * 8 + b'\0\0')
+  children = [hdlr, Box(b'ilst', children=items)]
+  if information is not None:
+    children.append(information)
+  return Box(b'meta', children=children, prefix=b'\0\0\0\0')
+
+def _replace_meta(moov, items, information):
+  udta = moov.find(b'udta')
+  if udta is None:
+    udta = Box(b'udta', children=[])
+    moov.children.append(udta)
+  udta.children = [c for c in udta.children if c.name != b'meta'] + [_meta(items, information)]
+
+def _promote(moov, after, delta):
+  promoted = False
+  for box in moov.walk():
+    if box.name == b'stco':
+      count = struct.unpack('>I', box.payload[4:8])[0]
+      offsets = struct.unpack('>{:d}I'.format(count), box.payload[8:8 + 4 * count])
+      if max([o + delta if o >= after else o for o in offsets] or [0]) > 0xffffffff:
+        box.name = b'co64'
+        box.payload = box.payload[:8] + struct.pack('>{:d}Q'.format(count), *offsets)
+        promoted = True
+  return promoted
+
+def _shift_offsets(moov, after, delta):
+  for box in moov.walk():
+    if box.name == b'stco':
+      count = struct.unpack('>I', box.payload[4:8])[0]
+      offsets = struct.unpack('>{:d}I'.format(count), box.payload[8:8 + 4 * count])
+      shifted = [o + delta if o >= after else o for o in offsets]
+      if max(shifted or [0]) > 0xffffffff:
+        raise Mp4Error('Chunk offsets overflow stco')
+      box.payload = box.payload[:8] + struct.pack('>{:d}I'.format(count), *shifted)
+    elif box.name == b'co64':
+      count = struct.unpack('>I', box.payload[4:8])[0]
+      offsets = struct.unpack('>{:d}Q'.format(count), box.payload[8:8 + 8 * count])
+      box.payload = box.payload[:8] + struct.pack('>{:d}Q'.format(count), *[o + delta if o >= after else o for o in offsets])
+
+def write_tags(path, parsley, output=None, padding=0, log=None):
+  if log is None:
+    log = getLogger()
+  items, information = from_parsley(parsley, log)
+  with open(path, 'rb') as f:
+    boxes = top_level(f)
+    names = [b[0] for b in boxes]
+    if b'moov' not in names:
+      raise Mp4Error('No moov box in {:s}'.format(path))
+    if b'moof' in names:
+      raise Mp4Error('Fragmented MP4 is not supported')
+    i = names.index(b'moov')
+    _, moov_start, moov_header, moov_size = boxes[i]
+    f.seek(moov_start + moov_header)
+    moov = Box(b'moov', children=parse(f.read(moov_size - moov_header)))
+  _replace_meta(moov, items, information)
+  new_moov = moov.serialize()
+  available = moov_size
+  following = i + 1
+  if following < len(boxes) and boxes[following][0] == b'free':
+    available += boxes[following][3]
+    following += 1
+  at_end = following == len(boxes)
+  spare = available - len(new_moov)
+  if at_end or spare == 0 or spare >= 8:
+    blob = new_moov + (_free(spare) if spare > 0 and not at_end else b'')
+    def patch(dst):
+      dst.seek(moov_start)
+      dst.write(blob)
+      if at_end:
+        dst.truncate()
+    def cloned(src, dst):
+      if not _clone(src, dst):
+        raise _NoClone()
+      patch(dst)
+    try:
+      _rewrite(path, output if output is not None else path, cloned)
+      log.debug('Wrote metadata into a clone ({:d} bytes of padding left)'.format(spare))
+      return output if output is not None else path
+    except _NoClone:
+      pass
+    if output is None:
+      log.debug('Writing metadata in place ({:d} bytes of padding left)'.format(spare))
+      with open(path, 'r+b') as f:
+        patch(f)
+        f.flush()
+        os.fsync(f.fileno())
+      return path
+  old_end = moov_start + available
+  pad = _free(max(padding, 8)) if padding > 0 else b''
+  delta = len(new_moov) + len(pad) - available
+  while _promote(moov, old_end, delta):
+    log.debug('Chunk offsets no longer fit in 32 bits, switching to co64')
+    delta = len(moov.serialize()) + len(pad) - available
+  _shift_offsets(moov, old_end, delta)
+  new_moov = moov.serialize()
+  log.debug('Rebuilding moov, shifting media by {:d} bytes'.format(delta))
+  def rebuild(src, dst):
+    _copy(src, dst, moov_start)
+    dst.write(new_moov)
+    dst.write(pad)
+    src.seek(old_end)
+    copyfileobj(src, dst, 1 << 20)
+  return _rewrite(path, output if output is not None else path, rebuild)
+
+def _rewrite(path, destination, fill):
+  with open(path, 'rb') as src:
+    with NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(destination)), suffix='.tmp', delete=False) as dst:
+      try:
+        fill(src, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+      except Exception:
+        os.remove(dst.name)
+        raise
+  copymode(path, dst.name)
+  os.rename(dst.name, destination)
+  return destination
+
+def _clone(src, dst):
+  try:
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+  except (IOError, OSError) as e:
+    if e.errno not in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL]:
+      raise
+    return False
+  return True
+
+def _copy(src, dst, length):
+  while length > 0:
+    buf = src.read(min(length, 1 << 20))
+    if not buf:
+      raise Mp4Error('Unexpected end of file')
+    dst.write(buf)
+    length -= len(buf)
@@ -7,23 +7,25 @@ import re
 import os
 import tmdbsimple as tmdb
 import rarfile
-from filecmp import cmp
-from shutil import move
 from datetime import datetime
 from logging import getLogger, LoggerAdapter
-from tvdb_api import Tvdb
-from ffmpeg import FfMpeg, get_file_version
+from ffmpeg import FfMpeg
 from timer import Timer
 from plex import refresh_plex
 from cleaning import Cleaner
+from checkpoint import Checkpoint
+from digest import identical
+from staging import staging_dir, publish
+from rarstream import largest_video, open_member, extract
+from metadata import tmdb_movie, tvdb_show, tvdb_episode, prefetch_movie, prefetch_tv
 from config import config
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from deluge.ui.client import client
 from time import sleep
 from logs import setup_logging
-from tempfile import gettempdir
 from sys import argv
-from psutil import process_iter
+from jobqueue import JobQueue
+from library import Library
 
 def safeify(name):
   safe_name = ' '.join(re.sub(pattern=r'[\\/:"*?<>|…]', repl=' ', string=name).split())
@@ -32,75 +34,34 @@ def safeify(name):
     safe_name = safe_name[:-1]
   return safe_name
 
-temp_skip_list = [
-  '/tank/Plex/Movies/How to Train Your Dragon/How to Train Your Dragon 2 (2014)/How to Train Your Dragon 2 (2014).1080p.mp4',
-  '/tank/Plex/Movies/How to Train Your Dragon/How to Train Your Dragon 2 (2014)/How to Train Your Dragon 2 (2014).720p.mp4',
-  '/tank/Plex/Movies/How to Train Your Dragon/How to Train Your Dragon 2 (2014)/How to Train Your Dragon 2 (2014).480p.mp4',
-  '/tank/Plex/Movies/Harry Potter/Harry Potter and the Goblet of Fire (2005)/Harry Potter and the Goblet of Fire (2005).1080p.mp4',
-  '/tank/Plex/Movies/Harry Potter/Harry Potter and the Goblet of Fire (2005)/Harry Potter and the Goblet of Fire (2005).720p.mp4',
-  '/tank/Plex/Movies/Harry Potter/Harry Potter and the Goblet of Fire (2005)/Harry Potter and the Goblet of Fire (2005).480p.mp4',
-  '/tank/Plex/Movies/The Hunt for Red October (1990)/The Hunt for Red October (1990).1080p.mp4',
-  '/tank/Plex/Movies/The Hunt for Red October (1990)/The Hunt for Red October (1990).720p.mp4',
-  '/tank/Plex/Movies/The Hunt for Red October (1990)/The Hunt for Red October (1990).480p.mp4',
-  '/tank/Plex/Movies/Alien/Aliens (1986)/Aliens (1986).1080p.mp4',
-  '/tank/Plex/Movies/Alien/Aliens (1986)/Aliens (1986).720p.mp4',
-  '/tank/Plex/Movies/Alien/Aliens (1986)/Aliens (1986).480p.mp4',
-  '/tank/Plex/Movies/Stargate (1994)/Stargate (1994).1080p.mp4',
-  '/tank/Plex/Movies/Stargate (1994)/Stargate (1994).720p.mp4',
-  '/tank/Plex/Movies/Stargate (1994)/Stargate (1994).480p.mp4',
-  '/tank/Plex/Movies/Death Proof (2007)/Death Proof (2007).480p.mp4',
-  '/tank/Plex/Movies/Lord of the Rings/The Lord of the Rings The Two Towers (2002)/The Lord of the Rings The Two Towers (2002).1080p.mp4',
-  '/tank/Plex/Movies/Lord of the Rings/The Lord of the Rings The Two Towers (2002)/The Lord of the Rings The Two Towers (2002).720p.mp4',
-  '/tank/Plex/Movies/Lord of the Rings/The Lord of the Rings The Two Towers (2002)/The Lord of the Rings The Two Towers (2002).480p.mp4',
-  '/tank/Plex/Movies/Kill Bill/Kill Bill Vol. 2 (2004)/Kill Bill Vol. 2 (2004).1080p.mp4',
-  '/tank/Plex/Movies/Kill Bill/Kill Bill Vol. 2 (2004)/Kill Bill Vol. 2 (2004).720p.mp4',
-  '/tank/Plex/Movies/Kill Bill/Kill Bill Vol. 2 (2004)/Kill Bill Vol. 2 (2004).480p.mp4'
-]
+def check_exists(filepath, version, library=None):
+  return (library or Library()).check(filepath, version)
 
-def check_exists(filepath, version):
-  if os.path.exists(filepath) and os.path.isfile(filepath):
-    if filepath in temp_skip_list:
-      return 'skip'
-    exists_version = get_file_version(filepath)
-    if exists_version is None:
-      return 'replace'
-    if exists_version['video'] != version['video']:
-      return 'replace'
-    if exists_version['audio'] != version['audio']:
-      # return 'audio'
-      return 'replace'
-    if exists_version['tags'] != version['tags']:
-      # return 'retag'
-      return 'replace'
-    return 'skip'
-  else:
-    return False
+def _backups(filename):
+  return [os.path.join(oldmp4_folder, f) for f in os.listdir(oldmp4_folder) if f == filename or (len(f) == len(filename) + 17 and f.endswith('-' + filename))]
 
 def replace_existing(folder, filename):
   if os.path.exists(os.path.join(folder, filename)) and os.path.isfile(os.path.join(folder, filename)):
     outerlog.debug('Destination file already exists!')
-    if os.path.exists(os.path.join(oldmp4_folder, filename)):
-      outerlog.debug('File already exists in oldmp4')
-      with Timer('Comparing files'):
-        res = cmp(os.path.join(oldmp4_folder, filename), os.path.join(folder, filename))
-      if res:
-        outerlog.debug('Files are identical, deleting Plex copy')
-        os.remove(os.path.join(folder, filename))
-      else:
-        outerlog.debug('Files are different')
-        with Timer('Renameing to timestamped backup in oldmp4'):
-          os.rename(os.path.join(folder, filename), os.path.join(oldmp4_folder, datetime.utcnow().strftime('%Y%m%dT%H%M%SZ-') + filename))
+    with Timer('Comparing files'):
+      duplicates = [b for b in _backups(filename) if identical(b, os.path.join(folder, filename), log=outerlog)]
+    if len(duplicates) > 0:
+      outerlog.debug('Files are identical to {:s}, deleting Plex copy'.format(os.path.basename(duplicates[0])))
+      os.remove(os.path.join(folder, filename))
+    elif os.path.exists(os.path.join(oldmp4_folder, filename)):
+      outerlog.debug('Files are different')
+      with Timer('Renameing to timestamped backup in oldmp4'):
+        os.rename(os.path.join(folder, filename), os.path.join(oldmp4_folder, datetime.utcnow().strftime('%Y%m%dT%H%M%SZ-') + filename))
     else:
       with Timer('Moving to oldmp4'):
         os.rename(os.path.join(folder, filename), os.path.join(oldmp4_folder, filename))
 
-def process_movie(file_path, tmdb_id, collection=None, special_feature_title=None, special_feature_type=None, crop=True, keep_other_audio=True, deint=False, tag_only=False, max_height=720, force_field_order=None, res_in_filename=False):
+def process_movie(file_path, tmdb_id, collection=None, special_feature_title=None, special_feature_type=None, crop=True, keep_other_audio=True, deint=False, tag_only=False, max_height=720, force_field_order=None, res_in_filename=False, progress=None):
   ident = '{:<13s}'.format(os.path.basename(file_path)[:13])
   log = LoggerAdapter(getLogger(), {'identifier': ident})
   if os.path.splitext(file_path)[1].lower() in ['.mkv', '.mp4', '.avi']:
     log.debug('TMDB ID: {:d}'.format(tmdb_id))
-    movie = tmdb.Movies(tmdb_id)
-    response = movie.info()
+    response = tmdb_movie(tmdb_id, log=log)
     title = response['title']
     release = datetime.strptime(response['release_date'], '%Y-%m-%d')
     log.debug('Movie title: {:s}'.format(title))
@@ -112,27 +73,32 @@ def process_movie(file_path, tmdb_id, collection=None, special_feature_title=Non
       destination_folder = os.path.join(plex_movie_section)
     destination_folder = os.path.join(destination_folder, '{:s} ({:d})'.format(title_safe, release.year))
 
-    if res_in_filename and max_height:
-      fn = os.path.join(destination_folder, '{:s} ({:d}).{:d}p.mp4'.format(title_safe, release.year, max_height))
+    if res_in_filename:
+      res = FfMpeg(file_path, ident=ident).resolution(None if tag_only else max_height)
+      fn = os.path.join(destination_folder, '{:s} ({:d}).{:s}.mp4'.format(title_safe, release.year, res))
     else:
       fn = os.path.join(destination_folder, '{:s} ({:d}).mp4'.format(title_safe, release.year))
-    exists = check_exists(fn, FfMpeg.version)
+    library = Library()
+    exists = check_exists(fn, FfMpeg.version, library)
 
     if exists:
       if exists == 'skip':
         log.debug('skipping {:s}'.format(fn))
         return
 
-    with Cleaner('{:s}{:s}'.format(title, ' {:d}p'.format(max_height) if max_height is not None else ''), ident) as c:
+    metadata = prefetch_movie(tmdb_id, log=log)
+    cp = Checkpoint('movie', file_path, {'tmdb_id': tmdb_id, 'collection': collection, 'special_feature_title': special_feature_title, 'special_feature_type': special_feature_type, 'crop': crop, 'keep_other_audio': keep_other_audio, 'deint': deint, 'tag_only': tag_only, 'max_height': max_height, 'force_field_order': force_field_order, 'res_in_filename': res_in_filename}, log=log, work_root=staging_dir(plex_movie_section))
+    with Cleaner('{:s}{:s}'.format(title, ' {:d}p'.format(max_height) if max_height is not None else ''), ident, temp_dir=cp.work_dir, checkpoint=cp) as c:
       target = file_path
       with Timer('Processing', ident) as t:
         with FfMpeg(target, c, ident) as n:
           if not tag_only:
             with Timer('Analyzing', ident):
               n.analyze(allow_crop=crop, keep_other_audio=keep_other_audio, max_height=max_height, deint=deint, force_field_order=force_field_order)
-          height = n.default_video_stream['_scale']['height'] if '_scale' in n.default_video_stream else (n.default_video_stream['_crop']['height'] if '_crop' in n.default_video_stream else (n.default_video_stream['height']))
-          width  = n.default_video_stream['_scale']['width']  if '_scale' in n.default_video_stream else (n.default_video_stream['_crop']['width']  if '_crop' in n.default_video_stream else (n.default_video_stream['width']))
-          res = '1080p' if height > 720 or width > 1280 else ('720p' if height > 480 or width > 854 else '480p')
+            if not cp.reached('analyzed'):
+              cp.record('analyzed')
+          with Timer('Resolving metadata', ident):
+            metadata.join()
           if special_feature_title is not None and special_feature_type is not None:
             destination_filename = '{:s}-{:s}.mp4'.format(special_feature_title,special_feature_type)
           else:
@@ -141,39 +107,136 @@ def process_movie(file_path, tmdb_id, collection=None, special_feature_title=Non
             else:
               destination_filename = '{:s} ({:d}).mp4'.format(title_safe, release.year)
           log.info('Destination path: {:s}'.format(os.path.join(destination_folder, destination_filename)))
-          if not tag_only:
+          if cp.reached('normalized') and not cp.reached('published'):
+            n.resume(cp.artifacts()[0])
+          if not tag_only and not cp.reached('normalized'):
             with Timer('Converting', ident):
-              n.convert_and_normalize()
-          if special_feature_title is None and special_feature_type is None:
-            with Timer('Tagging', ident):
-              n.tag_movie(tmdb_id, collection)
-          with Timer('Verifying faststart', ident):
-            n.faststart()
+              n.convert_and_normalize(progress=progress)
+            cp.record('normalized', n.current_file)
+          if not cp.reached('tagged'):
+            if special_feature_title is None and special_feature_type is None:
+              with Timer('Tagging', ident):
+                n.tag_movie(tmdb_id, collection)
+            cp.record('tagged', n.current_file)
+          if not cp.reached('faststarted'):
+            with Timer('Verifying faststart', ident):
+              n.faststart()
+            cp.record('faststarted', n.current_file)
           out = n.current_file
+          if not cp.reached('published'):
+            if not os.path.exists(destination_folder):
+              os.makedirs(destination_folder)
+            replace_existing(destination_folder, destination_filename)
+      c.timer_pushover(t)
+      if not cp.reached('published'):
+        with Timer('Publishing to Plex', ident):
+          publish(out, os.path.join(destination_folder, destination_filename), log=log)
+        cp.record('published', os.path.join(destination_folder, destination_filename))
+        library.record(os.path.join(destination_folder, destination_filename), 'movie', source=file_path, source_fingerprint=cp.fingerprint, tmdb_id=tmdb_id)
+    log.info('Processing complete')
+    refresh_plex(source_type='movie')
+    cp.clear()
+
+def process_movie_ladder(file_path, tmdb_id, heights, collection=None, crop=True, keep_other_audio=True, deint=False, force_field_order=None, progress=None):
+  ident = '{:<13s}'.format(os.path.basename(file_path)[:13])
+  log = LoggerAdapter(getLogger(), {'identifier': ident})
+  if os.path.splitext(file_path)[1].lower() in ['.mkv', '.mp4', '.avi']:
+    log.debug('TMDB ID: {:d}'.format(tmdb_id))
+    response = tmdb_movie(tmdb_id, log=log)
+    title = response['title']
+    release = datetime.strptime(response['release_date'], '%Y-%m-%d')
+    log.debug('Movie title: {:s}'.format(title))
+    title_safe = safeify(title)
+    log.debug('Safe movie title: {:s}'.format(title_safe))
+    if collection is not None:
+      destination_folder = os.path.join(plex_movie_section, collection)
+    else:
+      destination_folder = os.path.join(plex_movie_section)
+    destination_folder = os.path.join(destination_folder, '{:s} ({:d})'.format(title_safe, release.year))
+
+    library = Library()
+    probe = FfMpeg(file_path, ident=ident)
+    labels = {}
+    pending = []
+    for max_height in sorted(heights, reverse=True):
+      res = probe.resolution(max_height)
+      if res in labels.values():
+        log.debug('{:d}p would duplicate the {:s} rendition, dropping it'.format(max_height, res))
+        continue
+      labels[max_height] = res
+      fn = os.path.join(destination_folder, '{:s} ({:d}).{:s}.mp4'.format(title_safe, release.year, res))
+      if check_exists(fn, FfMpeg.version, library) == 'skip':
+        log.debug('skipping {:s}'.format(fn))
+      else:
+        pending.append(max_height)
+    if len(pending) == 0:
+      return
+
+    metadata = prefetch_movie(tmdb_id, log=log)
+    cp = Checkpoint('movie_ladder', file_path, {'tmdb_id': tmdb_id, 'heights': pending, 'collection': collection, 'crop': crop, 'keep_other_audio': keep_other_audio, 'deint': deint, 'force_field_order': force_field_order}, log=log, work_root=staging_dir(plex_movie_section))
+    with Cleaner('{:s} {:s}'.format(title, '/'.join(['{:d}p'.format(h) for h in pending])), ident, temp_dir=cp.work_dir, checkpoint=cp) as c:
+      with Timer('Processing', ident) as t:
+        if cp.reached('faststarted'):
+          published = [tuple(p) for p in cp.data('faststarted')]
+        else:
+          if cp.reached('normalized'):
+            renditions = cp.data('normalized')
+          else:
+            with FfMpeg(file_path, c, ident) as n:
+              with Timer('Analyzing', ident):
+                n.analyze(allow_crop=crop, keep_other_audio=keep_other_audio, max_height=pending[0], deint=deint, force_field_order=force_field_order)
+              cp.record('analyzed')
+              with Timer('Resolving metadata', ident):
+                metadata.join()
+              with Timer('Converting {:d} renditions'.format(len(pending)), ident):
+                renditions = n.convert_ladder(pending, progress=progress)
+              cp.record('normalized', [r['path'] for r in renditions], data=renditions)
+          metadata.join()
+          published = []
+          for r in renditions:
+            res = labels[r['max_height']]
+            destination_filename = '{:s} ({:d}).{:s}.mp4'.format(title_safe, release.year, res)
+            log.info('Destination path: {:s}'.format(os.path.join(destination_folder, destination_filename)))
+            c.add_path(r['path'])
+            with FfMpeg(r['path'], c, ident) as m:
+              with Timer('Tagging {:s}'.format(res), ident):
+                m.tag_movie(tmdb_id, collection)
+              with Timer('Verifying faststart {:s}'.format(res), ident):
+                m.faststart()
+              published.append((m.current_file, destination_filename))
+          cp.record('faststarted', [out for out, _ in published], data=published)
+        if not cp.reached('published'):
           if not os.path.exists(destination_folder):
             os.makedirs(destination_folder)
-          replace_existing(destination_folder, destination_filename)
+          for out, destination_filename in published:
+            c.add_path(out)
+            replace_existing(destination_folder, destination_filename)
       c.timer_pushover(t)
-      with Timer('Moving to Plex', ident):
-        move(out, os.path.join(destination_folder, destination_filename))
+      if not cp.reached('published'):
+        with Timer('Publishing to Plex', ident):
+          for out, destination_filename in published:
+            publish(out, os.path.join(destination_folder, destination_filename), log=log)
+        cp.record('published', [os.path.join(destination_folder, destination_filename) for _, destination_filename in published])
+        for _, destination_filename in published:
+          library.record(os.path.join(destination_folder, destination_filename), 'movie', source=file_path, source_fingerprint=cp.fingerprint, tmdb_id=tmdb_id)
     log.info('Processing complete')
     refresh_plex(source_type='movie')
+    cp.clear()
 
-def process_tv(file_path, show_id, season_number, episode_number, crop=False, max_height=720.0, keep_other_audio=False, deint=False, force_field_order=None, tag_only=False, add_filters=None):
+def process_tv(file_path, show_id, season_number, episode_number, crop=False, max_height=720.0, keep_other_audio=False, deint=False, force_field_order=None, tag_only=False, add_filters=None, rar_member=None, progress=None):
   ident = '{:06d}:{:02d}:{:03d}'.format(show_id, season_number, episode_number)
   log = LoggerAdapter(getLogger(), {'identifier': ident})
-  if os.path.splitext(file_path)[1].lower() in ['.mkv', '.mp4', '.avi']:
+  if os.path.splitext(rar_member if rar_member is not None else file_path)[1].lower() in ['.mkv', '.mp4', '.avi']:
     log.debug('Show ID: {:d}, Season: {:d}, Episode: {:d}'.format(show_id, season_number, episode_number))
-    tvdb = Tvdb(apikey=config['tvdb'], language='en', banners=True, actors=True)
-    show = tvdb[show_id]
-    show_name = show['seriesname']
+    show_name = tvdb_show(show_id, log=log)['seriesname']
     log.debug('Show name: {:s}'.format(show_name))
     show_name_safe = safeify(show_name)
     log.debug('Safe show name: {:s}'.format(show_name_safe))
-    with Cleaner('{:s} S{:02d}E{:02d}'.format(show_name_safe, season_number, episode_number), ident) as c:
-      season = show[season_number]
-      episode = season[episode_number]
-      episode_name = episode['episodename']
+    metadata = prefetch_tv(show_id, season_number, episode_number, log=log)
+    library = Library()
+    cp = Checkpoint('tv', file_path, {'show_id': show_id, 'season_number': season_number, 'episode_number': episode_number, 'crop': crop, 'max_height': max_height, 'keep_other_audio': keep_other_audio, 'deint': deint, 'force_field_order': force_field_order, 'tag_only': tag_only, 'add_filters': add_filters, 'rar_member': rar_member}, log=log, work_root=staging_dir(plex_tv_section))
+    with Cleaner('{:s} S{:02d}E{:02d}'.format(show_name_safe, season_number, episode_number), ident, temp_dir=cp.work_dir, checkpoint=cp) as c:
+      episode_name = tvdb_episode(show_id, season_number, episode_number, log=log)['episodename']
       if episode_name is None:
         episode_name = ''
       log.debug('Episode name: {:s}'.format(episode_name))
@@ -182,31 +245,50 @@ def process_tv(file_path, show_id, season_number, episode_number, crop=False, ma
       destination_folder = os.path.join(plex_tv_section, show_name_safe, 'Specials' if season_number == 0 else 'Season {:d}'.format(season_number))
       destination_filename = '{:s} - S{:02d}E{:02d} - {:s}.mp4'.format(show_name_safe, season_number, episode_number, episode_name_safe)
       log.info('Destination path: {:s}'.format(os.path.join(destination_folder, destination_filename)))
-      if not os.path.exists(destination_folder):
-        os.makedirs(destination_folder)
-      replace_existing(destination_folder, destination_filename)
-      target = file_path
-      with Timer('Processing', ident) as t:
-        with FfMpeg(target, c, ident) as n:
-          if not tag_only:
-            with Timer('Analyzing', ident):
-              n.analyze(allow_crop=crop, keep_other_audio=keep_other_audio, max_height=max_height, deint=deint, force_field_order=force_field_order)
-            with Timer('Converting', ident):
-              n.convert_and_normalize(add_filters=add_filters)
-          with Timer('Tagging', ident):
-            n.tag_tv(show_id, season_number, episode_number)
-          with Timer('Verifying faststart', ident):
-            n.faststart()
-          out = n.current_file
-      c.timer_pushover(t)
-      with Timer('Moving to Plex', ident):
-        move(out, os.path.join(destination_folder, destination_filename))
+      if not cp.reached('published'):
+        if not os.path.exists(destination_folder):
+          os.makedirs(destination_folder)
+        replace_existing(destination_folder, destination_filename)
+        target = file_path
+        if rar_member is not None and not cp.reached('normalized'):
+          target = open_member(file_path, rar_member, log=log)
+          if target is None:
+            with Timer('Extracting', ident):
+              target = extract(file_path, rar_member, cp.work_dir)
+            c.add_path(target)
+        with Timer('Processing', ident) as t:
+          with FfMpeg(target, c, ident) as n:
+            if cp.reached('normalized'):
+              n.resume(cp.artifacts()[0])
+            if not tag_only and not cp.reached('normalized'):
+              with Timer('Analyzing', ident):
+                n.analyze(allow_crop=crop, keep_other_audio=keep_other_audio, max_height=max_height, deint=deint, force_field_order=force_field_order)
+              cp.record('analyzed')
+              with Timer('Resolving metadata', ident):
+                metadata.join()
+              with Timer('Converting', ident):
+                n.convert_and_normalize(add_filters=add_filters, progress=progress)
+              cp.record('normalized', n.current_file)
+            if not cp.reached('tagged'):
+              metadata.join()
+              with Timer('Tagging', ident):
+                n.tag_tv(show_id, season_number, episode_number)
+              cp.record('tagged', n.current_file)
+            if not cp.reached('faststarted'):
+              with Timer('Verifying faststart', ident):
+                n.faststart()
+              cp.record('faststarted', n.current_file)
+            out = n.current_file
+        c.timer_pushover(t)
+        with Timer('Publishing to Plex', ident):
+          publish(out, os.path.join(destination_folder, destination_filename), log=log)
+        cp.record('published', os.path.join(destination_folder, destination_filename))
+        library.record(os.path.join(destination_folder, destination_filename), 'tv', source=file_path, source_fingerprint=cp.fingerprint, tvdb_id=show_id, season=season_number, episode=episode_number)
     log.info('Processing complete')
     refresh_plex(source_type='show')
+    cp.clear()
 
 def cleanup():
-  for f in temp_files:
-    os.remove(f)
   client.disconnect()
   reactor.stop()
 
@@ -219,13 +301,6 @@ def on_remove_torrent(success):
   cleanup()
   return
 
-def ffmpeg_count():
-  ffmpegs = 0
-  for process in process_iter():
-    if process.name() == 'ffmpeg':
-      ffmpegs += 1
-  return ffmpegs
-
 def on_get_status(torrent):
   if 'label' in torrent:
     label = torrent['label']
@@ -246,12 +321,9 @@ def on_get_status(torrent):
         for f in [f for f in torrent_files if f['path'][-3:].lower() == 'rar']:
           with Timer('Reading rar file', ident):
             rar = rarfile.RarFile(os.path.join(torrent_folder, f['path']))
-          video_files_in_rar = sorted([rf for rf in rar.infolist() if rf.filename[-3:].lower() in ['mkv', 'mp4', 'avi']], key=lambda r: r.file_size, reverse=True)
-          with Timer('Extracting', ident):
-            rar.extract(video_files_in_rar[0], temp_folder)
-          temp_files.append(os.path.join(temp_folder, video_files_in_rar[0].filename))
-          targets.append({'path': os.path.join(temp_folder, video_files_in_rar[0].filename), 'size': video_files_in_rar[0].file_size})
-          log.debug('Added {:s} to targets list'.format(os.path.basename(video_files_in_rar[0].filename)))
+          video_in_rar = largest_video(rar)
+          targets.append({'path': f['path'], 'size': video_in_rar.file_size, 'rar_member': video_in_rar.filename})
+          log.debug('Added {:s} to targets list'.format(os.path.basename(video_in_rar.filename)))
           rar.close()
       elif len([f for f in torrent_files if f['path'][-3:].lower() in ['mkv', 'mp4', 'avi']]) > 0:
         log.debug('Video file detected')
@@ -263,15 +335,21 @@ def on_get_status(torrent):
         cleanup()
         return
       target = sorted([t for t in targets], key=lambda d: d['size'], reverse=True)[0]
-      ffmpegs = ffmpeg_count()
-      if ffmpegs > 2:
-        log.info('Waiting for other processes to finish')
-        while ffmpegs > 2:
-          sleep(60)
-          ffmpegs = ffmpeg_count()
-        log.debug('Done waiting')
-      process_tv(os.path.join(torrent_folder, target['path']), show_id, season_number, episode_number, max_height=None)
-      client.core.remove_torrent(torrentId, remove_data=True).addCallback(on_remove_torrent)
+      q = JobQueue()
+      job_id = q.submit('tv', {'file_path': os.path.join(torrent_folder, target['path']),
+                               'show_id': show_id,
+                               'season_number': season_number,
+                               'episode_number': episode_number,
+                               'max_height': None,
+                               'rar_member': target.get('rar_member')})
+      if not q.daemon_running():
+        log.error('No job queue daemon is running, job {:d} stays queued and the torrent is kept'.format(job_id))
+        cleanup()
+        return
+      log.info('Queued as job {:d}, waiting for it to finish'.format(job_id))
+      d = threads.deferToThread(wait_for_job, job_id)
+      d.addCallback(on_job_finished, log)
+      d.addErrback(on_wait_failed, log)
     else:
       outerlog.debug('Label \'{:s}\' not recognized'.format(label))
       cleanup()
@@ -279,6 +357,24 @@ def on_get_status(torrent):
     outerlog.debug('Torrent is not labeled')
     cleanup()
 
+def wait_for_job(job_id):
+  # Runs in a reactor thread, so it needs its own connection to the queue
+  return JobQueue().wait(job_id, timeout=finished_wait, daemon=True)
+
+def on_job_finished(job, log):
+  if job['state'] == 'done':
+    client.core.remove_torrent(torrentId, remove_data=True).addCallback(on_remove_torrent)
+  elif job['state'] == 'failed':
+    log.error('Job {:d} failed, keeping torrent'.format(job['id']))
+    cleanup()
+  else:
+    log.error('Job {:d} is still {:s}, giving up waiting and keeping torrent'.format(job['id'], job['state']))
+    cleanup()
+
+def on_wait_failed(result, log):
+  log.error('Failed waiting for job = {}'.format(repr(result)))
+  cleanup()
+
 def on_get_status_failed(result):
   outerlog.error('Failed to get torrent status = {}'.format(repr(result)))
   cleanup()
@@ -300,12 +396,11 @@ tmdb.API_KEY = config['tmdb']
 plex_tv_section = config['plex_tv_section']
 oldmp4_folder = config['oldmp4_folder']
 plex_movie_section = config['plex_movie_section']
+finished_wait = config.get('finished_wait', 12 * 3600)
 rarfile.NEED_COMMENTS = 0
-temp_folder = gettempdir()
 outerlog = getLogger()
 
 if __name__ == '__main__':
-  temp_files = []
   torrentId = argv[1]
   setup_logging(os.path.join(config['log_path'], 'finished'))
   outerlog = getLogger()
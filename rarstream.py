@@ -0,0 +1,134 @@
+from __future__ import unicode_literals
+import os
+import re
+import rarfile
+from logging import getLogger
+
+video_extensions = ['.mkv', '.mp4', '.avi']
+rsegment = re.compile(r'^subfile,,start,(?P<start>\d+),end,(?P<end>\d+),,:(?P<path>.+)$')
+
+def is_url(path):
+  return path.startswith('concat:') or path.startswith('subfile,')
+
+def largest_video(rar):
+  videos = [rf for rf in rar.infolist() if os.path.splitext(rf.filename)[1].lower() in video_extensions]
+  if len(videos) == 0:
+    return None
+  return sorted(videos, key=lambda r: r.file_size, reverse=True)[0]
+
+def is_stored(info):
+  return info.compress_type == rarfile.RAR_M0 and not info.needs_password()
+
+def _segments(archive, member):
+  parts = []
+  def collect(h):
+    if getattr(h, 'filename', None) == member and getattr(h, 'add_size', 0) > 0:
+      parts.append((h.volume_file, h.data_offset, h.add_size))
+  rar = rarfile.RarFile(os.path.abspath(archive), info_callback=collect)
+  try:
+    info = rar.getinfo(member)
+  finally:
+    rar.close()
+  if not is_stored(info) or sum(p[2] for p in parts) != info.file_size:
+    return None
+  if any('|' in path or ',,:' in path for path, _, _ in parts):
+    return None
+  return parts
+
+def _url(segments):
+  urls = ['subfile,,start,{:d},end,{:d},,:{:s}'.format(start, start + length, path) for path, start, length in segments]
+  if len(urls) == 1:
+    return urls[0]
+  return 'concat:' + '|'.join(urls)
+
+def from_url(url, name=None):
+  if url.startswith('concat:'):
+    url = url[len('concat:'):]
+  segments = []
+  for part in url.split('|'):
+    m = rsegment.match(part)
+    if m is None:
+      raise ValueError('Not a RAR stream URL: {:s}'.format(part))
+    segments.append((m.group('path'), int(m.group('start')), int(m.group('end')) - int(m.group('start'))))
+  return RarStream(segments, name)
+
+class RarStream(object):
+  def __init__(self, segments, name=None):
+    self.segments = segments
+    self.name = name if name is not None else os.path.basename(segments[0][0])
+    self.size = sum(length for _, _, length in segments)
+    self.mtime = max(os.stat(path).st_mtime for path, _, _ in segments)
+    self.url = _url(segments)
+    self._pos = 0
+    self._fd = None
+    self._fd_path = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+    return False
+
+  def _locate(self, pos):
+    base = 0
+    for path, start, length in self.segments:
+      if pos < base + length:
+        return path, start + pos - base, base + length - pos
+      base += length
+    return None, 0, 0
+
+  def read(self, size=-1):
+    if size < 0:
+      size = self.size - self._pos
+    chunks = []
+    while size > 0:
+      path, offset, available = self._locate(self._pos)
+      if path is None:
+        break
+      if path != self._fd_path:
+        self.close()
+        self._fd = open(path, 'rb')
+        self._fd_path = path
+      self._fd.seek(offset)
+      data = self._fd.read(min(size, available))
+      if not data:
+        break
+      chunks.append(data)
+      self._pos += len(data)
+      size -= len(data)
+    return b''.join(chunks)
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._pos
+    elif whence == os.SEEK_END:
+      offset += self.size
+    self._pos = max(0, offset)
+    return self._pos
+
+  def tell(self):
+    return self._pos
+
+  def close(self):
+    if self._fd is not None:
+      self._fd.close()
+      self._fd = None
+      self._fd_path = None
+
+def open_member(archive, member, log=None):
+  log = log if log is not None else getLogger()
+  segments = _segments(archive, member)
+  if segments is None:
+    log.debug('{:s} is compressed, it will have to be extracted'.format(member))
+    return None
+  log.debug('Streaming {:s} from {:d} volumes'.format(member, len(segments)))
+  return RarStream(segments, os.path.basename(member))
+
+def extract(archive, member, folder):
+  rar = rarfile.RarFile(archive)
+  try:
+    rar.extract(member, folder)
+  finally:
+    rar.close()
+  return os.path.join(folder, member)
@@ -0,0 +1,196 @@
+from __future__ import unicode_literals
+import io
+import os
+import re
+import sys
+import threading
+from collections import deque
+from subprocess import Popen, PIPE
+from logging import getLogger
+
+_line_break = re.compile(b'[\r\n]')
+
+# Held while spawning, so pipe ends meant for one child never leak into another
+spawn_lock = threading.RLock()
+
+class Runner(object):
+  def __init__(self, cmd, log=None, tail=200, stdout=None, pass_fds=(), max_line=1 << 20):
+    self.commands = []
+    current = []
+    for c in cmd:
+      if c == '|':
+        self.commands.append(current)
+        current = []
+      else:
+        current.append(c)
+    self.commands.append(current)
+    self.log = log if log is not None else getLogger()
+    self.tail_lines = deque(maxlen=tail)
+    self.stdout_mode = stdout
+    self.pass_fds = tuple(pass_fds)
+    self.max_line = max_line
+    self.processes = []
+    self.stdout = None
+    self.returncode = None
+    self.terminated = False
+    self._parsers = {'stdout': [], 'stderr': []}
+    self._captured = []
+    self._threads = []
+    self._lock = threading.Lock()
+    self._devnull = None
+
+  def on(self, pattern, callback, stream='stderr'):
+    if not hasattr(pattern, 'search'):
+      pattern = re.compile(pattern)
+    self._parsers[stream].append((pattern, callback))
+    return self
+
+  def _fd_options(self):
+    if len(self.pass_fds) == 0:
+      return {'close_fds': True}
+    if sys.version_info[0] >= 3:
+      return {'close_fds': True, 'pass_fds': self.pass_fds}
+    return {'close_fds': False}
+
+  def start(self):
+    with spawn_lock:
+      return self._start()
+
+  def _start(self):
+    previous = None
+    for n, cmd in enumerate(self.commands):
+      last = n == len(self.commands) - 1
+      if last and self.stdout_mode is None:
+        if self._devnull is None:
+          self._devnull = open(os.devnull, 'wb')
+        stdout = self._devnull
+      else:
+        stdout = PIPE
+      p = Popen(cmd, stdin=previous.stdout if previous is not None else None, stdout=stdout, stderr=PIPE, **self._fd_options())
+      if previous is not None:
+        previous.stdout.close()
+      self.processes.append(p)
+      self._drain(p.stderr, 'stderr', last)
+      previous = p
+    if self.stdout_mode in ['lines', 'capture']:
+      self._drain(previous.stdout, 'stdout', True)
+    elif self.stdout_mode == 'raw':
+      self.stdout = previous.stdout
+    return self
+
+  def _drain(self, pipe, stream, parse):
+    t = threading.Thread(target=self._read, args=(pipe, stream, parse))
+    t.daemon = True
+    t.start()
+    self._threads.append(t)
+
+  def _read(self, pipe, stream, parse):
+    fd = pipe.fileno()
+    pending = b''
+    while True:
+      chunk = os.read(fd, 65536)
+      if not chunk:
+        break
+      if stream == 'stdout' and self.stdout_mode == 'capture':
+        self._captured.append(chunk)
+        continue
+      parts = _line_break.split(pending + chunk)
+      pending = parts.pop()
+      if len(pending) > self.max_line:
+        parts.append(pending)
+        pending = b''
+      for part in parts:
+        if part:
+          self._line(part.decode('latin-1'), stream, parse)
+    if pending:
+      self._line(pending.decode('latin-1'), stream, parse)
+    pipe.close()
+
+  def _line(self, line, stream, parse):
+    with self._lock:
+      if stream == 'stderr':
+        self.tail_lines.append(line)
+      if parse:
+        for pattern, callback in self._parsers[stream]:
+          m = pattern.search(line)
+          if m:
+            callback(m)
+
+  def terminate(self):
+    self.terminated = True
+    for p in self.processes:
+      if p.poll() is None:
+        p.terminate()
+
+  def wait(self):
+    codes = [p.wait() for p in self.processes]
+    for t in self._threads:
+      t.join()
+    if self.stdout is not None:
+      self.stdout.close()
+    if self._devnull is not None:
+      self._devnull.close()
+    self.returncode = codes[-1]
+    if self.returncode == 0:
+      self.returncode = next((c for c in codes if c != 0), 0)
+    return self.returncode
+
+  def run(self):
+    self.start()
+    return self.wait()
+
+  @property
+  def output(self):
+    return b''.join(self._captured)
+
+  @property
+  def tail(self):
+    return '\n'.join(self.tail_lines)
+
+  def write_faillog(self, path='faillog.log'):
+    with io.open(path, 'w', encoding='utf-8') as f:
+      f.write(self.tail)
+
+class Progress(object):
+  def __init__(self, duration=None):
+    self.duration = duration
+    self.frame = 0
+    self.fps = 0.0
+    self.out_time = 0.0
+    self.speed = None
+    self.eta = None
+    self.done = False
+
+  @property
+  def fraction(self):
+    if not self.duration:
+      return None
+    return min(1.0, self.out_time / self.duration)
+
+  def update(self, values):
+    if 'frame' in values:
+      self.frame = int(values['frame'])
+    if 'fps' in values:
+      self.fps = float(values['fps'])
+    if 'out_time_us' in values and values['out_time_us'].lstrip('-').isdigit():
+      self.out_time = max(0.0, int(values['out_time_us']) / 1000000.0)
+    elif 'out_time' in values and ':' in values['out_time']:
+      h, m, s = values['out_time'].lstrip('-').split(':')
+      self.out_time = int(h) * 3600 + int(m) * 60 + float(s)
+    if 'speed' in values and values['speed'].rstrip('x').replace('.', '', 1).isdigit():
+      self.speed = float(values['speed'].rstrip('x'))
+    if self.duration and self.speed:
+      self.eta = max(0.0, (self.duration - self.out_time) / self.speed)
+    self.done = values.get('progress') == 'end'
+    return self
+
+def watch_progress(runner, callback, duration=None):
+  progress = Progress(duration)
+  values = {}
+  def on_value(m):
+    values[m.group('key')] = m.group('value').strip()
+    if m.group('key') == 'progress':
+      callback(progress.update(values))
+      values.clear()
+  runner.on(r'^(?P<key>[a-z_0-9]+)=(?P<value>.*)$', on_value, stream='stdout')
+  return progress
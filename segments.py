@@ -0,0 +1,156 @@
+from __future__ import unicode_literals
+from __future__ import division
+import io
+import os
+import shutil
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from logging import getLogger
+from runner import Runner, Progress, watch_progress
+from cache import fingerprint, make_key
+from jobqueue import queue_slots
+from config import config
+
+segment_seconds = config.get('segment_seconds', 120)
+segment_threads = config.get('segment_threads', 2)
+segment_workers = config.get('segment_workers', max(1, multiprocessing.cpu_count() // (segment_threads * queue_slots)))
+
+def keyframes(filepath, stream_index, start_time=0.0):
+  cmd = ['ffprobe', '-v', 'error', '-select_streams', '{:d}'.format(stream_index),
+         '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', filepath]
+  r = Runner(cmd, stdout='capture')
+  rc = r.run()
+  if rc != 0:
+    raise IOError('Keyframe scan failed with exit code {:d}'.format(rc))
+  times = set()
+  for line in r.output.decode('utf-8').splitlines():
+    parts = line.strip().split(',')
+    if len(parts) >= 2 and 'K' in parts[1] and parts[0] not in ['', 'N/A']:
+      times.add(float(parts[0]) - start_time)
+  return sorted(times)
+
+def plan(keyframe_times, duration, length=None):
+  length = length or segment_seconds
+  bounds = [0.0]
+  for t in keyframe_times:
+    if t - bounds[-1] >= length and duration - t >= length / 2:
+      bounds.append(t)
+  return [(start, bounds[n + 1] if n + 1 < len(bounds) else None) for n, start in enumerate(bounds)]
+
+def _quote(path):
+  return "'{:s}'".format(path.replace("'", "'\\''"))
+
+class SegmentedEncode(object):
+  def __init__(self, filepath, stream_index, duration, filters, video_args, work_dir, basename, start_time=0.0, log=None):
+    self.filepath = filepath
+    self.stream_index = stream_index
+    self.duration = duration
+    self.filters = filters
+    self.video_args = video_args
+    self.start_time = start_time
+    self.log = log if log is not None else getLogger()
+    self.segments = plan(keyframes(filepath, stream_index, start_time), duration)
+    key = make_key(fingerprint(filepath), stream_index, filters, video_args, self.segments)
+    self.folder = os.path.join(work_dir, '{:s}.segments-{:s}'.format(basename, key[:12]))
+    self.list_file = os.path.join(self.folder, 'segments.txt')
+    self._lock = threading.Lock()
+    self._failed = threading.Event()
+    self._runners = {}
+    self._done = {}
+    self._progress = Progress(duration)
+
+  def path(self, n):
+    return os.path.join(self.folder, '{:05d}.mp4'.format(n))
+
+  def _length(self, n):
+    start, end = self.segments[n]
+    return (end if end is not None else self.duration) - start
+
+  def _report(self, n, p, progress):
+    with self._lock:
+      self._done[n] = (p.out_time, 0.0, 0.0) if p.done else (p.out_time, p.fps, p.speed or 0.0)
+      self._progress.out_time = sum(v[0] for v in self._done.values())
+      self._progress.fps = sum(v[1] for v in self._done.values())
+      self._progress.speed = sum(v[2] for v in self._done.values())
+      if self._progress.speed:
+        self._progress.eta = max(0.0, (self.duration - self._progress.out_time) / self._progress.speed)
+      if progress is not None:
+        progress(self._progress)
+
+  def _encode(self, n, progress=None):
+    start, end = self.segments[n]
+    temp = self.path(n) + '.part'
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-y', '-progress', 'pipe:1']
+    if start > 0:
+      cmd.extend(['-ss', '{:.6f}'.format(start)])
+    cmd.extend(['-i', self.filepath])
+    if end is not None:
+      cmd.extend(['-t', '{:.6f}'.format(end - start)])
+    cmd.extend(['-map', '0:{:d}'.format(self.stream_index), '-an', '-sn', '-dn'])
+    if self.filters:
+      cmd.extend(['-filter:v:0', self.filters])
+    cmd.extend(self.video_args)
+    cmd.extend(['-threads', '{:d}'.format(segment_threads), '-f', 'mp4', temp])
+    r = Runner(cmd, log=self.log, stdout='lines')
+    watch_progress(r, lambda p: self._report(n, p, progress), self._length(n))
+    with self._lock:
+      if self._failed.is_set():
+        return
+      self._runners[n] = r.start()
+    rc = r.wait()
+    with self._lock:
+      del self._runners[n]
+    if rc != 0:
+      if os.path.exists(temp):
+        os.remove(temp)
+      if not r.terminated:
+        r.write_faillog()
+      raise IOError('Segment {:d} failed with exit code {:d}'.format(n, rc))
+    os.rename(temp, self.path(n))
+
+  def _run_one(self, args):
+    n, progress = args
+    if self._failed.is_set():
+      return n, None
+    try:
+      self._encode(n, progress)
+      return n, None
+    except Exception as e:
+      with self._lock:
+        first = not self._failed.is_set()
+        self._failed.set()
+        for r in self._runners.values():
+          r.terminate()
+      return n, e if first else None
+
+  def run(self, workers=None, progress=None):
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+    pending = [n for n in range(len(self.segments)) if not os.path.exists(self.path(n))]
+    for n in range(len(self.segments)):
+      if n not in pending:
+        self._done[n] = (self._length(n), 0.0, 0.0)
+    if len(pending) < len(self.segments):
+      self.log.info('Resuming segmented encode, {:d} of {:d} segments already done'.format(len(self.segments) - len(pending), len(self.segments)))
+    else:
+      self.log.info('Encoding {:d} segments'.format(len(self.segments)))
+    self._failed.clear()
+    pool = ThreadPool(min(workers or segment_workers, max(1, len(pending))))
+    try:
+      errors = [e for n, e in pool.imap_unordered(self._run_one, [(n, progress) for n in pending]) if e is not None]
+    finally:
+      pool.close()
+      pool.join()
+    if len(errors) > 0:
+      raise errors[0]
+    with io.open(self.list_file, 'w', encoding='utf-8') as f:
+      f.write('ffconcat version 1.0\n')
+      for n in range(len(self.segments)):
+        f.write('file {:s}\n'.format(_quote(self.path(n))))
+        if self.segments[n][1] is not None:
+          f.write('duration {:.6f}\n'.format(self._length(n)))
+    return self.list_file
+
+  def clear(self):
+    shutil.rmtree(self.folder, ignore_errors=True)
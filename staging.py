@@ -0,0 +1,44 @@
+from __future__ import unicode_literals
+import os
+import shutil
+from logging import getLogger
+from config import config
+
+staging_path = config.get('staging_path', None)
+staging_name = config.get('staging_name', '.convert-staging')
+
+def _fsync(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def _existing(path):
+  path = os.path.abspath(path)
+  while not os.path.exists(path):
+    path = os.path.dirname(path)
+  return path
+
+def staging_dir(section):
+  if staging_path is not None:
+    return staging_path
+  return os.path.join(section, staging_name)
+
+def same_device(a, b):
+  return os.stat(_existing(a)).st_dev == os.stat(_existing(b)).st_dev
+
+def publish(source, destination, log=None):
+  log = log if log is not None else getLogger()
+  folder = os.path.dirname(destination)
+  if not same_device(source, folder):
+    log.warning('{:s} is not on the same filesystem as {:s}, copying'.format(source, folder))
+    partial = os.path.join(folder, '.{:s}.partial'.format(os.path.basename(destination)))
+    shutil.copyfile(source, partial)
+    shutil.copystat(source, partial)
+    os.remove(source)
+    source = partial
+  _fsync(source)
+  os.rename(source, destination)
+  _fsync(folder)
+  log.debug('Published {:s}'.format(destination))
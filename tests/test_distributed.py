@@ -0,0 +1,168 @@
+from __future__ import unicode_literals
+import io
+import os
+import socket
+import tempfile
+import threading
+import multiprocessing
+from time import time, sleep
+import pytest
+import checkpoint
+import jobqueue
+import distributed
+
+class _Progress(object):
+  fraction = 0.5
+  fps = 24.0
+  speed = 2.0
+  eta = 1.0
+
+def stub(file_path, progress=None):
+  with io.open(file_path, 'a', encoding='utf-8') as f:
+    f.write('{:d}\n'.format(os.getpid()))
+  progress(_Progress())
+  sleep(1.5)
+
+def slow(file_path, progress=None):
+  sleep(30)
+
+jobqueue.handlers['stub'] = 'test_distributed:stub'
+jobqueue.handlers['slow'] = 'test_distributed:slow'
+checkpoint.checkpoint_root = tempfile.mkdtemp()
+jobqueue.queue_backoff = 0.2
+distributed.worker_heartbeat = 0.2
+distributed.worker_timeout = 5
+distributed.worker_reconnect = 1
+distributed.worker_progress_interval = 0
+
+@pytest.fixture
+def coordinator(tmpdir):
+  c = distributed.Coordinator(str(tmpdir.join('queue.sqlite')), host='127.0.0.1', port=0, token='secret', timeout=2)
+  t = threading.Thread(target=c.run)
+  t.daemon = True
+  t.start()
+  yield c
+  c.shutdown()
+  t.join()
+
+def _workers(c, count):
+  workers = [multiprocessing.Process(target=distributed.Worker('127.0.0.1', c.address[1], name='w{:d}'.format(n), token='secret').run) for n in range(count)]
+  for w in workers:
+    w.start()
+  return workers
+
+def _wait(q, job_id, seconds):
+  deadline = time() + seconds
+  while time() < deadline:
+    job = q.get(job_id)
+    if job['state'] in ['done', 'failed']:
+      return job
+    sleep(0.05)
+  raise AssertionError('Job {:d} did not finish'.format(job_id))
+
+def test_jobs_run_once_and_report_progress(coordinator, tmpdir):
+  q = jobqueue.JobQueue(coordinator.path, backoff=0.2)
+  ids = [q.submit('stub', {'file_path': str(tmpdir.join('f{:d}'.format(n)))}) for n in range(4)]
+  workers = _workers(coordinator, 2)
+  try:
+    seen = set()
+    relayed = set()
+    deadline = time() + 30
+    while time() < deadline and any(q.get(i)['state'] != 'done' for i in ids):
+      relayed.update(i for i, p in coordinator.status().items() if p['fraction'] == 0.5)
+      seen.update(distributed.status('127.0.0.1', coordinator.address[1], token='secret'))
+      sleep(0.05)
+  finally:
+    for w in workers:
+      w.terminate()
+      w.join()
+  for n, job_id in enumerate(ids):
+    job = q.get(job_id)
+    assert job['state'] == 'done'
+    assert job['attempts'] == 1
+    assert job['worker'].startswith('tcp:w')
+    with io.open(str(tmpdir.join('f{:d}'.format(n))), encoding='utf-8') as f:
+      assert len(f.read().splitlines()) == 1
+  assert relayed == set(ids)
+  assert seen <= set(ids) and len(seen) > 0
+  assert len(set(q.get(i)['worker'] for i in ids)) == 2
+  assert coordinator.status() == {}
+
+def _hello(c, token, name='silent'):
+  s = socket.create_connection(c.address)
+  f = s.makefile('rwb')
+  distributed._send(f, {'op': 'hello', 'worker': name, 'token': token})
+  return s, f, distributed._recv(f)
+
+def test_bad_token_is_rejected(coordinator):
+  s, f, reply = _hello(coordinator, 'wrong')
+  assert reply['op'] == 'error'
+  distributed._send(f, {'op': 'claim'})
+  assert distributed._recv(f) is None
+  f.close()
+  s.close()
+
+def test_foreign_jobs_cannot_be_finished(coordinator):
+  q = jobqueue.JobQueue(coordinator.path)
+  job_id = q.submit('stub', {'file_path': 'x'})
+  s, f, reply = _hello(coordinator, 'secret')
+  assert reply['op'] == 'ok'
+  distributed._send(f, {'op': 'done', 'id': job_id})
+  assert distributed._recv(f)['op'] == 'error'
+  assert q.get(job_id)['state'] == 'queued'
+  f.close()
+  s.close()
+
+def test_silent_worker_loses_its_job(coordinator, tmpdir):
+  q = jobqueue.JobQueue(coordinator.path, backoff=0.2)
+  job_id = q.submit('stub', {'file_path': str(tmpdir.join('f'))})
+  s, f, reply = _hello(coordinator, 'secret')
+  distributed._send(f, {'op': 'claim'})
+  assert distributed._recv(f)['id'] == job_id
+  workers = _workers(coordinator, 1)
+  try:
+    job = _wait(q, job_id, 30)
+  finally:
+    for w in workers:
+      w.terminate()
+      w.join()
+    f.close()
+    s.close()
+  assert job['state'] == 'done'
+  assert job['attempts'] == 2
+  assert job['worker'] == 'tcp:w0'
+
+def test_worker_aborts_job_when_coordinator_goes_away(tmpdir):
+  listener = socket.socket()
+  listener.bind(('127.0.0.1', 0))
+  listener.listen(1)
+  marker = str(tmpdir.join('pid'))
+  w = multiprocessing.Process(target=distributed.Worker('127.0.0.1', listener.getsockname()[1], name='w').run)
+  w.start()
+  try:
+    conn, _ = listener.accept()
+    f = conn.makefile('rwb')
+    assert distributed._recv(f)['op'] == 'hello'
+    distributed._send(f, {'op': 'ok'})
+    assert distributed._recv(f)['op'] == 'claim'
+    distributed._send(f, {'op': 'job', 'id': 1, 'kind': 'slow', 'args': {'file_path': marker}})
+    assert distributed._recv(f)['op'] == 'heartbeat'
+    children = [int(p) for p in os.listdir('/proc') if p.isdigit() and _parent(p) == w.pid]
+    assert len(children) == 1
+    f.close()
+    conn.close()
+    deadline = time() + 10
+    while time() < deadline and os.path.exists('/proc/{:d}'.format(children[0])) and _parent(str(children[0])) == w.pid:
+      sleep(0.05)
+    assert not os.path.exists('/proc/{:d}'.format(children[0])) or _parent(str(children[0])) != w.pid
+  finally:
+    w.terminate()
+    w.join()
+    listener.close()
+
+def _parent(pid):
+  try:
+    with io.open('/proc/{:s}/stat'.format(pid), encoding='utf-8') as f:
+      return int(f.read().rsplit(')', 1)[1].split()[1])
+  except (IOError, OSError, IndexError, ValueError):
+    return None
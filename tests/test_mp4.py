@@ -0,0 +1,204 @@
+from __future__ import unicode_literals
+import os
+import json
+import struct
+import subprocess
+import pytest
+import mp4
+
+def _which(name):
+  return any(os.access(os.path.join(p, name), os.X_OK) for p in os.environ.get('PATH', '').split(os.pathsep))
+
+needs_ffmpeg = pytest.mark.skipif(not _which('ffmpeg') or not _which('ffprobe'), reason='ffmpeg is not installed')
+needs_atomicparsley = pytest.mark.skipif(not _which('AtomicParsley'), reason='AtomicParsley is not installed')
+
+parsley = {
+  'title': 'Pilot \xa9',
+  'TVShowName': 'Show',
+  'stik': 'TV Show',
+  'TVSeasonNum': 2,
+  'TVEpisodeNum': 5,
+  'contentRating': 'TV-14',
+  'information': 'zzzzFFVer1.2.3'
+}
+
+def _moov_box(offsets):
+  stco = mp4._box(b'stco', struct.pack('>II', 0, len(offsets)) + struct.pack('>{:d}I'.format(len(offsets)), *offsets))
+  return mp4._box(b'moov', mp4._box(b'trak', mp4._box(b'mdia', mp4._box(b'minf', mp4._box(b'stbl', stco)))))
+
+def _synthetic(path, chunks, faststart=True, padding=0):
+  ftyp = mp4._box(b'ftyp', b'isom\0\0\0\0isom')
+  free = mp4._free(padding) if padding > 0 else b''
+  mdat = mp4._box(b'mdat', b''.join(chunks))
+  base = len(ftyp) + (len(_moov_box([0] * len(chunks))) + len(free) if faststart else 0) + 8
+  offsets = []
+  for chunk in chunks:
+    offsets.append(base)
+    base += len(chunk)
+  moov = _moov_box(offsets)
+  with open(path, 'wb') as f:
+    f.write(ftyp + (moov + free + mdat if faststart else mdat + moov))
+  return path
+
+def _moov(path):
+  with open(path, 'rb') as f:
+    for name, start, header, size in mp4.top_level(f):
+      if name == b'moov':
+        f.seek(start + header)
+        return mp4.Box(b'moov', children=mp4.parse(f.read(size - header)))
+
+def _chunks(path, lengths):
+  moov = _moov(path)
+  box = [b for b in moov.walk() if b.name in [b'stco', b'co64']][0]
+  count = struct.unpack('>I', box.payload[4:8])[0]
+  width = 'I' if box.name == b'stco' else 'Q'
+  offsets = struct.unpack('>{:d}{:s}'.format(count, width), box.payload[8:])
+  chunks = []
+  with open(path, 'rb') as f:
+    for offset, length in zip(offsets, lengths):
+      f.seek(offset)
+      chunks.append(f.read(length))
+  return chunks
+
+def _tags(path):
+  meta = _moov(path).find(b'udta').find(b'meta')
+  return dict((item.name, mp4.parse(item.payload)[0].payload[8:]) for item in meta.find(b'ilst').children if item.name != b'----')
+
+def _layout(path):
+  with open(path, 'rb') as f:
+    return [(name, start, size) for name, start, _, size in mp4.top_level(f)]
+
+chunks = [os.urandom(n) for n in [1000, 37, 4096, 513]]
+
+def _check(path):
+  assert _chunks(path, [len(c) for c in chunks]) == chunks
+  tags = _tags(path)
+  assert tags[b'\xa9nam'] == 'Pilot \xa9'.encode('utf-8')
+  assert tags[b'tvsh'] == b'Show'
+  assert tags[b'stik'] == struct.pack('>B', 10)
+  assert tags[b'tvsn'] == struct.pack('>I', 2)
+  assert mp4.read_version(path) == {'video': 1, 'audio': 2, 'tags': 3}
+
+def test_rebuild_shifts_chunk_offsets(tmpdir):
+  source = _synthetic(str(tmpdir.join('in.mp4')), chunks)
+  output = str(tmpdir.join('out.mp4'))
+  assert mp4.write_tags(source, parsley, output=output, padding=1024) == output
+  _check(output)
+  names = [name for name, _, _ in _layout(output)]
+  assert names == [b'ftyp', b'moov', b'free', b'mdat']
+  assert mp4.is_faststart(output)
+
+def test_moov_at_end_keeps_media_in_place(tmpdir):
+  source = _synthetic(str(tmpdir.join('in.mp4')), chunks, faststart=False)
+  mdat = [box for box in _layout(source) if box[0] == b'mdat']
+  assert mp4.write_tags(source, parsley) == source
+  _check(source)
+  assert [box for box in _layout(source) if box[0] == b'mdat'] == mdat
+
+def test_padding_absorbs_tags_without_moving_media(tmpdir):
+  source = _synthetic(str(tmpdir.join('in.mp4')), chunks, padding=8192)
+  size = os.path.getsize(source)
+  mdat = [box for box in _layout(source) if box[0] == b'mdat']
+  assert mp4.write_tags(source, parsley) == source
+  _check(source)
+  assert os.path.getsize(source) == size
+  assert [box for box in _layout(source) if box[0] == b'mdat'] == mdat
+  assert sorted(os.listdir(str(tmpdir))) == ['in.mp4']
+
+def test_padding_is_written_in_place_without_clone(tmpdir, monkeypatch):
+  source = _synthetic(str(tmpdir.join('in.mp4')), chunks, padding=8192)
+  inode = os.stat(source).st_ino
+  monkeypatch.setattr(mp4, '_clone', lambda src, dst: False)
+  def copy(*args):
+    raise AssertionError('media was copied')
+  monkeypatch.setattr(mp4, 'copyfileobj', copy)
+  monkeypatch.setattr(mp4, '_copy', copy)
+  assert mp4.write_tags(source, parsley) == source
+  _check(source)
+  assert os.stat(source).st_ino == inode
+  assert sorted(os.listdir(str(tmpdir))) == ['in.mp4']
+
+def test_padded_output_leaves_source_untouched(tmpdir):
+  source = _synthetic(str(tmpdir.join('in.mp4')), chunks, padding=8192)
+  with open(source, 'rb') as f:
+    before = f.read()
+  output = str(tmpdir.join('out.mp4'))
+  assert mp4.write_tags(source, parsley, output=output) == output
+  _check(output)
+  with open(source, 'rb') as f:
+    assert f.read() == before
+
+def test_retagging_replaces_metadata(tmpdir):
+  source = _synthetic(str(tmpdir.join('in.mp4')), chunks, padding=8192)
+  mp4.write_tags(source, parsley)
+  mp4.write_tags(source, dict(parsley, title='Second'))
+  metas = [b for b in _moov(source).walk() if b.name == b'meta']
+  assert len(metas) == 1
+  assert _tags(source)[b'\xa9nam'] == b'Second'
+  assert _chunks(source, [len(c) for c in chunks]) == chunks
+
+def test_failed_write_leaves_original(tmpdir, monkeypatch):
+  source = _synthetic(str(tmpdir.join('in.mp4')), chunks, padding=8192)
+  with open(source, 'rb') as f:
+    before = f.read()
+  def fail(size):
+    raise IOError('disk full')
+  monkeypatch.setattr(mp4, '_free', fail)
+  with pytest.raises(IOError):
+    mp4.write_tags(source, parsley)
+  with open(source, 'rb') as f:
+    assert f.read() == before
+  assert sorted(os.listdir(str(tmpdir))) == ['in.mp4']
+
+def test_stco_is_promoted_to_co64():
+  offsets = [100, 0xffffff00]
+  moov = mp4.Box(b'moov', children=mp4.parse(_moov_box(offsets)[8:]))
+  assert not mp4._promote(moov, 50, 0x10)
+  assert mp4._promote(moov, 50, 0x1000)
+  mp4._shift_offsets(moov, 50, 0x1000)
+  box = [b for b in moov.walk() if b.name == b'co64'][0]
+  assert struct.unpack('>2Q', box.payload[8:]) == (100 + 0x1000, 0xffffff00 + 0x1000)
+  assert len([b for b in moov.walk() if b.name == b'stco']) == 0
+
+def _fixture(path, faststart):
+  cmd = ['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc=duration=2:size=128x72:rate=24',
+         '-f', 'lavfi', '-i', 'sine=duration=2', '-c:v', 'mpeg4', '-c:a', 'aac', '-shortest']
+  if faststart:
+    cmd.extend(['-movflags', '+faststart'])
+  subprocess.check_call(cmd + [path])
+  return path
+
+def _packets(path):
+  return subprocess.check_output(['ffmpeg', '-v', 'error', '-i', path, '-map', '0', '-c', 'copy', '-f', 'framemd5', '-'])
+
+def _probe_tags(path):
+  info = json.loads(subprocess.check_output(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', path]).decode('utf-8'))
+  return info['format'].get('tags', {})
+
+@needs_ffmpeg
+@pytest.mark.parametrize('faststart', [True, False])
+def test_ffmpeg_round_trip(tmpdir, faststart):
+  source = _fixture(str(tmpdir.join('in.mp4')), faststart)
+  before = _packets(source)
+  output = mp4.write_tags(source, parsley, output=str(tmpdir.join('out.mp4')), padding=4096)
+  assert _packets(output) == before
+  assert _probe_tags(output)['title'] == 'Pilot \xa9'
+  assert mp4.read_version(output) == {'video': 1, 'audio': 2, 'tags': 3}
+  assert mp4.write_tags(output, dict(parsley, title='Again')) == output
+  assert _packets(output) == before
+  assert _probe_tags(output)['title'] == 'Again'
+
+@needs_ffmpeg
+@needs_atomicparsley
+def test_atomicparsley_parity(tmpdir):
+  source = _fixture(str(tmpdir.join('in.mp4')), True)
+  native = mp4.write_tags(source, parsley, output=str(tmpdir.join('native.mp4')))
+  reference = str(tmpdir.join('reference.mp4'))
+  subprocess.check_call(['AtomicParsley', source, '--output', reference, '--title', parsley['title'].encode('utf-8'),
+                         '--TVShowName', parsley['TVShowName'], '--stik', parsley['stik'],
+                         '--TVSeasonNum', str(parsley['TVSeasonNum']), '--TVEpisodeNum', str(parsley['TVEpisodeNum'])])
+  expected = _tags(reference)
+  actual = _tags(native)
+  for name in [b'\xa9nam', b'tvsh', b'stik', b'tvsn', b'tves']:
+    assert actual[name] == expected[name]
+  assert _packets(native) == _packets(reference)
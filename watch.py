@@ -0,0 +1,214 @@
+from __future__ import unicode_literals
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from time import time
+from logging import getLogger
+from logs import setup_logging
+from cache import fingerprint
+from jobqueue import JobQueue
+from convert import submit_ladder, submit_movie
+from config import config
+
+watch_folders = config.get('watch_folders', [
+  {'path': '/tank/incoming/movies/priority', 'mode': 'ladder', 'priority': 'priority'},
+  {'path': '/tank/incoming/movies', 'mode': 'ladder', 'priority': 'normal'},
+  {'path': '/tank/Incoming', 'mode': 'movie', 'priority': 'normal'}
+])
+watch_settle = config.get('watch_settle', 30)
+watch_retry_failed = config.get('watch_retry_failed', False)
+
+submitters = {
+  'ladder': submit_ladder,
+  'movie': submit_movie
+}
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_event = struct.Struct('iIII')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.inotify_init1.argtypes = [ctypes.c_int]
+_libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+_libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+def _check(result):
+  if result < 0:
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+  return result
+
+def _encode(path):
+  return path if isinstance(path, bytes) else path.encode('utf-8')
+
+def _decode(path):
+  return path.decode('utf-8') if isinstance(path, bytes) else path
+
+class Inotify(object):
+  def __init__(self):
+    self.fd = _check(_libc.inotify_init1(IN_CLOEXEC))
+
+  def add(self, path, mask=watch_mask):
+    return _check(_libc.inotify_add_watch(self.fd, _encode(path), mask))
+
+  def remove(self, wd):
+    _libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self):
+    data = os.read(self.fd, 64 * 1024)
+    events = []
+    pos = 0
+    while pos < len(data):
+      wd, mask, cookie, length = _event.unpack_from(data, pos)
+      pos += _event.size
+      name = data[pos:pos + length].rstrip(b'\0')
+      pos += length
+      events.append((wd, mask, _decode(name)))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+class Watcher(object):
+  def __init__(self, folders=None, settle=None, retry_failed=None):
+    self.folders = sorted(folders or watch_folders, key=lambda f: len(f['path']), reverse=True)
+    self.settle = settle if settle is not None else watch_settle
+    self.retry_failed = retry_failed if retry_failed is not None else watch_retry_failed
+    self.log = getLogger()
+    self.queue = JobQueue()
+    self.inotify = None
+    self.watches = {}
+    self.pending = {}
+    self.rejected = set()
+
+  def _folder(self, path):
+    for folder in self.folders:
+      if path.startswith(os.path.join(folder['path'], '')):
+        return folder
+    return None
+
+  def _watch(self, folder):
+    for root, dirs, fs in os.walk(folder):
+      try:
+        wd = self.inotify.add(root)
+      except OSError as e:
+        self.log.warning('Unable to watch {:s}: {}'.format(root, e))
+        continue
+      self.watches[wd] = root
+      for f in fs:
+        self._consider(os.path.join(root, f))
+
+  def _consider(self, path):
+    if os.path.splitext(path)[1].lower() not in ['.mkv', '.mp4', '.avi']:
+      return
+    try:
+      st = os.stat(path)
+    except OSError:
+      self.pending.pop(path, None)
+      return
+    previous = self.pending.get(path)
+    if previous is None or previous[:2] != (st.st_size, st.st_mtime):
+      self.pending[path] = (st.st_size, st.st_mtime, time())
+
+  def _settled(self):
+    now = time()
+    for path, (size, mtime, since) in list(self.pending.items()):
+      self._consider(path)
+      if path not in self.pending or self.pending[path][2] != since or now - since < self.settle:
+        continue
+      del self.pending[path]
+      self._submit(path)
+
+  def _submit(self, path):
+    folder = self._folder(path)
+    if folder is None or path in self.rejected:
+      return
+    if not self.retry_failed:
+      try:
+        job = self.queue.failed(path, fingerprint(path))
+      except (IOError, OSError):
+        return
+      if job is not None:
+        self.log.info('{:s} already failed as job {:d}, not queueing it again'.format(os.path.basename(path), job['id']))
+        return
+    try:
+      job_id = submitters[folder['mode']](self.queue, path, priority=folder['priority'])
+    except Exception as e:
+      self.log.error('Unable to submit {:s}: {}'.format(path, e))
+      return
+    if job_id is None:
+      self.rejected.add(path)
+    else:
+      self.log.info('{:s} queued as job {:d}'.format(os.path.basename(path), job_id))
+
+  def _handle(self, wd, mask, name):
+    if mask & IN_Q_OVERFLOW:
+      self.log.warning('inotify queue overflowed, rescanning')
+      self._rescan()
+      return
+    if mask & IN_IGNORED:
+      self.watches.pop(wd, None)
+      return
+    if wd not in self.watches:
+      return
+    path = os.path.join(self.watches[wd], name)
+    if mask & IN_ISDIR:
+      if mask & (IN_CREATE | IN_MOVED_TO):
+        self._watch(path)
+    elif mask & (IN_DELETE | IN_MOVED_FROM):
+      self.pending.pop(path, None)
+      self.rejected.discard(path)
+    elif name:
+      self._consider(path)
+
+  def _rescan(self):
+    for wd in list(self.watches):
+      self.inotify.remove(wd)
+    self.watches = {}
+    for folder in self.folders:
+      if os.path.isdir(folder['path']):
+        self._watch(folder['path'])
+
+  def run(self):
+    self.inotify = Inotify()
+    try:
+      self._rescan()
+      self.log.info('Watching {:d} folders'.format(len(self.watches)))
+      while True:
+        timeout = None
+        if len(self.pending) > 0:
+          timeout = max(1, min(since for _, _, since in self.pending.values()) + self.settle - time())
+        try:
+          ready, _, _ = select.select([self.inotify.fd], [], [], timeout)
+        except select.error as e:
+          if e.args[0] != errno.EINTR:
+            raise
+          continue
+        if ready:
+          for wd, mask, name in self.inotify.read():
+            self._handle(wd, mask, name)
+        self._settled()
+    finally:
+      self.inotify.close()
+
+if __name__ == '__main__':
+  setup_logging(os.path.join(config['log_path'], 'watch'))
+  Watcher().run()